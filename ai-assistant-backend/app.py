@@ -1,4 +1,7 @@
 import os
+import gc
+import json
+import queue
 import random
 import re
 import secrets
@@ -6,23 +9,89 @@ import string
 import io
 import sys
 import shutil
+import subprocess
 import tempfile
 import uuid
+import zlib
 import ast
 import threading
+import time
+import hashlib
 from hashlib import sha256
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from itertools import combinations
 from pathlib import Path
-from typing import Any
+from typing import Any, BinaryIO, Callable, Iterable, Iterator
 
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, g, has_request_context, jsonify, request, send_file
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask_mail import Mail, Message
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text
+from sqlalchemy import and_, case, delete, event, func, insert, or_, text, update
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm import Session as OrmSession
 from werkzeug.utils import secure_filename
 from werkzeug.security import check_password_hash, generate_password_hash
 
+try:
+    import orjson  # type: ignore
+except Exception:  # optional: stdlib json is used when orjson isn't installed
+    orjson = None
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+
+def _json_dumps(obj: Any) -> str:
+    """Serialize to a UTF-8 JSON str (non-ASCII kept as-is, like ensure_ascii=False)."""
+
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False)
+
+try:
+    import zstandard as _zstd  # type: ignore
+except Exception:  # optional: stdlib zlib is used for compressed columns
+    _zstd = None
+
+# zstd frames start with this magic; anything else in a compressed column is zlib.
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def _compress_text(value: str) -> bytes:
+    """Compress a UTF-8 text payload (zstd level 3, or zlib without zstandard)."""
+
+    raw = value.encode('utf-8')
+    if _zstd is not None:
+        return _zstd.ZstdCompressor(level=3).compress(raw)
+    return zlib.compress(raw, 6)
+
+
+def _decompress_text(blob: bytes | None) -> str:
+    if not blob:
+        return ''
+    if blob[:4] == _ZSTD_MAGIC:
+        if _zstd is None:
+            raise RuntimeError('zstandard is required to read this column')
+        return _zstd.ZstdDecompressor().decompress(blob).decode('utf-8')
+    return zlib.decompress(blob).decode('utf-8')
+
+try:
+    import regex as _regex  # type: ignore
+except Exception:  # optional: falls back to the pure-Python bracket scan
+    _regex = None
+
+try:
+    import numpy as _np  # type: ignore
+    from numba import njit as _njit  # type: ignore
+except Exception:  # optional: JIT-compiled bracket matcher
+    _np = None
+    _njit = None
+
 
 def _ensure_ffmpeg_on_path():
     """Best-effort ensure ffmpeg is discoverable.
@@ -58,7 +127,39 @@ def _ensure_ffmpeg_on_path():
 _ensure_ffmpeg_on_path()
 
 
+class _OrjsonJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, so every jsonify()/get_json() uses it.
+
+    Output matches the default provider (sorted keys, UTF-8, datetimes as HTTP
+    dates via `default`); calls with extra json.dumps kwargs are delegated.
+    """
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return self._dumps_bytes(obj).decode('utf-8')
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any):
+        obj = self._prepare_response_obj(args, kwargs)
+        if self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(obj)
+        return self._app.response_class(self._dumps_bytes(obj) + b'\n', mimetype=self.mimetype)
+
+    def _dumps_bytes(self, obj: Any) -> bytes:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option)
+
+
 app = Flask(__name__)
+if orjson is not None:
+    app.json = _OrjsonJSONProvider(app)
 CORS(
     app,
     resources={r"/api/*": {"origins": "*"}, r"/ai/api/*": {"origins": "*"}},
@@ -89,10 +190,46 @@ app.config.update(
     OCR_VERSION=os.getenv('OCR_VERSION'),
 )
 
+_db_uri = app.config['SQLALCHEMY_DATABASE_URI']
+if _db_uri.startswith('sqlite') and ':memory:' not in _db_uri:
+    # Request threads plus background workers (mail, note summaries) share the
+    # file; a busy timeout makes writers wait for the lock instead of failing
+    # with "database is locked". LIFO checkout keeps reusing the most recently
+    # returned connections, so their page cache and mmap stay warm.
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 5,
+        'max_overflow': 10,
+        'pool_use_lifo': True,
+        'connect_args': {'check_same_thread': False, 'timeout': 30},
+    }
+
 db = SQLAlchemy(app)
 mail = Mail(app)
 
 
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Tune every new SQLite connection: WAL journal + NORMAL sync.
+
+    With the default rollback journal each commit pays a full fsync and
+    readers block the writer; WAL batches dirty pages and lets reads proceed.
+    """
+
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.execute('PRAGMA mmap_size=268435456')
+        cursor.execute('PRAGMA cache_size=-65536')
+    finally:
+        cursor.close()
+
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', _apply_sqlite_pragmas)
+
+
 # --- Subject normalization (dashboard-friendly) -------------------------
 # Keep subject values stable so one concept doesn't fragment across labels.
 SUBJECT_CHOICES: list[str] = [
@@ -159,54 +296,79 @@ _SUBJECT_ALIASES: dict[str, str] = {
     '其它': '未分类',
 }
 
+# Exact-match lookup: every alias plus every choice mapped to itself (choices win).
+_SUBJECT_MAP: dict[str, str] = {**_SUBJECT_ALIASES, **{c: c for c in SUBJECT_CHOICES}}
+
+
+def _compile_keyword_pattern(keywords) -> re.Pattern:
+    # Longest keyword first so '体育健康' wins over '体育' at the same position.
+    return re.compile('|'.join(re.escape(k) for k in sorted(keywords, key=len, reverse=True) if k))
+
+
+# One C-level scan per group rejects inputs that contain none of its keywords.
+_SUBJECT_CHOICE_KEYWORDS = tuple(c for c in SUBJECT_CHOICES if c != '未分类')
+_SUBJECT_ALIAS_RE = _compile_keyword_pattern(_SUBJECT_ALIASES)
+_SUBJECT_CHOICE_RE = _compile_keyword_pattern(_SUBJECT_CHOICE_KEYWORDS)
+_SUBJECT_PREFIX_RE = re.compile(r'^(?:学科|科目|subject)\s*[:：]\s*', re.I)
+_EN_HINT_RE = re.compile(r'math|english|physics|chem|bio|history|geography', re.I)
+_EN_HINT_SUBJECTS: dict[str, str] = {
+    'math': '数学',
+    'english': '英语',
+    'physics': '物理',
+    'chem': '化学',
+    'bio': '生物',
+    'history': '历史',
+    'geography': '地理',
+}
+
+
+def _first_keyword(pattern: re.Pattern, s: str, keywords: Iterable[str]) -> str | None:
+    """The first of `keywords`, in priority order, that occurs in `s`.
+
+    The pattern only gates the lookup: when the text holds two keywords, the
+    earlier one in `keywords` wins, not the one that appears first in the text.
+    """
+
+    if not pattern.search(s):
+        return None
+    return next((k for k in keywords if k in s), None)
+
 
 def normalize_subject(subject: Any) -> str:
     if subject is None:
         return '未分类'
-    s = str(subject).strip()
+    return _normalize_subject_cached(str(subject))
+
+
+# Pure function over a small vocabulary (subject names repeat across every entry).
+@lru_cache(maxsize=4096)
+def _normalize_subject_cached(raw: str) -> str:
+    s = raw.strip()
     if not s:
         return '未分类'
 
     # Common prefixes
-    for prefix in ('学科：', '科目：', '科目:', '学科:', 'subject:', 'Subject:'):
-        if s.startswith(prefix):
-            s = s[len(prefix) :].strip()
-            break
-
-    # Direct hit
-    if s in SUBJECT_CHOICES:
-        return s
+    s = _SUBJECT_PREFIX_RE.sub('', s, count=1)
 
-    # Alias exact
-    if s in _SUBJECT_ALIASES:
-        return _SUBJECT_ALIASES[s]
+    # Direct hit / alias exact
+    hit = _SUBJECT_MAP.get(s)
+    if hit:
+        return hit
 
     # English hints
-    low = s.lower()
-    if 'math' in low:
-        return '数学'
-    if 'english' in low:
-        return '英语'
-    if 'physics' in low:
-        return '物理'
-    if 'chem' in low:
-        return '化学'
-    if 'bio' in low:
-        return '生物'
-    if 'history' in low:
-        return '历史'
-    if 'geography' in low:
-        return '地理'
+    hint = _first_keyword(_EN_HINT_RE, s.lower(), _EN_HINT_SUBJECTS)
+    if hint:
+        return _EN_HINT_SUBJECTS[hint]
 
     # Alias contains
-    for key, value in _SUBJECT_ALIASES.items():
-        if key and key in s:
-            return value
+    alias = _first_keyword(_SUBJECT_ALIAS_RE, s, _SUBJECT_ALIASES)
+    if alias:
+        return _SUBJECT_ALIASES[alias]
 
     # Choice contains
-    for choice in SUBJECT_CHOICES:
-        if choice != '未分类' and choice in s:
-            return choice
+    choice = _first_keyword(_SUBJECT_CHOICE_RE, s, _SUBJECT_CHOICE_KEYWORDS)
+    if choice:
+        return choice
 
     return '未分类'
 
@@ -228,7 +390,8 @@ class User(db.Model):
     verified = db.Column(db.Boolean, default=False)
     verification_code = db.Column(db.String(10))
     verification_expires = db.Column(db.DateTime)
-    auth_token = db.Column(db.String(128))
+    # Indexed for the token lookup on every authenticated request (token-cache misses).
+    auth_token = db.Column(db.String(128), index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     @property
@@ -282,18 +445,36 @@ class ErrorBookEntry(db.Model):
     image_mimetype = db.Column(db.String(80))
     image_size = db.Column(db.Integer)
     image_sha256 = db.Column(db.String(64))
-    image_blob = db.Column(db.LargeBinary)
-
-    ocr_text = db.Column(db.Text)
-    ocr_json = db.Column(db.Text)
-    ai_analysis = db.Column(db.Text)
-
-    quiz_json = db.Column(db.Text)
+    # Relative to ERROR_BOOK_UPLOAD_DIR. image_blob is legacy, kept only for backfill.
+    image_path = db.Column(db.String(255))
+    image_blob = db.deferred(db.Column(db.LargeBinary), group='image')
+
+    ocr_text = db.deferred(db.Column(db.Text), group='detail')
+    # Raw PaddleOCR output, compressed (see _compress_text). ocr_json is legacy
+    # plaintext, still read for rows written before the compressed column existed.
+    ocr_json_zst = db.deferred(db.Column(db.LargeBinary), group='detail')
+    ocr_json = db.deferred(db.Column(db.Text), group='detail')
+    ai_analysis = db.deferred(db.Column(db.Text), group='detail')
+    # Small JSON digest of ai_analysis (key_points / review_plan / mistake_concepts),
+    # written with it so list views never parse the full analysis.
+    ai_digest_json = db.Column(db.Text)
+
+    quiz_json = db.deferred(db.Column(db.Text), group='detail')
     quiz_created_at = db.Column(db.DateTime)
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # Lists filter by user_id and sort by created_at desc; SQLite walks this index backwards.
+    __table_args__ = (
+        db.Index('ix_error_book_entries_user_created', 'user_id', 'created_at'),
+        db.Index('ix_error_book_entries_user_status', 'user_id', 'status'),
+        db.Index('ix_error_book_entries_user_sha', 'user_id', 'image_sha256'),
+        # Stored images are shared across users; deletes check for other references.
+        db.Index('ix_error_book_entries_sha', 'image_sha256'),
+    )
+
     def to_summary(self):
+        # Reads only ERROR_BOOK_SUMMARY_COLUMNS so list queries can load_only() them.
         return {
             'id': self.id,
             'title': self.title or '未命名错题',
@@ -301,21 +482,20 @@ class ErrorBookEntry(db.Model):
             'status': self.status,
             'verdict': self.verdict or '',
             'created_at': isoformat_utc_z(self.created_at),
-            'image_url': f"/api/error-book/entries/{self.id}/image" if self.image_blob else None,
+            'image_url': f"/api/error-book/entries/{self.id}/image" if (self.image_path or self.image_sha256) else None,
         }
 
     def to_detail(self):
         payload = self.to_summary()
         quiz_payload = None
-        if (self.quiz_json or '').strip():
-            stored = _loads_lenient_object(self.quiz_json)
-            if stored and isinstance(stored, dict):
-                quiz_payload, _ = _validate_quiz_dict(stored)
+        stored = _cached_json_object(self, 'quiz_json')
+        if stored:
+            quiz_payload, _ = _validate_quiz_dict(stored)
         payload.update(
             {
                 'ocr_text': self.ocr_text or '',
                 'ai_analysis': self.ai_analysis or '',
-                'ocr_json': self.ocr_json or '',
+                'ocr_json': _decompress_text(self.ocr_json_zst) if self.ocr_json_zst else (self.ocr_json or ''),
                 'quiz_created_at': isoformat_utc_z(self.quiz_created_at),
                 'quiz': quiz_payload,
             }
@@ -323,6 +503,22 @@ class ErrorBookEntry(db.Model):
         return payload
 
 
+# Columns touched by ErrorBookEntry.to_summary(); list endpoints load only these.
+ERROR_BOOK_SUMMARY_COLUMNS = (
+    ErrorBookEntry.id,
+    ErrorBookEntry.title,
+    ErrorBookEntry.subject,
+    ErrorBookEntry.status,
+    ErrorBookEntry.verdict,
+    ErrorBookEntry.created_at,
+    ErrorBookEntry.image_path,
+    ErrorBookEntry.image_sha256,
+)
+
+# What _extract_error_concepts reads (ai_analysis only lazy-loads for rows without a digest).
+ERROR_BOOK_CONCEPT_COLUMNS = (ErrorBookEntry.id, ErrorBookEntry.subject, ErrorBookEntry.ai_digest_json)
+
+
 class NoteAssistantEntry(db.Model):
     __tablename__ = 'note_assistant_entries'
 
@@ -344,12 +540,14 @@ class NoteAssistantEntry(db.Model):
     audio_sha256 = db.Column(db.String(64))
 
     transcript_text = db.Column(db.Text)
-    summary_json = db.Column(db.Text)
-    tasks_json = db.Column(db.Text)
+    summary_json = db.deferred(db.Column(db.Text), group='detail')
+    tasks_json = db.deferred(db.Column(db.Text), group='detail')
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    __table_args__ = (db.Index('ix_note_assistant_entries_user_created', 'user_id', 'created_at'),)
+
     def to_summary(self):
         transcript_preview = (self.transcript_text or '').strip().replace('\r', '')
         if len(transcript_preview) > 160:
@@ -367,12 +565,9 @@ class NoteAssistantEntry(db.Model):
 
     def to_detail(self):
         payload = self.to_summary()
-        summary = _loads_lenient_object(self.summary_json or '') if (self.summary_json or '').strip() else None
-        tasks = None
-        if (self.tasks_json or '').strip():
-            tasks_obj = _loads_lenient_object(self.tasks_json or '')
-            if isinstance(tasks_obj, dict):
-                tasks = tasks_obj.get('tasks')
+        summary = _cached_json_object(self, 'summary_json')
+        tasks_obj = _cached_json_object(self, 'tasks_json')
+        tasks = tasks_obj.get('tasks') if tasks_obj else None
         payload.update(
             {
                 'transcript': (self.transcript_text or ''),
@@ -397,7 +592,10 @@ class KnowledgeNode(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_seen_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    __table_args__ = (db.UniqueConstraint('user_id', 'subject', 'name', name='uq_knowledge_node_user_subject_name'),)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'subject', 'name', name='uq_knowledge_node_user_subject_name'),
+        db.Index('ix_knowledge_nodes_user_last_seen', 'user_id', 'last_seen_at'),
+    )
 
     def to_dict(self):
         return {
@@ -411,6 +609,28 @@ class KnowledgeNode(db.Model):
         }
 
 
+class KnowledgeHit(db.Model):
+    """One knowledge node mentioned by one error-book entry or note.
+
+    Written when an entry's concepts are upserted, so dashboards can count
+    mentions per node with a GROUP BY instead of re-extracting concepts.
+    """
+
+    __tablename__ = 'knowledge_hits'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    node_id = db.Column(db.Integer, db.ForeignKey('knowledge_nodes.id'), nullable=False)
+    source_type = db.Column(db.String(20), nullable=False)  # error_book|note
+    source_id = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('source_type', 'source_id', 'node_id', name='uq_knowledge_hit_source_node'),
+        db.Index('ix_knowledge_hits_user_node', 'user_id', 'node_id'),
+    )
+
+
 class MindMapSnapshot(db.Model):
     __tablename__ = 'mind_map_snapshots'
 
@@ -463,121 +683,187 @@ class BindRequest(db.Model):
         }
 
 
-def ensure_error_book_entry_schema():
+# Columns added after the initial release. SQLAlchemy create_all() won't add new
+# columns to existing tables, so ensure_schema() backfills them on SQLite.
+_PLANNED_COLUMNS: list[tuple[str, str, str]] = [
+    ('error_book_entries', 'quiz_json', 'TEXT'),
+    ('error_book_entries', 'quiz_created_at', 'DATETIME'),
+    ('error_book_entries', 'image_path', 'VARCHAR(255)'),
+    ('error_book_entries', 'ai_digest_json', 'TEXT'),
+    ('error_book_entries', 'ocr_json_zst', 'BLOB'),
+    ('note_assistant_entries', 'session_id', 'VARCHAR(64)'),
+    ('note_assistant_entries', 'title', 'VARCHAR(200)'),
+    ('note_assistant_entries', 'subject', 'VARCHAR(80)'),
+    ('note_assistant_entries', 'focus_tag', 'VARCHAR(80)'),
+    ('note_assistant_entries', 'status', 'VARCHAR(30)'),
+    ('note_assistant_entries', 'audio_original_name', 'VARCHAR(255)'),
+    ('note_assistant_entries', 'audio_mimetype', 'VARCHAR(80)'),
+    ('note_assistant_entries', 'audio_size', 'INTEGER'),
+    ('note_assistant_entries', 'audio_sha256', 'VARCHAR(64)'),
+    ('note_assistant_entries', 'transcript_text', 'TEXT'),
+    ('note_assistant_entries', 'summary_json', 'TEXT'),
+    ('note_assistant_entries', 'tasks_json', 'TEXT'),
+    ('note_assistant_entries', 'created_at', 'DATETIME'),
+    ('note_assistant_entries', 'updated_at', 'DATETIME'),
+    ('knowledge_nodes', 'last_seen_at', 'DATETIME'),
+    ('mind_map_snapshots', 'highlights_json', 'TEXT'),
+    ('mind_map_snapshots', 'related_json', 'TEXT'),
+    ('bind_requests', 'responded_at', 'DATETIME'),
+]
+
+# Indexes declared on the models after tables already existed in deployed DBs.
+_PLANNED_INDEXES: list[tuple[str, str, str]] = [
+    ('users', 'ix_users_auth_token', 'auth_token'),
+    ('error_book_entries', 'ix_error_book_entries_user_created', 'user_id, created_at'),
+    ('error_book_entries', 'ix_error_book_entries_user_status', 'user_id, status'),
+    ('error_book_entries', 'ix_error_book_entries_user_sha', 'user_id, image_sha256'),
+    ('error_book_entries', 'ix_error_book_entries_sha', 'image_sha256'),
+    ('note_assistant_entries', 'ix_note_assistant_entries_user_created', 'user_id, created_at'),
+    ('knowledge_nodes', 'ix_knowledge_nodes_user_last_seen', 'user_id, last_seen_at'),
+]
+
+
+def ensure_schema():
     """Best-effort migration for SQLite (development).
 
-    SQLAlchemy create_all() won't add new columns to existing tables.
-    This keeps existing user DBs working when we add quiz persistence.
+    Reads the existing tables/columns once and applies every missing column from
+    _PLANNED_COLUMNS (plus _PLANNED_INDEXES) in a single transaction. Tables that
+    don't exist yet are left to create_all().
     """
 
     try:
         if db.engine.dialect.name != 'sqlite':
             return
-        with db.engine.connect() as conn:
-            cols = conn.execute(text("PRAGMA table_info(error_book_entries)")).fetchall()
-            existing = {row[1] for row in cols}  # row[1] is column name
-            if 'quiz_json' not in existing:
-                conn.execute(text('ALTER TABLE error_book_entries ADD COLUMN quiz_json TEXT'))
-            if 'quiz_created_at' not in existing:
-                conn.execute(text('ALTER TABLE error_book_entries ADD COLUMN quiz_created_at DATETIME'))
-            conn.commit()
+        with db.engine.begin() as conn:
+            tables = conn.execute(text("SELECT name FROM sqlite_master WHERE type='table'"))
+            existing: dict[str, set[str]] = {row[0]: set() for row in tables.fetchall()}
+            planned_tables = {table for table, _, _ in _PLANNED_COLUMNS}
+            for table in planned_tables & existing.keys():
+                cols = conn.execute(text(f'PRAGMA table_info({table})')).fetchall()
+                existing[table] = {row[1] for row in cols}  # row[1] is column name
+
+            for table, column, ddl_type in _PLANNED_COLUMNS:
+                if table in existing and column not in existing[table]:
+                    conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl_type}'))
+
+            for table, index_name, columns in _PLANNED_INDEXES:
+                if table in existing:
+                    conn.execute(text(f'CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({columns})'))
     except Exception as exc:
         app.logger.warning('Schema migration skipped/failed: %s', exc)
 
 
-def ensure_note_assistant_schema():
-    """Best-effort migration for SQLite (development) for note_assistant_entries."""
+def backfill_error_book_digests(batch_size: int = 100) -> int:
+    """One-shot backfill: fill ai_digest_json for analysed rows written before it existed.
 
-    try:
-        if db.engine.dialect.name != 'sqlite':
-            return
-        with db.engine.connect() as conn:
-            tables = conn.execute(text("SELECT name FROM sqlite_master WHERE type='table'"))
-            names = {row[0] for row in tables.fetchall()}
-            if 'note_assistant_entries' not in names:
-                return
+    Returns the number of rows updated.
+    """
 
-            cols = conn.execute(text('PRAGMA table_info(note_assistant_entries)')).fetchall()
-            existing = {row[1] for row in cols}
-
-            # Columns added incrementally
-            if 'session_id' not in existing:
-                conn.execute(text('ALTER TABLE note_assistant_entries ADD COLUMN session_id VARCHAR(64)'))
-            if 'title' not in existing:
-                conn.execute(text('ALTER TABLE note_assistant_entries ADD COLUMN title VARCHAR(200)'))
-            if 'subject' not in existing:
-                conn.execute(text('ALTER TABLE note_assistant_entries ADD COLUMN subject VARCHAR(80)'))
-            if 'focus_tag' not in existing:
-                conn.execute(text('ALTER TABLE note_assistant_entries ADD COLUMN focus_tag VARCHAR(80)'))
-            if 'status' not in existing:
-                conn.execute(text('ALTER TABLE note_assistant_entries ADD COLUMN status VARCHAR(30)'))
-            if 'audio_original_name' not in existing:
-                conn.execute(text('ALTER TABLE note_assistant_entries ADD COLUMN audio_original_name VARCHAR(255)'))
-            if 'audio_mimetype' not in existing:
-                conn.execute(text('ALTER TABLE note_assistant_entries ADD COLUMN audio_mimetype VARCHAR(80)'))
-            if 'audio_size' not in existing:
-                conn.execute(text('ALTER TABLE note_assistant_entries ADD COLUMN audio_size INTEGER'))
-            if 'audio_sha256' not in existing:
-                conn.execute(text('ALTER TABLE note_assistant_entries ADD COLUMN audio_sha256 VARCHAR(64)'))
-            if 'transcript_text' not in existing:
-                conn.execute(text('ALTER TABLE note_assistant_entries ADD COLUMN transcript_text TEXT'))
-            if 'summary_json' not in existing:
-                conn.execute(text('ALTER TABLE note_assistant_entries ADD COLUMN summary_json TEXT'))
-            if 'tasks_json' not in existing:
-                conn.execute(text('ALTER TABLE note_assistant_entries ADD COLUMN tasks_json TEXT'))
-            if 'created_at' not in existing:
-                conn.execute(text('ALTER TABLE note_assistant_entries ADD COLUMN created_at DATETIME'))
-            if 'updated_at' not in existing:
-                conn.execute(text('ALTER TABLE note_assistant_entries ADD COLUMN updated_at DATETIME'))
-
-            conn.commit()
+    updated = 0
+    last_id = 0
+    try:
+        while True:
+            entries = (
+                ErrorBookEntry.query.options(db.undefer(ErrorBookEntry.ai_analysis))
+                .filter(ErrorBookEntry.id > last_id)
+                .filter(ErrorBookEntry.ai_digest_json.is_(None))
+                .filter(ErrorBookEntry.ai_analysis.isnot(None))
+                .order_by(ErrorBookEntry.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not entries:
+                break
+            last_id = entries[-1].id
+            for entry in entries:
+                digest = _analysis_digest(entry)
+                if digest is not None:
+                    entry.ai_digest_json = _json_dumps(digest)
+                    updated += 1
+            db.session.commit()
     except Exception as exc:
-        app.logger.warning('Note schema migration skipped/failed: %s', exc)
+        db.session.rollback()
+        app.logger.warning('Error-book digest backfill skipped/failed: %s', exc)
+    return updated
 
 
-def ensure_knowledge_schema():
-    """Best-effort migration for SQLite (development) for knowledge_nodes/mind_map_snapshots."""
+def backfill_knowledge_hits(batch_size: int = 200) -> int:
+    """One-shot backfill: record knowledge hits for entries analysed before the table existed.
+
+    Only runs while knowledge_hits is empty. Hits are matched against existing
+    nodes only (nothing is created), mirroring what the dashboard counted before.
+    Returns the number of hits inserted.
+    """
 
+    inserted = 0
     try:
-        if db.engine.dialect.name != 'sqlite':
-            return
-        with db.engine.connect() as conn:
-            tables = conn.execute(text("SELECT name FROM sqlite_master WHERE type='table'"))
-            names = {row[0] for row in tables.fetchall()}
-            if 'knowledge_nodes' in names:
-                cols = conn.execute(text('PRAGMA table_info(knowledge_nodes)')).fetchall()
-                existing = {row[1] for row in cols}
-                if 'last_seen_at' not in existing:
-                    conn.execute(text('ALTER TABLE knowledge_nodes ADD COLUMN last_seen_at DATETIME'))
-            if 'mind_map_snapshots' in names:
-                cols = conn.execute(text('PRAGMA table_info(mind_map_snapshots)')).fetchall()
-                existing = {row[1] for row in cols}
-                if 'highlights_json' not in existing:
-                    conn.execute(text('ALTER TABLE mind_map_snapshots ADD COLUMN highlights_json TEXT'))
-                if 'related_json' not in existing:
-                    conn.execute(text('ALTER TABLE mind_map_snapshots ADD COLUMN related_json TEXT'))
-            conn.commit()
+        if db.session.query(KnowledgeHit.id).first() is not None:
+            return 0
+        sources = (
+            ('error_book', ErrorBookEntry, _extract_error_concepts),
+            ('note', NoteAssistantEntry, _extract_note_concepts),
+        )
+        for source_type, model, extract in sources:
+            last_id = 0
+            while True:
+                entries = model.query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+                if not entries:
+                    break
+                last_id = entries[-1].id
+                for entry in entries:
+                    subject, concepts = extract(entry)
+                    if not concepts:
+                        continue
+                    node_ids = [
+                        row[0]
+                        for row in db.session.query(KnowledgeNode.id).filter(
+                            KnowledgeNode.user_id == entry.user_id,
+                            KnowledgeNode.subject == subject,
+                            KnowledgeNode.name.in_(concepts),
+                        )
+                    ]
+                    db.session.add_all(
+                        KnowledgeHit(user_id=entry.user_id, node_id=node_id, source_type=source_type, source_id=entry.id)
+                        for node_id in node_ids
+                    )
+                    inserted += len(node_ids)
+                db.session.commit()
     except Exception as exc:
-        app.logger.warning('Knowledge schema migration skipped/failed: %s', exc)
+        db.session.rollback()
+        app.logger.warning('Knowledge hit backfill skipped/failed: %s', exc)
+    return inserted
 
 
-def ensure_bind_schema():
-    """Best-effort migration for bind_requests."""
+def migrate_error_book_images_to_disk(batch_size: int = 50) -> int:
+    """One-shot backfill: move legacy image_blob bytes into the upload dir.
+
+    Returns the number of migrated rows.
+    """
 
+    migrated = 0
     try:
-        if db.engine.dialect.name != 'sqlite':
-            return
-        with db.engine.connect() as conn:
-            tables = conn.execute(text("SELECT name FROM sqlite_master WHERE type='table'"))
-            names = {row[0] for row in tables.fetchall()}
-            if 'bind_requests' in names:
-                cols = conn.execute(text('PRAGMA table_info(bind_requests)')).fetchall()
-                existing = {row[1] for row in cols}
-                if 'responded_at' not in existing:
-                    conn.execute(text('ALTER TABLE bind_requests ADD COLUMN responded_at DATETIME'))
-            conn.commit()
+        while True:
+            entries = (
+                ErrorBookEntry.query.options(db.undefer_group('image'))
+                .filter(ErrorBookEntry.image_path.is_(None))
+                .filter(ErrorBookEntry.image_blob.isnot(None))
+                .limit(batch_size)
+                .all()
+            )
+            if not entries:
+                break
+            for entry in entries:
+                data = entry.image_blob
+                digest = entry.image_sha256 or sha256(data).hexdigest()
+                entry.image_sha256 = digest
+                entry.image_path = _store_error_book_image(data, digest)
+                entry.image_blob = None
+            db.session.commit()
+            migrated += len(entries)
     except Exception as exc:
-        app.logger.warning('Bind schema migration skipped/failed: %s', exc)
+        db.session.rollback()
+        app.logger.warning('Error-book image migration skipped/failed: %s', exc)
+    return migrated
 
 
 # --- Helpers -------------------------------------------------------------
@@ -595,7 +881,32 @@ def generate_token():
     return secrets.token_urlsafe(48)
 
 
-def send_email(subject, recipients, body):
+# Werkzeug method string for new password hashes. The default scrypt (n=2^15) costs
+# ~90ms of CPU per hash/check on the request thread; e.g. 'scrypt:16384:8:1' halves
+# that. Existing hashes keep verifying and are upgraded on the next successful login.
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', '').strip() or 'scrypt'
+
+
+def hash_password(password: str) -> str:
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+
+@lru_cache(maxsize=1)
+def _password_hash_prefix() -> str:
+    # Werkzeug expands defaults ('scrypt' -> 'scrypt:32768:8:1'); read it off a real hash.
+    return hash_password('').split('$', 1)[0]
+
+
+def password_needs_rehash(password_hash: str) -> bool:
+    return (password_hash or '').split('$', 1)[0] != _password_hash_prefix()
+
+
+_MAIL_QUEUE: 'queue.Queue[tuple[str, list[str], str]]' = queue.Queue(maxsize=512)
+_MAIL_WORKER: threading.Thread | None = None
+_MAIL_WORKER_LOCK = threading.Lock()
+
+
+def _send_email_now(subject, recipients, body):
     try:
         msg = Message(subject=subject, recipients=recipients, body=body)
         mail.send(msg)
@@ -603,13 +914,105 @@ def send_email(subject, recipients, body):
         app.logger.error('邮件发送失败: %s', exc)
 
 
+def _mail_worker_loop():
+    while True:
+        batch = [_MAIL_QUEUE.get()]
+        # Drain whatever else is queued so one SMTP connection serves the batch.
+        while True:
+            try:
+                batch.append(_MAIL_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            with app.app_context():
+                if len(batch) == 1:
+                    _send_email_now(*batch[0])
+                else:
+                    with mail.connect() as conn:
+                        for subject, recipients, body in batch:
+                            try:
+                                conn.send(Message(subject=subject, recipients=recipients, body=body))
+                            except Exception as exc:  # pragma: no cover
+                                app.logger.error('邮件发送失败: %s', exc)
+        except Exception as exc:  # pragma: no cover
+            app.logger.error('邮件发送失败: %s', exc)
+        finally:
+            for _ in batch:
+                _MAIL_QUEUE.task_done()
+
+
+def _ensure_mail_worker():
+    global _MAIL_WORKER
+    if _MAIL_WORKER is not None and _MAIL_WORKER.is_alive():
+        return
+    with _MAIL_WORKER_LOCK:
+        if _MAIL_WORKER is None or not _MAIL_WORKER.is_alive():
+            _MAIL_WORKER = threading.Thread(target=_mail_worker_loop, name='mail-sender', daemon=True)
+            _MAIL_WORKER.start()
+
+
+def send_email(subject, recipients, body):
+    """Queue an email for the background sender; SMTP stays off the request thread.
+
+    Falls back to sending synchronously when the queue is full.
+    """
+
+    try:
+        _ensure_mail_worker()
+        _MAIL_QUEUE.put_nowait((subject, list(recipients or []), body))
+    except queue.Full:
+        _send_email_now(subject, recipients, body)
+    except Exception as exc:  # pragma: no cover
+        app.logger.error('邮件入队失败: %s', exc)
+        _send_email_now(subject, recipients, body)
+
+
+# token -> (user_id, expires_at); skips the auth_token scan for repeat callers.
+_TOKEN_CACHE: dict[str, tuple[int, float]] = {}
+_TOKEN_CACHE_LOCK = threading.Lock()
+_TOKEN_CACHE_TTL = 60.0
+_TOKEN_CACHE_MAX = 4096
+
+
+def _cache_token(token: str, user_id: int) -> None:
+    now = time.monotonic()
+    with _TOKEN_CACHE_LOCK:
+        if len(_TOKEN_CACHE) >= _TOKEN_CACHE_MAX:
+            for key in [k for k, (_, exp) in _TOKEN_CACHE.items() if exp <= now]:
+                _TOKEN_CACHE.pop(key, None)
+            while len(_TOKEN_CACHE) >= _TOKEN_CACHE_MAX:
+                _TOKEN_CACHE.pop(next(iter(_TOKEN_CACHE)), None)
+        _TOKEN_CACHE[token] = (user_id, now + _TOKEN_CACHE_TTL)
+
+
+def invalidate_token(token: str | None) -> None:
+    if not token:
+        return
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE.pop(token, None)
+
+
 def get_auth_user():
     auth_header = request.headers.get('Authorization', '')
-    if auth_header.startswith('Bearer '):
-        token = auth_header.split(' ', 1)[1]
-        if token:
-            return User.query.filter_by(auth_token=token).first()
-    return None
+    if not auth_header.startswith('Bearer '):
+        return None
+    token = auth_header.split(' ', 1)[1]
+    if not token:
+        return None
+
+    with _TOKEN_CACHE_LOCK:
+        cached = _TOKEN_CACHE.get(token)
+    if cached and cached[1] > time.monotonic():
+        user = db.session.get(User, cached[0])
+        # Token may have been rotated since it was cached.
+        if user and user.auth_token == token:
+            return user
+        invalidate_token(token)
+
+    user = User.query.filter_by(auth_token=token).first()
+    if user:
+        _cache_token(token, user.id)
+    return user
 
 
 def require_auth():
@@ -625,27 +1028,37 @@ def get_error_book_access_user_ids(user: Any) -> list[int]:
     Rule:
     - student: only self
     - parent: self + linked children (students)
+
+    Memoized on flask.g for the rest of the request; the list is small (a parent
+    has a handful of children), so callers filter with a plain indexed IN.
     """
 
     if not user:
         return []
 
+    memo = g.setdefault('access_user_ids', {}) if has_request_context() else {}
+    cached = memo.get(user.id)
+    if cached is not None:
+        return list(cached)
+
     ids = [user.id]
 
     try:
         if (user.role or '') == 'parent':
-            # Case A: link stored on parent side
-            if user.linked_user and (user.linked_user.role or '') == 'student':
-                ids.append(user.linked_user.id)
-
+            # One id-only query covers both link directions:
+            # Case A: link stored on parent side (user.linked_user_id)
             # Case B: link stored on student side (potentially multiple children)
-            children = User.query.filter_by(linked_user_id=user.id, role='student').all()
-            for child in children:
-                ids.append(child.id)
+            link_match = User.linked_user_id == user.id
+            if user.linked_user_id:
+                link_match = or_(link_match, User.id == user.linked_user_id)
+            rows = db.session.query(User.id).filter(User.role == 'student', link_match).all()
+            ids.extend(row[0] for row in rows)
     except Exception:
         pass
 
-    return sorted(set(int(x) for x in ids if x is not None))
+    result = sorted(set(int(x) for x in ids if x is not None))
+    memo[user.id] = tuple(result)
+    return result
 
 
 def get_note_access_user_ids(user: Any) -> list[int]:
@@ -667,128 +1080,259 @@ def isoformat_utc_z(dt: Any) -> str | None:
 
     if not dt:
         return None
+    if isinstance(dt, datetime) and dt.tzinfo is None:
+        # Fast path for DB values: already UTC, no conversion needed.
+        return dt.isoformat() + 'Z'
     if not isinstance(dt, datetime):
         try:
             dt = datetime.fromisoformat(str(dt))
         except Exception:
             return None
 
-    if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
-    return dt.astimezone(timezone.utc).isoformat().replace('+00:00', 'Z')
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.isoformat() + 'Z'
+
+
+_WS_RE = re.compile(r'\s+')
+_CONCEPT_TRIM_CHARS = ' \t\r\n，。；;：:、-—'
 
 
 def _normalize_concept_name(value: Any) -> str:
-    s = str(value or '').strip()
+    return _normalize_concept_name_cached(str(value or ''))
+
+
+@lru_cache(maxsize=4096)
+def _normalize_concept_name_cached(raw: str) -> str:
+    s = raw.strip()
     if not s:
         return ''
-    # collapse whitespace
-    s = re.sub(r'\s+', ' ', s)
-    # remove long punctuation tails
-    s = s.strip(' \t\r\n，。；;：:、-—')
+    # collapse whitespace, then remove long punctuation tails
+    s = _WS_RE.sub(' ', s).strip(_CONCEPT_TRIM_CHARS)
     if len(s) > 24:
         s = s[:24]
     return s
 
 
 def get_or_create_knowledge_node(owner_user_id: int, subject: Any, name: Any, kind: str = 'concept') -> KnowledgeNode | None:
-    subject_norm = normalize_subject(subject)
     name_norm = _normalize_concept_name(name)
     if not name_norm:
         return None
+    nodes = bulk_upsert_knowledge_nodes(owner_user_id, subject, [name_norm], kind=kind)
+    return nodes.get(name_norm)
+
+
+def bulk_upsert_knowledge_nodes(
+    owner_user_id: int,
+    subject: Any,
+    names: list[Any],
+    kind: str = 'concept',
+    commit: bool = True,
+    kinds: dict[str, str] | None = None,
+) -> dict[str, KnowledgeNode]:
+    """Get-or-create many knowledge nodes of one subject in a single transaction.
+
+    One SELECT ... IN finds existing (subject, name) rows, one UPDATE bumps their
+    last_seen_at, new rows are inserted together, then a single commit (or just a
+    flush with commit=False, leaving the caller to commit). `kinds` maps a
+    normalized name to its own kind, overriding `kind` for that name.
+    Returns {normalized_name: node}.
+    """
+
+    subject_norm = normalize_subject(subject)
+    name_list = [n for n in dict.fromkeys(_normalize_concept_name(x) for x in (names or [])) if n]
+    if not name_list:
+        return {}
+
+    now = datetime.utcnow()
+    existing = {
+        n.name: n
+        for n in KnowledgeNode.query.filter(
+            KnowledgeNode.user_id == owner_user_id,
+            KnowledgeNode.subject == subject_norm,
+            KnowledgeNode.name.in_(name_list),
+        ).all()
+    }
+
+    if existing:
+        db.session.execute(
+            update(KnowledgeNode)
+            .where(KnowledgeNode.id.in_([n.id for n in existing.values()]))
+            .values(last_seen_at=now)
+        )
+        for node in existing.values():
+            node_kind = kinds.get(node.name, kind) if kinds else kind
+            if node_kind and node_kind != 'concept' and (node.kind or '') == 'concept':
+                node.kind = node_kind
+
+    new_nodes = [
+        KnowledgeNode(
+            user_id=owner_user_id,
+            subject=subject_norm,
+            name=name_norm,
+            kind=(kinds.get(name_norm, kind) if kinds else kind) or 'concept',
+            last_seen_at=now,
+        )
+        for name_norm in name_list
+        if name_norm not in existing
+    ]
+    if new_nodes:
+        db.session.add_all(new_nodes)
+    if not commit:
+        db.session.flush()
+        if existing:
+            # The bulk UPDATE above bypasses the flush hook that tracks dashboard owners.
+            db.session.info.setdefault('dashboard_owners', set()).add(owner_user_id)
+    else:
+        db.session.commit()
+        if existing:
+            # The bulk UPDATE above bypasses the flush hook that tracks dashboard owners.
+            invalidate_dashboard_cache([owner_user_id])
+
+    result = dict(existing)
+    result.update((n.name, n) for n in new_nodes)
+    return result
+
+
+def _dedup_cap(items: Iterable[str], cap: int = 16) -> list[str]:
+    """Keep the first `cap` distinct non-empty items, stopping as soon as the cap is hit."""
+
+    seen: set[str] = set()
+    out: list[str] = []
+    for item in items:
+        if not item or item in seen:
+            continue
+        seen.add(item)
+        out.append(item)
+        if len(out) >= cap:
+            break
+    return out
 
-    node = KnowledgeNode.query.filter_by(user_id=owner_user_id, subject=subject_norm, name=name_norm).first()
-    if node:
-        node.last_seen_at = datetime.utcnow()
-        if kind and (node.kind or '') == 'concept' and kind != 'concept':
-            node.kind = kind
-        save_and_commit(node)
-        return node
-
-    node = KnowledgeNode(
-        user_id=owner_user_id,
-        subject=subject_norm,
-        name=name_norm,
-        kind=kind or 'concept',
-        last_seen_at=datetime.utcnow(),
-    )
-    save_and_commit(node)
-    return node
 
+def _summary_point_heads(points: list) -> Iterator[str]:
+    for p in points:
+        s = str(p or '').strip()
+        if s:
+            yield s.split('：', 1)[0].strip() if '：' in s else s[:12]
 
-def _extract_note_concepts(entry: 'NoteAssistantEntry') -> tuple[str, list[str]]:
+
+def _extract_note_concepts(entry: 'NoteAssistantEntry', summary_obj: dict | None = None) -> tuple[str, list[str]]:
     """Return (subject, concept_names) from a note entry.
 
     - key_terms are preferred as concept nodes
     - fallback: summary_points headings
+
+    Pass `summary_obj` when the caller already has the summary dict, to skip
+    re-parsing summary_json.
     """
 
     subject = normalize_subject(entry.subject)
     concepts: list[str] = []
 
-    summary_obj = _loads_lenient_object(entry.summary_json or '') if (entry.summary_json or '').strip() else None
+    if summary_obj is None:
+        summary_obj = _cached_json_object(entry, 'summary_json')
     if isinstance(summary_obj, dict):
         key_terms = summary_obj.get('key_terms')
         if isinstance(key_terms, list):
-            for t in key_terms:
-                n = _normalize_concept_name(t)
-                if n:
-                    concepts.append(n)
+            concepts = _dedup_cap(_normalize_concept_name(t) for t in key_terms)
         if not concepts:
             points = summary_obj.get('summary_points')
             if isinstance(points, list):
-                for p in points:
-                    s = str(p or '').strip()
-                    if not s:
-                        continue
-                    head = s.split('：', 1)[0].strip() if '：' in s else s[:12]
-                    n = _normalize_concept_name(head)
-                    if n:
-                        concepts.append(n)
+                concepts = _dedup_cap(_normalize_concept_name(h) for h in _summary_point_heads(points))
+
+    return subject, concepts
+
+
+def _clean_str_list(value: Any) -> list[str]:
+    if not isinstance(value, list):
+        return []
+    return [s for s in (str(item or '').strip() for item in value) if s]
+
 
-    return subject, list(dict.fromkeys(concepts))[:16]
+def build_analysis_digest(parsed: dict) -> dict:
+    """The parts of a parsed analysis that dashboards and concept mining read."""
+
+    mistakes = parsed.get('mistakes')
+    concepts = [m.get('concept') for m in mistakes if isinstance(m, dict)] if isinstance(mistakes, list) else []
+    return {
+        'key_points': _clean_str_list(parsed.get('key_points')),
+        'review_plan': _clean_str_list(parsed.get('review_plan')),
+        'mistake_concepts': _clean_str_list(concepts),
+    }
+
+
+def _analysis_digest(entry: 'ErrorBookEntry') -> dict | None:
+    """Stored digest, or one parsed from ai_analysis for rows written before the column existed."""
+
+    if entry.ai_digest_json:
+        return _cached_json_object(entry, 'ai_digest_json')
+    parsed = _parse_first_json_object(entry.ai_analysis or '')
+    return build_analysis_digest(parsed) if isinstance(parsed, dict) else None
 
 
 def _extract_error_concepts(entry: 'ErrorBookEntry') -> tuple[str, list[str]]:
     subject = normalize_subject(entry.subject)
     concepts: list[str] = []
 
-    extracted = _extract_first_json_object(entry.ai_analysis or '')
-    parsed = _loads_lenient_object(extracted) if extracted else None
-    if isinstance(parsed, dict):
-        mistakes = parsed.get('mistakes')
-        if isinstance(mistakes, list):
-            for m in mistakes:
-                if not isinstance(m, dict):
-                    continue
-                c = _normalize_concept_name(m.get('concept'))
-                if c:
-                    concepts.append(c)
-        key_points = parsed.get('key_points')
-        if isinstance(key_points, list):
-            for kp in key_points:
-                c = _normalize_concept_name(kp)
-                if c:
-                    concepts.append(c)
+    digest = _analysis_digest(entry)
+    if digest:
+        concepts = _dedup_cap(
+            _normalize_concept_name(c) for c in (*digest.get('mistake_concepts', ()), *digest.get('key_points', ()))
+        )
 
-    return subject, list(dict.fromkeys(concepts))[:16]
+    return subject, concepts
 
 
-def upsert_knowledge_from_note(entry: 'NoteAssistantEntry'):
+def _delete_knowledge_hits(source_type: str, source_id: int) -> None:
+    """Queue removal of a source entry's hits in the current transaction (SQLite may reuse its id)."""
+
+    db.session.execute(
+        delete(KnowledgeHit).where(KnowledgeHit.source_type == source_type, KnowledgeHit.source_id == source_id)
+    )
+
+
+def replace_knowledge_hits(
+    owner_user_id: int, source_type: str, source_id: int, nodes: Iterable[KnowledgeNode], commit: bool = True
+) -> None:
+    """Make `nodes` the full set of hits recorded for one source entry."""
+
+    # identity[0] is the primary key; reading .id would refresh each node expired by
+    # the upsert's commit.
+    node_ids = list(dict.fromkeys(sa_inspect(n).identity[0] for n in nodes))
+    _delete_knowledge_hits(source_type, source_id)
+    db.session.add_all(
+        KnowledgeHit(user_id=owner_user_id, node_id=node_id, source_type=source_type, source_id=source_id)
+        for node_id in node_ids
+    )
+    if commit:
+        db.session.commit()
+
+
+def upsert_knowledge_from_note(entry: 'NoteAssistantEntry', summary_obj: dict | None = None):
     try:
-        subject, concepts = _extract_note_concepts(entry)
-        for name in concepts:
-            get_or_create_knowledge_node(entry.user_id, subject, name, kind='concept')
+        subject, concepts = _extract_note_concepts(entry, summary_obj)
+        nodes = bulk_upsert_knowledge_nodes(entry.user_id, subject, concepts, kind='concept')
+        replace_knowledge_hits(entry.user_id, 'note', entry.id, nodes.values())
     except Exception:
+        db.session.rollback()
         return
 
 
-def upsert_knowledge_from_error(entry: 'ErrorBookEntry'):
+def upsert_knowledge_from_error(entry: 'ErrorBookEntry', commit: bool = True):
+    """Record the entry's concepts as knowledge nodes + hits.
+
+    With commit=False the writes join the caller's transaction inside a SAVEPOINT,
+    so a failure here is rolled back without discarding the caller's pending changes.
+    """
+
     try:
-        subject, concepts = _extract_error_concepts(entry)
-        for name in concepts:
-            get_or_create_knowledge_node(entry.user_id, subject, name, kind='concept')
+        with nullcontext() if commit else db.session.begin_nested():
+            subject, concepts = _extract_error_concepts(entry)
+            nodes = bulk_upsert_knowledge_nodes(entry.user_id, subject, concepts, kind='concept', commit=commit)
+            replace_knowledge_hits(entry.user_id, 'error_book', entry.id, nodes.values(), commit=commit)
     except Exception:
+        if commit:
+            db.session.rollback()
         return
 
 
@@ -796,8 +1340,22 @@ USERNAME_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{3,20}$')
 
 
 _OCR_INSTANCE: Any = None
+_OCR_INIT_LOCK = threading.Lock()
+# One predictor serves all workers; inference on it is serialized.
+_OCR_RUN_LOCK = threading.Lock()
+_OCR_RUN_COUNT = 0
+# Release cached allocator memory every N OCR runs (0 disables).
+_OCR_GC_EVERY = int(os.getenv('OCR_GC_EVERY', '100'))
 _WHISPER_PIPELINE: Any = None
 _WHISPER_INIT_LOCK = threading.Lock()
+# A compiled model shares one static KV cache and one set of CUDA graphs across
+# calls, so concurrent generate() calls would overwrite each other; with
+# WHISPER_TORCH_COMPILE=1 this becomes a lock and calls are serialized.
+_WHISPER_RUN_LOCK: Any = nullcontext()
+# Set once the pipeline is loaded; request handlers check it instead of loading inline.
+_WHISPER_READY = threading.Event()
+# Whisper's feature extractor expects 16kHz mono input.
+_WHISPER_SAMPLE_RATE = 16000
 _WHISPER_INIT_ERROR: str | None = None
 
 
@@ -857,44 +1415,165 @@ def note_whisper_status():
     return jsonify(info)
 
 
+# ```lang\n...``` wrapping the whole (stripped) text; the body is group 1.
+_CODE_FENCE_RE = re.compile(r'\A```[^\n]*\n(.*?)```\Z', re.DOTALL)
+
+
 def _strip_code_fence(text: str) -> str:
     trimmed = (text or '').strip()
-    if trimmed.startswith('```') and trimmed.endswith('```'):
-        lines = trimmed.splitlines()
-        if len(lines) >= 2:
-            return '\n'.join(lines[1:-1]).strip()
-    return trimmed
+    m = _CODE_FENCE_RE.match(trimmed)
+    return m.group(1).strip() if m else trimmed
 
 
-def _extract_first_json_object(text: str) -> str | None:
-    s = _strip_code_fence(text)
-    start = s.find('{')
-    if start < 0:
-        return None
+def _parses_as_json_object(s: str) -> bool:
+    try:
+        return isinstance(_json_loads(s), dict)
+    except Exception:
+        return False
+
+
+# Balanced {...} / [...] spans that skip brackets inside JSON strings; needs the
+# `regex` package for recursion ((?R)).
+if _regex is not None:
+    _JSON_OBJ_RE = _regex.compile(r'\{(?:[^{}"]|"(?:\\.|[^"\\])*"|(?R))*\}', _regex.DOTALL)
+    _JSON_ARR_RE = _regex.compile(r'\[(?:[^\[\]"]|"(?:\\.|[^"\\])*"|(?R))*\]', _regex.DOTALL)
+else:
+    _JSON_OBJ_RE = _JSON_ARR_RE = None
+
+
+# Characters the bracket matcher has to look at; everything else is skipped in C.
+_BRACKET_SCAN_RE = {'{': re.compile(r'["{}]'), '[': re.compile(r'["\[\]]')}
+_JSON_STRING_SPECIAL_RE = re.compile(r'["\\]')
+
+
+if _njit is not None:
+
+    @_njit(cache=True)
+    def _balanced_span_nb(buf, start, open_b, close_b):
+        depth = 0
+        in_string = False
+        escape = False
+        for i in range(start, buf.shape[0]):
+            ch = buf[i]
+            if in_string:
+                if escape:
+                    escape = False
+                elif ch == 92:  # backslash
+                    escape = True
+                elif ch == 34:  # double quote
+                    in_string = False
+            elif ch == 34:
+                in_string = True
+            elif ch == open_b:
+                depth += 1
+            elif ch == close_b:
+                depth -= 1
+                if depth == 0:
+                    return i
+        return -1
+
+else:
+    _balanced_span_nb = None
+
+
+def _find_balanced_end_jit(s: str, start: int, open_ch: str, close_ch: str) -> int:
+    # Quotes/brackets/backslash are ASCII and never occur inside multi-byte UTF-8
+    # sequences, so scanning the encoded bytes is exact. Only the tail from `start`
+    # is encoded (once); the matched byte span is decoded once to map back.
+    raw = s[start:].encode('utf-8')
+    end_b = _balanced_span_nb(_np.frombuffer(raw, dtype=_np.uint8), 0, ord(open_ch), ord(close_ch))
+    if end_b < 0:
+        return -1
+    return start + len(raw[: end_b + 1].decode('utf-8')) - 1
+
+
+def _find_balanced_end(s: str, start: int, open_ch: str, close_ch: str) -> int:
+    """Index of the bracket closing the one at `start`, or -1.
+
+    Brackets inside JSON strings (with backslash escapes) are ignored. Uses the
+    Numba kernel when available; otherwise each step jumps straight to the next
+    quote/bracket (or, inside a string, the next quote/backslash).
+    """
+
+    if _balanced_span_nb is not None:
+        return _find_balanced_end_jit(s, start, open_ch, close_ch)
+
+    scan = _BRACKET_SCAN_RE[open_ch].search
+    scan_string = _JSON_STRING_SPECIAL_RE.search
     depth = 0
-    in_string = False
-    escape = False
-    for i in range(start, len(s)):
+    i = start
+    while True:
+        m = scan(s, i)
+        if m is None:
+            return -1
+        i = m.start()
         ch = s[i]
-        if in_string:
-            if escape:
-                escape = False
-            elif ch == '\\':
-                escape = True
-            elif ch == '"':
-                in_string = False
-            continue
-
         if ch == '"':
-            in_string = True
+            j = i + 1
+            while True:
+                m = scan_string(s, j)
+                if m is None:
+                    return -1
+                j = m.start()
+                if s[j] == '\\':
+                    j += 2
+                    continue
+                break
+            i = j + 1
             continue
-        if ch == '{':
+        if ch == open_ch:
             depth += 1
-        elif ch == '}':
+        elif ch == close_ch:
             depth -= 1
             if depth == 0:
-                return s[start : i + 1].strip()
-    return None
+                return i
+        i += 1
+
+
+def _extract_first_json_object(text: str) -> str | None:
+    s = _strip_code_fence(text)
+    start = s.find('{')
+    if start < 0:
+        return None
+
+    # Fast path: most model replies are a single clean object, so parse the
+    # outermost {...} span in C before falling back to the char-by-char scan.
+    end = s.rfind('}')
+    if end > start and _parses_as_json_object(s[start : end + 1]):
+        return s[start : end + 1].strip()
+
+    if _JSON_OBJ_RE is not None:
+        m = _JSON_OBJ_RE.match(s, start)
+        return m.group(0).strip() if m else None
+
+    end = _find_balanced_end(s, start, '{', '}')
+    return s[start : end + 1].strip() if end >= 0 else None
+
+
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _parse_first_json_object(text: str) -> dict | None:
+    """Parse the first {...} object in an LLM reply.
+
+    raw_decode() finds the end of the object and parses it in the same pass, so
+    well-formed replies are never scanned and then parsed again. Replies that are
+    not strict JSON (single quotes, True/None, smart quotes) go through the
+    balanced-span scan and the lenient parser instead.
+    """
+
+    s = _strip_code_fence(text)
+    start = s.find('{')
+    if start < 0:
+        return None
+    try:
+        obj, _ = _JSON_DECODER.raw_decode(s, start)
+        if isinstance(obj, dict):
+            return obj
+    except ValueError:
+        pass
+    extracted = _extract_first_json_object(s)
+    return _loads_lenient_object(extracted) if extracted else None
 
 
 def _extract_first_json_array(text: str) -> str | None:
@@ -902,30 +1581,31 @@ def _extract_first_json_array(text: str) -> str | None:
     start = s.find('[')
     if start < 0:
         return None
-    depth = 0
-    in_string = False
-    escape = False
-    for i in range(start, len(s)):
-        ch = s[i]
-        if in_string:
-            if escape:
-                escape = False
-            elif ch == '\\':
-                escape = True
-            elif ch == '"':
-                in_string = False
-            continue
 
-        if ch == '"':
-            in_string = True
-            continue
-        if ch == '[':
-            depth += 1
-        elif ch == ']':
-            depth -= 1
-            if depth == 0:
-                return s[start : i + 1].strip()
-    return None
+    if _JSON_ARR_RE is not None:
+        m = _JSON_ARR_RE.match(s, start)
+        return m.group(0).strip() if m else None
+
+    end = _find_balanced_end(s, start, '[', ']')
+    return s[start : end + 1].strip() if end >= 0 else None
+
+
+# Tokens that differ between Python-literal dicts and JSON. Double-quoted strings
+# are matched first so their contents are left untouched.
+_PY_LITERAL_TOKEN_RE = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|\b(?:True|False|None)\b')
+_PY_LITERAL_KEYWORDS = {'True': 'true', 'False': 'false', 'None': 'null'}
+# Curly double quotes → ASCII, in one C pass.
+_SMART_QUOTE_TABLE = str.maketrans({'\u201c': '"', '\u201d': '"'})
+
+
+def _py_literal_token_to_json(m: re.Match) -> str:
+    tok = m.group(0)
+    if tok[0] == '"':
+        return tok
+    if tok[0] == "'":
+        inner = tok[1:-1].replace("\\'", "'").replace('"', '\\"')
+        return f'"{inner}"'
+    return _PY_LITERAL_KEYWORDS[tok]
 
 
 def _loads_lenient_object(text: str) -> dict | None:
@@ -940,21 +1620,21 @@ def _loads_lenient_object(text: str) -> dict | None:
     if not s:
         return None
 
-    import json
-
     try:
-        obj = json.loads(s)
+        obj = _json_loads(s)
         return obj if isinstance(obj, dict) else None
     except Exception:
         pass
 
-    normalized = (
-        s.replace('\u201c', '"')
-        .replace('\u201d', '"')
-        .replace('“', '"')
-        .replace('”', '"')
-        .strip()
-    )
+    normalized = s.translate(_SMART_QUOTE_TABLE).strip()
+
+    # Python-literal dicts ('single quotes', True/None) usually become valid JSON
+    # with a token rewrite, which is much cheaper than building an AST.
+    try:
+        obj = _json_loads(_PY_LITERAL_TOKEN_RE.sub(_py_literal_token_to_json, normalized))
+        return obj if isinstance(obj, dict) else None
+    except Exception:
+        pass
 
     try:
         obj = ast.literal_eval(normalized)
@@ -963,9 +1643,26 @@ def _loads_lenient_object(text: str) -> dict | None:
         return None
 
 
-def _validate_quiz_dict(parsed: dict) -> tuple[dict | None, str | None]:
-    options = parsed.get('options')
-    answer_index = parsed.get('answer_index')
+def _cached_json_object(instance: Any, attr: str) -> dict | None:
+    """Parse a JSON text column once per loaded instance.
+
+    The result is remembered on the instance and reused while the column still
+    holds the same string object; assigning a new value invalidates it.
+    """
+
+    raw = getattr(instance, attr) or ''
+    cache = instance.__dict__.setdefault('_json_cache', {})
+    hit = cache.get(attr)
+    if hit is not None and hit[0] is raw:
+        return hit[1]
+    parsed = _loads_lenient_object(raw) if raw.strip() else None
+    cache[attr] = (raw, parsed)
+    return parsed
+
+
+def _validate_quiz_dict(parsed: dict) -> tuple[dict | None, str | None]:
+    options = parsed.get('options')
+    answer_index = parsed.get('answer_index')
     if not (isinstance(options, list) and len(options) == 4):
         return None, '练习题 options 格式错误'
     if not (isinstance(answer_index, int) and 0 <= answer_index <= 3):
@@ -988,8 +1685,8 @@ def _validate_quiz_dict(parsed: dict) -> tuple[dict | None, str | None]:
     return payload, None
 
 
-def _generate_and_persist_quiz(entry: 'ErrorBookEntry') -> tuple[dict | None, str | None]:
-    """Generate quiz from entry.ocr_text, persist to DB on success."""
+def _generate_and_persist_quiz(entry: 'ErrorBookEntry', commit: bool = True) -> tuple[dict | None, str | None]:
+    """Generate quiz from entry.ocr_text, persist to DB on success (commit=False only sets it on the entry)."""
 
     if not (entry.ocr_text or '').strip():
         return None, 'OCR 文本为空，无法生成练习题'
@@ -999,24 +1696,19 @@ def _generate_and_persist_quiz(entry: 'ErrorBookEntry') -> tuple[dict | None, st
     except Exception as exc:
         return None, f'练习题生成失败：{exc}'
 
-    extracted = _extract_first_json_object(quiz_text)
-    if not extracted:
-        return None, '练习题返回格式非 JSON'
-
-    parsed = _loads_lenient_object(extracted)
+    parsed = _parse_first_json_object(quiz_text)
     if not parsed:
-        return None, '练习题 JSON 解析失败'
+        return None, ('练习题 JSON 解析失败' if '{' in (quiz_text or '') else '练习题返回格式非 JSON')
 
     payload, err = _validate_quiz_dict(parsed)
     if err or not payload:
         return None, err or '练习题格式错误'
 
     try:
-        import json
-
-        entry.quiz_json = json.dumps(payload, ensure_ascii=False)
+        entry.quiz_json = _json_dumps(payload)
         entry.quiz_created_at = datetime.utcnow()
-        save_and_commit(entry)
+        if commit:
+            save_and_commit(entry)
     except Exception as exc:
         app.logger.warning('Failed to persist quiz: %s', exc)
 
@@ -1024,10 +1716,18 @@ def _generate_and_persist_quiz(entry: 'ErrorBookEntry') -> tuple[dict | None, st
 
 
 def get_ocr_instance():
+    """Process-wide PaddleOCR engine, created once (the prewarm thread and upload workers may race)."""
+
     global _OCR_INSTANCE
     if _OCR_INSTANCE is not None:
         return _OCR_INSTANCE
+    with _OCR_INIT_LOCK:
+        if _OCR_INSTANCE is None:
+            _OCR_INSTANCE = _create_ocr_instance()
+    return _OCR_INSTANCE
+
 
+def _create_ocr_instance():
     try:
         from paddleocr import PaddleOCR  # type: ignore
     except Exception as exc:
@@ -1061,7 +1761,14 @@ def get_ocr_instance():
         kwargs['ocr_version'] = ocr_version
 
     try:
-        _OCR_INSTANCE = PaddleOCR(**kwargs)
+        # High-performance inference picks the fastest available backend
+        # (Paddle/ONNX Runtime/OpenVINO/TensorRT, FP16 where supported).
+        if os.getenv('OCR_ENABLE_HPI', '1').strip() != '0':
+            try:
+                return PaddleOCR(**kwargs, enable_hpi=True)
+            except Exception as exc:
+                app.logger.info('PaddleOCR HPI unavailable, using default backend: %s', exc)
+        return PaddleOCR(**kwargs)
     except Exception as exc:
         raise RuntimeError(
             'OCR 初始化失败。若日志包含 “No available model hosting platforms detected”，说明模型下载被网络/代理阻断。\n'
@@ -1072,7 +1779,6 @@ def get_ocr_instance():
             '   - OCR_TEXT_RECOGNITION_MODEL_DIR=...\n'
             '（也可设置 *_MODEL_NAME 或 OCR_LANG/OCR_VERSION）'
         ) from exc
-    return _OCR_INSTANCE
 
 
 def get_whisper_pipeline():
@@ -1084,6 +1790,7 @@ def get_whisper_pipeline():
 
     global _WHISPER_PIPELINE
     global _WHISPER_INIT_ERROR
+    global _WHISPER_RUN_LOCK
     if _WHISPER_PIPELINE is not None:
         return _WHISPER_PIPELINE
 
@@ -1122,11 +1829,19 @@ def get_whisper_pipeline():
             # If path probing fails, continue to let Transformers raise a more specific error.
             pass
         device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
-        torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+        if torch.cuda.is_available():
+            # bf16 on Ampere+ (same bandwidth as fp16, fewer overflows); fp16 otherwise.
+            torch_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        else:
+            torch_dtype = torch.float32
 
         try:
             model = AutoModelForSpeechSeq2Seq.from_pretrained(
-                model_id, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=True
+                model_id,
+                torch_dtype=torch_dtype,
+                low_cpu_mem_usage=True,
+                use_safetensors=True,
+                attn_implementation='sdpa',
             )
             model.to(device)
             processor = AutoProcessor.from_pretrained(model_id)
@@ -1143,6 +1858,16 @@ def get_whisper_pipeline():
             )
             raise WhisperUnavailableError(_WHISPER_INIT_ERROR) from exc
 
+        # Opt-in: compilation is slow on first call and not supported everywhere (e.g. Windows).
+        if os.getenv('WHISPER_TORCH_COMPILE', '').strip() == '1' and hasattr(torch, 'compile'):
+            try:
+                # A static KV cache keeps decoder shapes fixed, so CUDA graphs are reused across steps.
+                model.generation_config.cache_implementation = 'static'
+                _WHISPER_RUN_LOCK = threading.Lock()
+                model.forward = torch.compile(model.forward, mode='reduce-overhead')
+            except Exception as exc:
+                app.logger.warning('torch.compile for Whisper skipped: %s', exc)
+
         _WHISPER_PIPELINE = pipeline(
             'automatic-speech-recognition',
             model=model,
@@ -1150,8 +1875,14 @@ def get_whisper_pipeline():
             feature_extractor=processor.feature_extractor,
             torch_dtype=torch_dtype,
             device=device,
+            # Long recordings are split into overlapping 30s windows and the encoder
+            # runs on up to WHISPER_BATCH_SIZE windows per forward pass.
+            chunk_length_s=30,
+            stride_length_s=5,
+            batch_size=max(1, int(os.getenv('WHISPER_BATCH_SIZE', '8'))),
         )
         _WHISPER_INIT_ERROR = None
+        _WHISPER_READY.set()
         return _WHISPER_PIPELINE
     finally:
         try:
@@ -1160,13 +1891,115 @@ def get_whisper_pipeline():
             pass
 
 
+def _prewarm_models():
+    """Load OCR, Whisper and the Gemini client in the background so the first upload doesn't pay for it."""
+
+    if _balanced_span_nb is not None:
+        try:
+            _find_balanced_end('{"a": [1]}', 0, '{', '}')  # trigger JIT compile
+        except Exception as exc:
+            app.logger.warning('JSON span JIT warmup failed: %s', exc)
+
+    api_key = app.config.get('GEMINI_API_KEY', '')
+    if api_key:
+        try:
+            _genai_client(api_key)  # pays the google-genai import + client setup now
+        except Exception as exc:
+            app.logger.warning('Gemini client prewarm failed: %s', exc)
+
+    try:
+        get_ocr_instance()
+    except Exception as exc:
+        app.logger.warning('OCR prewarm failed: %s', exc)
+    try:
+        get_whisper_pipeline()
+    except Exception as exc:
+        app.logger.warning('Whisper prewarm failed: %s', _WHISPER_INIT_ERROR or exc)
+
+
+def start_model_prewarm() -> None:
+    if os.getenv('MODEL_PREWARM', '1').strip() == '0':
+        return
+    threading.Thread(target=_prewarm_models, name='model-prewarm', daemon=True).start()
+
+
+def _load_whisper_background() -> None:
+    try:
+        get_whisper_pipeline()
+    except WhisperInitializingError:
+        pass
+    except Exception as exc:
+        app.logger.warning('Whisper background init failed: %s', exc)
+
+
+def whisper_not_ready_response():
+    """Return a 503 response while Whisper is still loading, else None.
+
+    Loading happens on a background thread so Flask workers aren't tied up for
+    the whole model download. A recorded init error is left to the transcription
+    path, which reports it the same way as before.
+    """
+
+    if _WHISPER_READY.is_set():
+        return None
+    if _WHISPER_INIT_ERROR and os.getenv('WHISPER_FORCE_RETRY', '').strip() != '1':
+        return None
+    if not _WHISPER_INIT_LOCK.locked():
+        threading.Thread(target=_load_whisper_background, name='whisper-init', daemon=True).start()
+    resp = jsonify({'message': 'Whisper 模型预热中，请稍候重试', 'retry_after': 5})
+    resp.status_code = 503
+    resp.headers['Retry-After'] = '5'
+    return resp
+
+
 def transcribe_audio_file(audio_path: str) -> str:
-    pipe = get_whisper_pipeline()
     audio_path = str(audio_path)
     if not audio_path or not Path(audio_path).exists():
         raise RuntimeError(f'音频文件不存在：{audio_path}')
+    get_whisper_pipeline()  # fail fast before decoding if ASR isn't available
+    samples = _decode_audio_av(Path(audio_path))
+    if samples is not None and samples.size:
+        return transcribe_audio_samples(samples)
+    # No PyAV (or it couldn't decode): let the pipeline run ffmpeg itself.
+    return _run_whisper(audio_path)
+
+
+def transcribe_audio_samples(samples: Any) -> str:
+    """Transcribe 16kHz mono float32 samples (skips the pipeline's own ffmpeg decode)."""
+
+    return _run_whisper({'raw': samples, 'sampling_rate': _WHISPER_SAMPLE_RATE})
+
+
+def _transcript_cache_key(digest: str) -> tuple[str, str]:
+    model_id = os.getenv('WHISPER_MODEL') or 'openai/whisper-base'
+    return _ai_cache_key('transcript', model_id, digest, version=_WHISPER_CACHE_VERSION, provider='whisper'), model_id
+
+
+def _cached_transcript(digest: str) -> str | None:
+    return _ai_cache_get(_transcript_cache_key(digest)[0])
+
+
+def _transcribe_cached(digest: str, transcribe: Any) -> str:
+    """Transcript for audio with this sha256, from the AI cache or by calling `transcribe()`.
+
+    Retried uploads and re-finalized recordings of the same audio skip Whisper.
+    """
+
+    key, model_id = _transcript_cache_key(digest)
+    cached = _ai_cache_get(key)
+    if cached is not None:
+        return cached
+    transcript = transcribe()
+    if (transcript or '').strip():
+        _ai_cache_set(key, model_id, transcript, version=_WHISPER_CACHE_VERSION)
+    return transcript
+
+
+def _run_whisper(audio: Any) -> str:
+    pipe = get_whisper_pipeline()
     try:
-        result = pipe(audio_path, return_timestamps=True)
+        with _WHISPER_RUN_LOCK:
+            result = pipe(audio, return_timestamps=True)
     except Exception as exc:
         ffmpeg_ok = bool(shutil.which('ffmpeg'))
         detail = str(exc or '').strip()
@@ -1183,6 +2016,18 @@ def transcribe_audio_file(audio_path: str) -> str:
     return str(result).strip()
 
 
+# Checked in this order when the subtype isn't an exact key (e.g. "x-m4a").
+_MIME_SUFFIX = {
+    'webm': '.webm',
+    'wav': '.wav',
+    'mpeg': '.mp3',
+    'mp3': '.mp3',
+    'ogg': '.ogg',
+    'mp4': '.mp4',
+    'm4a': '.m4a',
+}
+
+
 def _guess_audio_suffix(original_name: str, mimetype: str) -> str:
     """Infer a safe filename suffix for temp audio files.
 
@@ -1198,98 +2043,270 @@ def _guess_audio_suffix(original_name: str, mimetype: str) -> str:
         return suffix
 
     mt = (mimetype or '').lower()
-    if 'webm' in mt:
-        return '.webm'
-    if 'wav' in mt:
-        return '.wav'
-    if 'mpeg' in mt or 'mp3' in mt:
-        return '.mp3'
-    if 'ogg' in mt:
-        return '.ogg'
-    if 'mp4' in mt:
-        return '.mp4'
-    if 'm4a' in mt:
-        return '.m4a'
+    # Common case: the subtype is a known key ("audio/webm;codecs=opus" -> "webm").
+    subtype = mt.split('/', 1)[-1].split(';', 1)[0].strip()
+    suffix = _MIME_SUFFIX.get(subtype)
+    if suffix:
+        return suffix
+    for key, suffix in _MIME_SUFFIX.items():
+        if key in mt:
+            return suffix
     return '.webm'
 
 
+def _error_book_upload_dir() -> Path:
+    base = Path(app.config['ERROR_BOOK_UPLOAD_DIR'])
+    base.mkdir(parents=True, exist_ok=True)
+    return base
+
+
+def _store_error_book_image(data: bytes | str, digest: str) -> str:
+    """Write image bytes once per sha256 (content-addressed); return the relative path.
+
+    `data` is either the raw bytes or the path of a (temp) file holding them; a
+    file is moved into place rather than copied. If the digest is already stored,
+    the file is left where it is for the caller to remove.
+    """
+
+    rel = Path(digest[:2]) / digest
+    full = _error_book_upload_dir() / rel
+    if not full.exists():
+        full.parent.mkdir(parents=True, exist_ok=True)
+        tmp = full.with_name(f'{digest}.{uuid.uuid4().hex}.tmp')
+        if isinstance(data, (bytes, bytearray)):
+            tmp.write_bytes(data)
+        else:
+            shutil.move(data, tmp)  # a rename when on the same filesystem
+        os.replace(tmp, full)
+    return rel.as_posix()
+
+
+# Image files are shared by every entry with the same bytes. Storing one for a new
+# row and unlinking one nobody references any more must not interleave, or a
+# delete could remove the file an upload is about to commit a row for.
+_ERROR_BOOK_IMAGE_LOCK = threading.Lock()
+
+
+def _remove_unreferenced_error_book_image(digest: str | None, rel_path: str | None) -> None:
+    """Unlink a stored image once no entry (of any user) has these bytes any more."""
+
+    if not digest or not rel_path:
+        return
+    with _ERROR_BOOK_IMAGE_LOCK:
+        if db.session.query(ErrorBookEntry.id).filter(ErrorBookEntry.image_sha256 == digest).first() is not None:
+            return
+        try:
+            (_error_book_upload_dir() / rel_path).unlink(missing_ok=True)
+        except Exception as exc:
+            app.logger.warning('Failed to remove error-book image %s: %s', rel_path, exc)
+
+
+_UPLOAD_CHUNK_SIZE = 1 << 20
+NOTE_AUDIO_MAX_BYTES = 80 * 1024 * 1024
+NOTE_CHUNK_MAX_BYTES = 10 * 1024 * 1024
+
+
+class UploadTooLargeError(RuntimeError):
+    pass
+
+
+def _stream_upload_to_tempfile(
+    file_storage: Any, suffix: str = '', prefix: str = 'upload_', max_size: int | None = None
+) -> tuple[str, int, str]:
+    """Copy an upload to a temp file in 1 MiB chunks, hashing as it goes.
+
+    Returns (path, size, sha256 hex); the caller removes the file. Past `max_size`
+    bytes the copy stops, the partial file is removed and UploadTooLargeError is raised.
+    """
+
+    h = sha256()
+    size = 0
+    fd, path = tempfile.mkstemp(prefix=prefix, suffix=suffix)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = file_storage.stream.read(_UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise UploadTooLargeError(f'upload exceeds {max_size} bytes')
+                out.write(chunk)
+                h.update(chunk)
+    except Exception:
+        try:
+            os.unlink(path)
+        except Exception:
+            pass
+        raise
+    return path, size, h.hexdigest()
+
+
 def _note_session_dir(session_id: str) -> Path:
     base = Path(app.instance_path) / 'uploads' / 'note_sessions' / session_id
     base.mkdir(parents=True, exist_ok=True)
     return base
 
 
-def _save_note_session_chunk(session_id: str, original_name: str, mimetype: str, data: bytes) -> Path:
-    import time
-
+def _save_note_session_chunk(
+    session_id: str, original_name: str, mimetype: str, stream: Any, max_size: int | None = None
+) -> Path:
     suffix = _guess_audio_suffix(original_name, mimetype)
     ts = int(time.time() * 1000)
     out_path = _note_session_dir(session_id) / f'chunk_{ts}{suffix}'
-    out_path.write_bytes(data)
+    # Written under a dot-name and renamed when complete, so the live decoder never
+    # reads a half-written chunk.
+    tmp_path = out_path.with_name(f'.{out_path.name}')
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as out:
+            while True:
+                chunk = stream.read(_UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise UploadTooLargeError(f'chunk exceeds {max_size} bytes')
+                out.write(chunk)
+        os.replace(tmp_path, out_path)
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        raise
     return out_path
 
 
-def _ffmpeg_concat_to_wav(chunk_paths: list[Path], wav_out: Path) -> tuple[bool, str]:
-    """Concat chunk files into a single WAV using ffmpeg concat demuxer."""
+def _decode_audio_av(path: Path | BinaryIO) -> Any:
+    """Decode an audio file (or in-memory stream) in-process with PyAV into 16kHz mono float32 samples.
 
-    import subprocess
-    import tempfile
+    Returns None when PyAV/numpy aren't installed or the file can't be decoded,
+    so callers can fall back to ffmpeg.
+    """
 
-    if not chunk_paths:
-        return False, '没有可用音频分片'
+    try:
+        import av  # type: ignore
+        import numpy as np  # type: ignore
+    except Exception:
+        return None
 
-    # ffmpeg concat list file uses POSIX-like paths more reliably.
     try:
-        with tempfile.NamedTemporaryFile('w', delete=False, suffix='.txt', encoding='utf-8') as f:
-            list_path = Path(f.name)
-            for p in chunk_paths:
-                f.write(f"file '{p.resolve().as_posix()}'\n")
+        resampler = av.AudioResampler(format='s16', layout='mono', rate=_WHISPER_SAMPLE_RATE)
+        parts = []
+        with av.open(str(path) if isinstance(path, Path) else path) as container:
+            if not container.streams.audio:
+                return None
+            for frame in container.decode(container.streams.audio[0]):
+                parts.extend(f.to_ndarray().reshape(-1) for f in resampler.resample(frame))
+            parts.extend(f.to_ndarray().reshape(-1) for f in resampler.resample(None))
+        if not parts:
+            return None
+        return np.concatenate(parts).astype(np.float32) / 32768.0
     except Exception as exc:
-        return False, f'生成合并清单失败：{exc}'
+        app.logger.info('PyAV decode failed for %s, falling back to ffmpeg: %s', getattr(path, 'name', 'stream'), exc)
+        return None
+
+
+_EBML_MAGIC = b'\x1a\x45\xdf\xa3'
+
+
+def _is_single_webm_stream(chunk_paths: list[Path]) -> bool:
+    """True when the chunks are timeslices of one MediaRecorder WebM stream.
+
+    Only the first slice carries the EBML header; the rest are bare clusters, so the
+    byte concatenation is the original file (a stream copy, nothing re-encoded).
+    """
+
+    if not chunk_paths or any(p.suffix.lower() != '.webm' for p in chunk_paths):
+        return False
+    try:
+        for i, p in enumerate(chunk_paths):
+            with open(p, 'rb') as f:
+                if (f.read(4) == _EBML_MAGIC) != (i == 0):
+                    return False
+    except OSError:
+        return False
+    return True
+
+
+def _decode_chunks_to_pcm(chunk_paths: list[Path]) -> tuple[Any, str]:
+    """Decode session chunks to one sample array: PyAV in-process, else a single ffmpeg pass."""
+
+    if _is_single_webm_stream(chunk_paths):
+        data = b''.join(p.read_bytes() for p in chunk_paths)
+        samples = _decode_audio_av(io.BytesIO(data))
+        if samples is None:
+            samples, _ = _ffmpeg_pipe_to_pcm(['-i', 'pipe:0'], data)
+        if samples is not None:
+            return samples, ''
+
+    decoded = [_decode_audio_av(p) for p in chunk_paths] if chunk_paths else []
+    if decoded and all(d is not None for d in decoded):
+        import numpy as np  # type: ignore
+
+        return np.concatenate(decoded), ''
+    return _ffmpeg_concat_to_pcm(chunk_paths)
+
+
+def _ffmpeg_concat_to_pcm(chunk_paths: list[Path]) -> tuple[Any, str]:
+    """Concat chunk files and decode to 16kHz mono float32 samples in one ffmpeg pass.
+
+    The concat list is fed on stdin and raw s16le PCM is read from stdout, so neither
+    a list file nor an intermediate WAV touches the disk. Returns (samples, error).
+    """
+
+    if not chunk_paths:
+        return None, '没有可用音频分片'
+
+    # ffmpeg concat list uses POSIX-like paths more reliably.
+    concat_list = ''.join(f"file '{p.resolve().as_posix()}'\n" for p in chunk_paths)
+    return _ffmpeg_pipe_to_pcm(
+        ['-f', 'concat', '-safe', '0', '-protocol_whitelist', 'file,pipe', '-i', 'pipe:0'],
+        concat_list.encode('utf-8'),
+    )
+
+
+def _ffmpeg_pipe_to_pcm(input_args: list[str], stdin_data: bytes) -> tuple[Any, str]:
+    """Run ffmpeg with `input_args` reading stdin, returning 16kHz mono float32 samples from stdout."""
+
+    try:
+        import numpy as np  # type: ignore
+    except Exception:
+        return None, '缺少 numpy（Whisper 依赖）'
 
     try:
         cmd = [
             'ffmpeg',
-            '-y',
             '-hide_banner',
             '-loglevel',
             'error',
-            '-f',
-            'concat',
-            '-safe',
-            '0',
-            '-i',
-            str(list_path),
+            *input_args,
             '-vn',
             '-ac',
             '1',
             '-ar',
-            '16000',
-            str(wav_out),
+            str(_WHISPER_SAMPLE_RATE),
+            '-f',
+            's16le',
+            '-acodec',
+            'pcm_s16le',
+            'pipe:1',
         ]
-        proc = subprocess.run(cmd, capture_output=True, text=True)
+        proc = subprocess.run(cmd, input=stdin_data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         if proc.returncode != 0:
-            stderr = (proc.stderr or '').strip()[:600]
-            return False, f'ffmpeg 合并失败：{stderr or "unknown"}'
-        if not wav_out.exists() or wav_out.stat().st_size == 0:
-            return False, 'ffmpeg 合并输出为空'
-        return True, ''
+            stderr = proc.stderr.decode('utf-8', 'replace').strip()[:600]
+            return None, f'ffmpeg 合并失败：{stderr or "unknown"}'
+        if not proc.stdout:
+            return None, 'ffmpeg 合并输出为空'
+        samples = np.frombuffer(proc.stdout, dtype=np.int16).astype(np.float32) / 32768.0
+        return samples, ''
     except FileNotFoundError:
-        return False, '未找到 ffmpeg：请安装 ffmpeg 并加入 PATH（实时录音分片合并需要）'
+        return None, '未找到 ffmpeg：请安装 ffmpeg 并加入 PATH（实时录音分片合并需要）'
     except Exception as exc:
-        return False, f'ffmpeg 合并异常：{exc}'
-    finally:
-        try:
-            list_path.unlink(missing_ok=True)
-        except Exception:
-            pass
+        return None, f'ffmpeg 合并异常：{exc}'
 
 
 def _ffmpeg_to_wav(input_path: Path, wav_out: Path) -> tuple[bool, str]:
     """Decode a single audio file into 16kHz mono WAV via ffmpeg."""
 
-    import subprocess
-
     try:
         _ensure_ffmpeg_on_path()
     except Exception:
@@ -1327,8 +2344,6 @@ def _ffmpeg_to_wav(input_path: Path, wav_out: Path) -> tuple[bool, str]:
 def _ffmpeg_to_mp3(input_path: Path, mp3_out: Path) -> tuple[bool, str]:
     """Encode a single audio file into MP3 (16kHz mono) via ffmpeg."""
 
-    import subprocess
-
     try:
         _ensure_ffmpeg_on_path()
     except Exception:
@@ -1367,48 +2382,218 @@ def _ffmpeg_to_mp3(input_path: Path, mp3_out: Path) -> tuple[bool, str]:
         return False, f'ffmpeg 转 mp3 异常：{exc}'
 
 
-def run_gemini_note_summary(transcript: str, focus_tag: str | None = None):
-    api_key = app.config.get('GEMINI_API_KEY', '')
-    if not api_key:
-        raise RuntimeError('未配置 GEMINI_API_KEY，无法进行智能摘要')
+@lru_cache(maxsize=4)
+def _genai_client(api_key: str) -> Any:
+    """One google-genai client per API key, reused so HTTP keep-alive/TLS sessions carry over."""
 
     try:
         from google import genai  # type: ignore
     except Exception as exc:
         raise RuntimeError('google-genai 未安装，请先安装 google-genai') from exc
+    return genai.Client(api_key=api_key)
+
+
+# Exact-match cache for Gemini text responses, keyed by (model, prompt). Re-runs
+# on the same OCR text / transcript (retries, duplicate uploads) skip the network call.
+_GEMINI_CACHE: dict[str, tuple[str, float]] = {}
+_GEMINI_CACHE_LOCK = threading.Lock()
+_GEMINI_CACHE_TTL = float(os.getenv('GEMINI_CACHE_TTL', 7 * 24 * 3600))
+_GEMINI_CACHE_MAX = 512
+
+
+def _gemini_cache_key(model: str, prompt: str) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    h.update(model.encode('utf-8'))
+    h.update(b'\0')
+    h.update(prompt.encode('utf-8'))
+    return h.hexdigest()
+
+
+def _gemini_stream_until_json(client: Any, model: str, prompt: str, config: dict | None = None) -> str:
+    """Stream the response, stopping once the first top-level JSON object has closed.
+
+    Whatever the model would emit after that (trailing whitespace, a closing fence)
+    is never parsed anyway, so there's no reason to wait for it.
+    """
+
+    parts: list[str] = []
+    start = -1
+    for chunk in client.models.generate_content_stream(model=model, contents=prompt, config=config):
+        piece = getattr(chunk, 'text', None) or ''
+        if not piece:
+            continue
+        parts.append(piece)
+        if '}' not in piece:
+            continue
+        buf = ''.join(parts)
+        if start < 0:
+            start = buf.find('{')
+        if start >= 0 and _find_balanced_end(buf, start, '{', '}') >= 0:
+            break
+    return ''.join(parts)
+
+
+def _gemini_generate_text(
+    client: Any,
+    model: str,
+    prompt: str,
+    schema: dict | None = None,
+    validate: Callable[[dict], bool] | None = None,
+) -> str:
+    """Streamed JSON-object response text (see above), with an in-process response cache.
+
+    With `schema`, decoding is constrained to JSON matching it (response_schema), so
+    the model can't wrap the object in a fence or drift from the field names. The
+    prompt already pins the schema, so it isn't part of the cache key.
+    Only replies that parse to a JSON object (and pass `validate`, when given) are
+    cached, so retrying after a truncated or invalid reply calls the API again.
+    Set GEMINI_CACHE_DISABLE=1 to always call the API.
+    """
+
+    use_cache = os.getenv('GEMINI_CACHE_DISABLE', '').strip() != '1'
+    key = _gemini_cache_key(model, prompt) if use_cache else ''
+    if use_cache:
+        with _GEMINI_CACHE_LOCK:
+            hit = _GEMINI_CACHE.get(key)
+        if hit and hit[1] > time.monotonic():
+            return hit[0]
+
+    config = {'response_mime_type': 'application/json', 'response_schema': schema} if schema else None
+    text = _gemini_stream_until_json(client, model, prompt, config)
+
+    if use_cache and _gemini_reply_ok(text, validate):
+        now = time.monotonic()
+        with _GEMINI_CACHE_LOCK:
+            if len(_GEMINI_CACHE) >= _GEMINI_CACHE_MAX:
+                for k in [k for k, (_, exp) in _GEMINI_CACHE.items() if exp <= now]:
+                    _GEMINI_CACHE.pop(k, None)
+                while len(_GEMINI_CACHE) >= _GEMINI_CACHE_MAX:
+                    _GEMINI_CACHE.pop(next(iter(_GEMINI_CACHE)), None)
+            _GEMINI_CACHE[key] = (text, now + _GEMINI_CACHE_TTL)
+    return text
+
+
+def _gemini_reply_ok(text: str, validate: Callable[[dict], bool] | None) -> bool:
+    parsed = _parse_first_json_object(text) if text.strip() else None
+    if not isinstance(parsed, dict):
+        return False
+    try:
+        return validate is None or bool(validate(parsed))
+    except Exception:
+        return False
+
+
+# Static instruction/schema headers, built once. The per-request input goes last so
+# repeated calls share an identical prefix (Gemini reuses cached prefix tokens).
+_ALLOWED_SUBJECTS_TEXT = '、'.join(SUBJECT_CHOICES)
+
+
+# response_schema counterparts of the schemas spelled out in the prompts.
+def _schema_object(properties: dict) -> dict:
+    return {'type': 'OBJECT', 'properties': properties, 'required': list(properties)}
 
-    client = genai.Client(api_key=api_key)
+
+_SCHEMA_STR = {'type': 'STRING'}
+_SCHEMA_STR_LIST = {'type': 'ARRAY', 'items': _SCHEMA_STR}
+
+_NOTE_SUMMARY_SCHEMA = _schema_object(
+    {
+        'title': _SCHEMA_STR,
+        'subject': {'type': 'STRING', 'enum': list(SUBJECT_CHOICES)},
+        'summary_points': _SCHEMA_STR_LIST,
+        'tasks': {
+            'type': 'ARRAY',
+            'items': _schema_object({'id': _SCHEMA_STR, 'text': _SCHEMA_STR, 'done': {'type': 'BOOLEAN'}}),
+        },
+        'key_terms': _SCHEMA_STR_LIST,
+    }
+)
+
+_PARENT_REPORT_SCHEMA = _schema_object(
+    {
+        'week': _SCHEMA_STR,
+        'overallTone': _SCHEMA_STR,
+        'aiSummary': _SCHEMA_STR,
+        'encouragement': _SCHEMA_STR,
+        'weakTopics': {
+            'type': 'ARRAY',
+            'items': _schema_object({'subject': _SCHEMA_STR, 'issue': _SCHEMA_STR, 'suggestion': _SCHEMA_STR}),
+        },
+        'highlightCards': {
+            'type': 'ARRAY',
+            'items': _schema_object({'title': _SCHEMA_STR, 'detail': _SCHEMA_STR}),
+        },
+    }
+)
+
+_ANALYSIS_SCHEMA = _schema_object(
+    {
+        'title': _SCHEMA_STR,
+        'subject': {'type': 'STRING', 'enum': list(SUBJECT_CHOICES)},
+        'verdict': _SCHEMA_STR,
+        'mistakes': {
+            'type': 'ARRAY',
+            'items': _schema_object(
+                {
+                    'concept': _SCHEMA_STR,
+                    'reason': _SCHEMA_STR,
+                    'correct_approach': _SCHEMA_STR,
+                    'practice': _SCHEMA_STR,
+                    'evidence': _SCHEMA_STR,
+                }
+            ),
+        },
+        'key_points': _SCHEMA_STR_LIST,
+        'review_plan': _SCHEMA_STR_LIST,
+        'confidence': {'type': 'NUMBER'},
+    }
+)
+
+_QUIZ_SCHEMA = _schema_object(
+    {
+        'question': _SCHEMA_STR,
+        'options': _SCHEMA_STR_LIST,
+        'answer_index': {'type': 'INTEGER'},
+        'explanation': _SCHEMA_STR,
+        'topic': _SCHEMA_STR,
+    }
+)
+
+_NOTE_SUMMARY_PROMPT_PREFIX = (
+    '只输出 JSON，禁止 markdown/解释文字/多余字符。\n'
+    '你是课堂笔记助手。根据课堂转写文本，提炼结构化笔记与任务追踪。\n'
+    'JSON schema（必须严格匹配）：\n'
+    '{\n'
+    '  "title": string,\n'
+    '  "subject": string,\n'
+    '  "summary_points": string[],\n'
+    '  "tasks": [{"id": string, "text": string, "done": boolean}],\n'
+    '  "key_terms": string[]\n'
+    '}\n'
+    '要求：\n'
+    f'- subject 必须且只能从如下列表中选择其一：{_ALLOWED_SUBJECTS_TEXT}。\n'
+    '- title 简短（<= 18 字）。\n'
+    '- summary_points 3-6 条，每条 <= 28 字；尽量包含关键公式/例题/典型句式等“可复用示例”。\n'
+    '- tasks 2-6 条，都是可执行动作，text <= 30 字；done 默认 false；id 用短字符串（如 t1、t2）。\n'
+    '- key_terms 3-8 个关键词，<= 8 字/个。\n'
+    '- 如果转写内容信息不足：summary_points/tasks/key_terms 允许为空数组，但不要输出占位词。\n\n'
+)
+
+
+def run_gemini_note_summary(transcript: str, focus_tag: str | None = None):
+    api_key = app.config.get('GEMINI_API_KEY', '')
+    if not api_key:
+        raise RuntimeError('未配置 GEMINI_API_KEY，无法进行智能摘要')
+
+    client = _genai_client(api_key)
     model = app.config.get('GEMINI_MODEL', 'gemini-2.5-flash')
 
-    allowed_subjects = '、'.join(SUBJECT_CHOICES)
     ft = (focus_tag or '').strip()
     focus_line = f'focus_tag：{ft}\n' if ft else ''
 
-    prompt = (
-        '只输出 JSON，禁止 markdown/解释文字/多余字符。\n'
-        '你是课堂笔记助手。根据课堂转写文本，提炼结构化笔记与任务追踪。\n'
-        'JSON schema（必须严格匹配）：\n'
-        '{\n'
-        '  "title": string,\n'
-        '  "subject": string,\n'
-        '  "summary_points": string[],\n'
-        '  "tasks": [{"id": string, "text": string, "done": boolean}],\n'
-        '  "key_terms": string[]\n'
-        '}\n'
-        '要求：\n'
-        f'- subject 必须且只能从如下列表中选择其一：{allowed_subjects}。\n'
-        '- title 简短（<= 18 字）。\n'
-        '- summary_points 3-6 条，每条 <= 28 字；尽量包含关键公式/例题/典型句式等“可复用示例”。\n'
-        '- tasks 2-6 条，都是可执行动作，text <= 30 字；done 默认 false；id 用短字符串（如 t1、t2）。\n'
-        '- key_terms 3-8 个关键词，<= 8 字/个。\n'
-        '- 如果转写内容信息不足：summary_points/tasks/key_terms 允许为空数组，但不要输出占位词。\n\n'
-        f'{focus_line}'
-        f'TRANSCRIPT:\n{transcript}'
-    )
+    prompt = f'{_NOTE_SUMMARY_PROMPT_PREFIX}{focus_line}TRANSCRIPT:\n{transcript}'
 
-    response = client.models.generate_content(model=model, contents=prompt)
-    text = getattr(response, 'text', None) or str(response)
-    return text
+    return _gemini_generate_text(client, model, prompt, _NOTE_SUMMARY_SCHEMA)
 
 
 def _validate_note_summary_dict(parsed: dict) -> tuple[dict | None, str | None]:
@@ -1459,37 +2644,30 @@ def _summarize_and_persist_note(entry: 'NoteAssistantEntry') -> tuple[dict | Non
     except Exception as exc:
         return None, f'智能摘要失败：{exc}'
 
-    extracted = _extract_first_json_object(raw)
-    if not extracted:
-        return None, '摘要返回格式非 JSON'
-
-    parsed = _loads_lenient_object(extracted)
+    parsed = _parse_first_json_object(raw)
     if not parsed:
-        return None, '摘要 JSON 解析失败'
+        return None, ('摘要 JSON 解析失败' if '{' in (raw or '') else '摘要返回格式非 JSON')
 
     payload, err = _validate_note_summary_dict(parsed)
     if err or not payload:
         return None, err or '摘要格式错误'
 
+    summary_obj = {
+        'title': payload.get('title'),
+        'subject': payload.get('subject'),
+        'summary_points': payload.get('summary_points', []),
+        'key_terms': payload.get('key_terms', []),
+    }
     try:
-        import json
-
         entry.title = payload.get('title') or entry.title
         entry.subject = normalize_subject(payload.get('subject'))
-        entry.summary_json = json.dumps(
-            {
-                'title': payload.get('title'),
-                'subject': payload.get('subject'),
-                'summary_points': payload.get('summary_points', []),
-                'key_terms': payload.get('key_terms', []),
-            },
-            ensure_ascii=False,
-        )
-        entry.tasks_json = json.dumps({'tasks': payload.get('tasks', [])}, ensure_ascii=False)
+        entry.summary_json = _json_dumps(summary_obj)
+        entry.tasks_json = _json_dumps({'tasks': payload.get('tasks', [])})
         entry.status = 'done'
         save_and_commit(entry)
 
-        upsert_knowledge_from_note(entry)
+        # The commit expired `entry`; hand over the dict instead of re-parsing the column.
+        upsert_knowledge_from_note(entry, summary_obj)
     except Exception as exc:
         app.logger.warning('Failed to persist note summary: %s', exc)
 
@@ -1497,18 +2675,11 @@ def _summarize_and_persist_note(entry: 'NoteAssistantEntry') -> tuple[dict | Non
 
 
 def run_gemini_parent_report(dashboard_payload: dict):
-    import json
-
     api_key = app.config.get('GEMINI_API_KEY', '')
     if not api_key:
         raise RuntimeError('未配置 GEMINI_API_KEY，无法生成家长周报')
 
-    try:
-        from google import genai  # type: ignore
-    except Exception as exc:
-        raise RuntimeError('google-genai 未安装，请先安装 google-genai') from exc
-
-    client = genai.Client(api_key=api_key)
+    client = _genai_client(api_key)
     model = app.config.get('GEMINI_MODEL', 'gemini-2.5-flash')
 
     prompt = (
@@ -1530,12 +2701,13 @@ def run_gemini_parent_report(dashboard_payload: dict):
         '- weakTopics 2-4 条，建议必须可执行。\n'
         '- highlightCards 2-4 条，标题 <= 10 字，detail <= 24 字。\n'
         '输入数据（JSON）：\n'
-        f'{json.dumps(dashboard_payload, ensure_ascii=False)}'
+        f'{_json_dumps(dashboard_payload)}'
     )
 
-    response = client.models.generate_content(model=model, contents=prompt)
-    text = getattr(response, 'text', None) or str(response)
-    return text
+    # The report route falls back to the template report without an overallTone.
+    return _gemini_generate_text(
+        client, model, prompt, _PARENT_REPORT_SCHEMA, validate=lambda p: bool(str(p.get('overallTone') or '').strip())
+    )
 
 
 def _build_parent_report_fallback(dashboard_payload: dict) -> dict:
@@ -1632,6 +2804,11 @@ def _build_parent_report_fallback(dashboard_payload: dict) -> dict:
 
 _NOTE_SUMMARY_RUNNING: set[int] = set()
 _NOTE_SUMMARY_LOCK = threading.Lock()
+# Summaries are Gemini-bound; a small fixed pool caps concurrent sessions/connections.
+_NOTE_SUMMARY_EXECUTOR = ThreadPoolExecutor(
+    max_workers=max(1, int(os.getenv('NOTE_SUMMARY_WORKERS', '4'))),
+    thread_name_prefix='note-summary',
+)
 
 
 def _run_note_summary_job(entry_id: int) -> None:
@@ -1674,8 +2851,7 @@ def start_note_summary_job(entry_id: int) -> bool:
                 return False
             _NOTE_SUMMARY_RUNNING.add(entry_id)
 
-        t = threading.Thread(target=_run_note_summary_job, args=(entry_id,), daemon=True)
-        t.start()
+        _NOTE_SUMMARY_EXECUTOR.submit(_run_note_summary_job, entry_id)
         return True
     except Exception:
         try:
@@ -1686,32 +2862,61 @@ def start_note_summary_job(entry_id: int) -> bool:
         return False
 
 
-def run_ocr(image_path: str):
-    ocr = get_ocr_instance()
-    result = ocr.predict(input=image_path)
-
-    # PaddleX 风格结果对象最稳的方式：落盘 JSON 再读取
-    with tempfile.TemporaryDirectory() as tmp:
-        tmp_dir = Path(tmp)
-        ocr_json_payload = None
-        for res in result:
-            try:
-                res.save_to_json(str(tmp_dir))
-            except Exception:
-                # 兼容不同版本：可能支持 to_json()/json 属性
-                if hasattr(res, 'json'):
-                    ocr_json_payload = getattr(res, 'json')
-                elif hasattr(res, 'to_json'):
-                    ocr_json_payload = res.to_json()
-            break
-
-        if ocr_json_payload is None:
-            json_files = list(tmp_dir.glob('*.json'))
-            if json_files:
-                import json
+def _ocr_result_payload(res: Any) -> Any:
+    """JSON payload of one PaddleX-style OCR result, in memory when the object allows it."""
 
-                with json_files[0].open('r', encoding='utf-8') as f:
-                    ocr_json_payload = json.load(f)
+    try:
+        payload = getattr(res, 'json', None)
+        if payload is None and hasattr(res, 'to_json'):
+            payload = res.to_json()
+        if isinstance(payload, (str, bytes)):
+            payload = _json_loads(payload)
+    except Exception:
+        payload = None
+    if payload is not None:
+        # `.json` wraps the fields save_to_json() writes in {"res": {...}}.
+        if isinstance(payload, dict) and len(payload) == 1 and isinstance(payload.get('res'), dict):
+            payload = payload['res']
+        return payload
+
+    # Older versions only offer save_to_json(); give it a fixed file name so
+    # there's nothing to glob for.
+    with tempfile.TemporaryDirectory() as tmp:
+        out_path = Path(tmp) / 'ocr.json'
+        try:
+            res.save_to_json(str(out_path))
+        except Exception:
+            return None
+        if out_path.exists():
+            return _json_loads(out_path.read_bytes())
+    return None
+
+
+def _release_ocr_memory() -> None:
+    gc.collect()
+    try:
+        import paddle  # type: ignore
+
+        if paddle.device.is_compiled_with_cuda():
+            paddle.device.cuda.empty_cache()
+    except Exception:
+        pass
+
+
+def run_ocr(image: Any):
+    """OCR an image given as a file path or a decoded BGR ndarray."""
+
+    global _OCR_RUN_COUNT
+    ocr = get_ocr_instance()
+    with _OCR_RUN_LOCK:
+        result = ocr.predict(input=image)
+        ocr_json_payload = None
+        for res in result:
+            ocr_json_payload = _ocr_result_payload(res)
+            break
+        _OCR_RUN_COUNT += 1
+        if _OCR_GC_EVERY > 0 and _OCR_RUN_COUNT % _OCR_GC_EVERY == 0:
+            _release_ocr_memory()
 
     if not isinstance(ocr_json_payload, dict):
         ocr_json_payload = {'raw': ocr_json_payload}
@@ -1725,53 +2930,202 @@ def run_ocr(image_path: str):
     return ocr_text, ocr_json_payload
 
 
+_ANALYSIS_PROMPT_PREFIX = (
+    '只输出 JSON，禁止 markdown/解释文字/多余字符。\n'
+    '你是中学学习助教。下面是 OCR 提取的错题文本，请输出严格 JSON（不要 markdown），并尽量可解释、可核验。\n'
+    'JSON schema（必须严格匹配）：\n'
+    '{\n'
+    '  "title": string,\n'
+    '  "subject": string,\n'
+    '  "verdict": string,\n'
+    '  "mistakes": [{\n'
+    '    "concept": string,\n'
+    '    "reason": string,\n'
+    '    "correct_approach": string,\n'
+    '    "practice": string,\n'
+    '    "evidence": string\n'
+    '  }],\n'
+    '  "key_points": string[],\n'
+    '  "review_plan": string[],\n'
+    '  "confidence": number\n'
+    '}\n'
+    '要求：\n'
+    f'- subject 必须且只能从如下列表中选择其一：{_ALLOWED_SUBJECTS_TEXT}。\n'
+    '- title/subject 简短；verdict 一句话总结最主要错因；confidence 0~1。\n'
+    '- mistakes 只在确实能提炼出错因时给出（最多 3 条）；如果无法判断，请输出空数组 []，不要输出占位词。\n'
+    '- 每条 mistakes 中：concept <= 10 字；reason <= 30 字；correct_approach <= 40 字；practice <= 40 字；evidence <= 30 字。\n'
+    '- key_points 建议 3-6 条，每条 <= 25 字。\n'
+    '- review_plan 建议 3-6 条，每条 <= 28 字。\n'
+    '- evidence 用 OCR 文本中的短片段引用（若无把握可留空字符串）。\n\n'
+)
+
+
 def run_gemini_analysis(ocr_text: str):
     api_key = app.config.get('GEMINI_API_KEY', '')
     if not api_key:
         raise RuntimeError('未配置 GEMINI_API_KEY，无法进行 AI 深度分析')
 
-    try:
-        from google import genai  # type: ignore
-    except Exception as exc:
-        raise RuntimeError('google-genai 未安装，请先安装 google-genai') from exc
+    client = _genai_client(api_key)
+    model = app.config.get('GEMINI_MODEL', 'gemini-2.5-flash')
+
+    prompt = f'{_ANALYSIS_PROMPT_PREFIX}OCR_TEXT:\n{ocr_text}'
+
+    return _gemini_generate_text(client, model, prompt, _ANALYSIS_SCHEMA)
+
+
+_ANALYSIS_BATCH_SCHEMA = _schema_object({'items': {'type': 'ARRAY', 'items': _ANALYSIS_SCHEMA}})
+
+
+def run_gemini_analysis_batch(ocr_texts: list[str]) -> list[str]:
+    """Analyse several OCR texts in one request; returns one JSON object string per text, in order."""
+
+    api_key = app.config.get('GEMINI_API_KEY', '')
+    if not api_key:
+        raise RuntimeError('未配置 GEMINI_API_KEY，无法进行 AI 深度分析')
 
-    client = genai.Client(api_key=api_key)
+    client = _genai_client(api_key)
     model = app.config.get('GEMINI_MODEL', 'gemini-2.5-flash')
 
-    allowed_subjects = '、'.join(SUBJECT_CHOICES)
+    items = ''.join(f'ITEM {i}:\n{t}\n\n' for i, t in enumerate(ocr_texts, 1))
     prompt = (
-        '只输出 JSON，禁止 markdown/解释文字/多余字符。\n'
-        '你是中学学习助教。下面是 OCR 提取的错题文本，请输出严格 JSON（不要 markdown），并尽量可解释、可核验。\n'
-        'JSON schema（必须严格匹配）：\n'
-        '{\n'
-        '  "title": string,\n'
-        '  "subject": string,\n'
-        '  "verdict": string,\n'
-        '  "mistakes": [{\n'
-        '    "concept": string,\n'
-        '    "reason": string,\n'
-        '    "correct_approach": string,\n'
-        '    "practice": string,\n'
-        '    "evidence": string\n'
-        '  }],\n'
-        '  "key_points": string[],\n'
-        '  "review_plan": string[],\n'
-        '  "confidence": number\n'
-        '}\n'
-        '要求：\n'
-        f'- subject 必须且只能从如下列表中选择其一：{allowed_subjects}。\n'
-        '- title/subject 简短；verdict 一句话总结最主要错因；confidence 0~1。\n'
-        '- mistakes 只在确实能提炼出错因时给出（最多 3 条）；如果无法判断，请输出空数组 []，不要输出占位词。\n'
-        '- 每条 mistakes 中：concept <= 10 字；reason <= 30 字；correct_approach <= 40 字；practice <= 40 字；evidence <= 30 字。\n'
-        '- key_points 建议 3-6 条，每条 <= 25 字。\n'
-        '- review_plan 建议 3-6 条，每条 <= 28 字。\n'
-        '- evidence 用 OCR 文本中的短片段引用（若无把握可留空字符串）。\n\n'
-        f'OCR_TEXT:\n{ocr_text}'
+        f'{_ANALYSIS_PROMPT_PREFIX}'
+        f'下面有 {len(ocr_texts)} 道错题（ITEM 1..{len(ocr_texts)}），请逐题独立按上述 schema 分析。\n'
+        f'输出 {{"items": [...]}}，items 与输入一一对应、顺序一致，长度必须为 {len(ocr_texts)}。\n\n'
+        f'{items}'
     )
 
-    response = client.models.generate_content(model=model, contents=prompt)
-    text = getattr(response, 'text', None) or str(response)
-    return text
+    def items_match(parsed: dict) -> bool:
+        results = parsed.get('items')
+        return isinstance(results, list) and len(results) == len(ocr_texts) and all(isinstance(r, dict) for r in results)
+
+    raw = _gemini_generate_text(client, model, prompt, _ANALYSIS_BATCH_SCHEMA, validate=items_match)
+    parsed = _parse_first_json_object(raw)
+    if not isinstance(parsed, dict) or not items_match(parsed):
+        raise RuntimeError('批量分析返回格式不匹配')
+    results = parsed['items']
+    return [_json_dumps(r) for r in results]
+
+
+# Analysis requests from concurrent upload workers are coalesced: the batcher takes
+# the first queued text and, while other error-book jobs are still running (and so
+# may ask too), waits up to GEMINI_BATCH_WAIT_MS for more (at most GEMINI_BATCH_MAX).
+# A lone upload is sent at once. Each batch is sent from a small pool, so collecting
+# the next batch never waits on Gemini. GEMINI_BATCH_MAX=1 disables it.
+_ANALYSIS_BATCH_MAX = max(1, int(os.getenv('GEMINI_BATCH_MAX', '8')))
+_ANALYSIS_BATCH_WAIT = max(0, int(os.getenv('GEMINI_BATCH_WAIT_MS', '300'))) / 1000
+_ANALYSIS_QUEUE: 'queue.Queue[tuple[str, Future]]' = queue.Queue()
+_ANALYSIS_BATCHER: threading.Thread | None = None
+_ANALYSIS_BATCHER_LOCK = threading.Lock()
+# Every error-book job waits on at most one analysis, so this many requests in flight is enough.
+_ANALYSIS_EXECUTOR = ThreadPoolExecutor(
+    max_workers=max(1, int(os.getenv('ERROR_BOOK_WORKERS', '2'))),
+    thread_name_prefix='gemini-analysis',
+)
+_ANALYSIS_EXPECTED_LOCK = threading.Lock()
+_ANALYSIS_EXPECTED = 0  # running error-book jobs that have not queued their text yet
+_ANALYSIS_PRODUCER = threading.local()
+
+
+def _analysis_expect(delta: int) -> None:
+    global _ANALYSIS_EXPECTED
+    with _ANALYSIS_EXPECTED_LOCK:
+        _ANALYSIS_EXPECTED += delta
+
+
+def analysis_producer_started() -> None:
+    """Mark the current thread as a job that may soon call analyze_error_text."""
+
+    _ANALYSIS_PRODUCER.pending = True
+    _analysis_expect(1)
+
+
+def analysis_producer_finished() -> None:
+    if getattr(_ANALYSIS_PRODUCER, 'pending', False):
+        _ANALYSIS_PRODUCER.pending = False
+        _analysis_expect(-1)
+
+
+def _run_analysis_batch(batch: list[tuple[str, Future]]) -> None:
+    try:
+        if len(batch) > 1:
+            try:
+                results = run_gemini_analysis_batch([ocr_text for ocr_text, _ in batch])
+            except Exception as exc:
+                app.logger.info('Batched analysis failed, retrying items one by one: %s', exc)
+            else:
+                for (_, fut), result in zip(batch, results):
+                    fut.set_result(result)
+                return
+
+        for ocr_text, fut in batch:
+            try:
+                fut.set_result(run_gemini_analysis(ocr_text))
+            except Exception as exc:
+                fut.set_exception(exc)
+    except Exception as exc:  # pragma: no cover
+        for _, fut in batch:
+            if not fut.done():
+                fut.set_exception(exc)
+
+
+def _analysis_batcher_loop():
+    while True:
+        batch = [_ANALYSIS_QUEUE.get()]
+        deadline = time.monotonic() + _ANALYSIS_BATCH_WAIT
+        while len(batch) < _ANALYSIS_BATCH_MAX:
+            try:
+                batch.append(_ANALYSIS_QUEUE.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or _ANALYSIS_EXPECTED <= 0:
+                break
+            try:
+                batch.append(_ANALYSIS_QUEUE.get(timeout=min(remaining, 0.05)))
+            except queue.Empty:
+                continue
+        try:
+            _ANALYSIS_EXECUTOR.submit(_run_analysis_batch, batch)
+        except Exception as exc:  # pragma: no cover
+            for _, fut in batch:
+                fut.set_exception(exc)
+
+
+def _ensure_analysis_batcher():
+    global _ANALYSIS_BATCHER
+    if _ANALYSIS_BATCHER is not None and _ANALYSIS_BATCHER.is_alive():
+        return
+    with _ANALYSIS_BATCHER_LOCK:
+        if _ANALYSIS_BATCHER is None or not _ANALYSIS_BATCHER.is_alive():
+            _ANALYSIS_BATCHER = threading.Thread(target=_analysis_batcher_loop, name='gemini-analysis-batcher', daemon=True)
+            _ANALYSIS_BATCHER.start()
+
+
+def analyze_error_text(ocr_text: str) -> str:
+    """run_gemini_analysis, sharing a request with other entries analysed at the same time."""
+
+    if _ANALYSIS_BATCH_MAX <= 1:
+        return run_gemini_analysis(ocr_text)
+    _ensure_analysis_batcher()
+    fut: Future = Future()
+    _ANALYSIS_QUEUE.put((ocr_text, fut))
+    analysis_producer_finished()
+    return fut.result()
+
+
+_QUIZ_PROMPT_PREFIX = (
+    '只输出 JSON，禁止 markdown/解释文字/多余字符。\n'
+    '你是中学学习助教。根据 OCR 文本，生成一道“类似但更简单”的单选题（4 个选项），用于检验同一知识点。\n'
+    '请输出严格 JSON（不要 markdown），schema：\n'
+    '{"question": string, "options": [string,string,string,string], "answer_index": number, "explanation": string, "topic": string}.\n'
+    '要求：\n'
+    '- answer_index 必须是 0~3 的整数。\n'
+    '- question 必须非空。\n'
+    '- options 的 4 个字符串都必须非空，且相互区分（不要 4 个一样/近似）。\n'
+    '- 题目要清晰、可独立作答；避免含糊引用“上题/图中”。\n'
+    '- explanation 用 2-5 句解释即可。\n\n'
+)
 
 
 def run_gemini_quiz(ocr_text: str):
@@ -1779,31 +3133,14 @@ def run_gemini_quiz(ocr_text: str):
     if not api_key:
         raise RuntimeError('未配置 GEMINI_API_KEY，无法生成练习题')
 
-    try:
-        from google import genai  # type: ignore
-    except Exception as exc:
-        raise RuntimeError('google-genai 未安装，请先安装 google-genai') from exc
-
-    client = genai.Client(api_key=api_key)
+    client = _genai_client(api_key)
     model = app.config.get('GEMINI_MODEL', 'gemini-2.5-flash')
 
-    prompt = (
-        '只输出 JSON，禁止 markdown/解释文字/多余字符。\n'
-        '你是中学学习助教。根据 OCR 文本，生成一道“类似但更简单”的单选题（4 个选项），用于检验同一知识点。\n'
-        '请输出严格 JSON（不要 markdown），schema：\n'
-        '{"question": string, "options": [string,string,string,string], "answer_index": number, "explanation": string, "topic": string}.\n'
-        '要求：\n'
-        '- answer_index 必须是 0~3 的整数。\n'
-        '- question 必须非空。\n'
-        '- options 的 4 个字符串都必须非空，且相互区分（不要 4 个一样/近似）。\n'
-        '- 题目要清晰、可独立作答；避免含糊引用“上题/图中”。\n'
-        '- explanation 用 2-5 句解释即可。\n\n'
-        f'OCR_TEXT:\n{ocr_text}'
-    )
+    prompt = f'{_QUIZ_PROMPT_PREFIX}OCR_TEXT:\n{ocr_text}'
 
-    response = client.models.generate_content(model=model, contents=prompt)
-    text = getattr(response, 'text', None) or str(response)
-    return text
+    return _gemini_generate_text(
+        client, model, prompt, _QUIZ_SCHEMA, validate=lambda p: _validate_quiz_dict(p)[0] is not None
+    )
 
 
 # --- Routes: Public -----------------------------------------------------
@@ -1833,7 +3170,7 @@ def register():
     user = User(
         email=email,
         username=username,
-        password_hash=generate_password_hash(password),
+        password_hash=hash_password(password),
         role='parent' if role == 'parent' else 'student',
         display_name=display_name,
         verification_code=generate_code(),
@@ -1867,6 +3204,7 @@ def verify_email():
     user.verified = True
     user.verification_code = None
     user.verification_expires = None
+    invalidate_token(user.auth_token)
     user.auth_token = generate_token()
     save_and_commit(user)
 
@@ -1885,6 +3223,9 @@ def login():
     if not user.verified:
         return jsonify({'message': '请先完成邮箱验证'}), 403
 
+    if password_needs_rehash(user.password_hash):
+        user.password_hash = hash_password(password)
+    invalidate_token(user.auth_token)
     user.auth_token = generate_token()
     save_and_commit(user)
 
@@ -1927,124 +3268,261 @@ def reset_password():
     if user.verification_expires and user.verification_expires < datetime.utcnow():
         return jsonify({'message': '验证码已过期'}), 400
 
-    user.password_hash = generate_password_hash(new_password)
+    user.password_hash = hash_password(new_password)
     user.verification_code = None
     user.verification_expires = None
     save_and_commit(user)
+    invalidate_token(user.auth_token)
 
     return jsonify({'message': '密码已重置'})
 
 
 # --- Routes: Error Book -------------------------------------------------
-@app.route('/api/error-book/entries', methods=['GET', 'POST'])
-def error_book_entries():
-    user, error_response, status = require_auth()
-    if error_response:
-        return error_response, status
+# Error-book uploads are processed off the request thread: OCR is CPU/GPU-bound
+# and the Gemini calls take seconds, so a small pool bounds both.
+ERROR_BOOK_PENDING_STATUSES = ('uploaded', 'ocr_done')
+_ERROR_BOOK_EXECUTOR = ThreadPoolExecutor(
+    max_workers=max(1, int(os.getenv('ERROR_BOOK_WORKERS', '2'))),
+    thread_name_prefix='error-book',
+)
+# Stored images never change under a given sha256; browsers may reuse them for an hour.
+ERROR_BOOK_IMAGE_CACHE_CONTROL = 'private, max-age=3600'
 
-    access_user_ids = get_error_book_access_user_ids(user)
 
-    if request.method == 'GET':
-        entries = (
-            ErrorBookEntry.query.filter(ErrorBookEntry.user_id.in_(access_user_ids))
-            .order_by(ErrorBookEntry.created_at.desc())
-            .limit(50)
-            .all()
-        )
-        return jsonify([entry.to_summary() for entry in entries])
+def _load_ocr_input(path: Path) -> Any:
+    """Decode a stored image to a BGR ndarray for PaddleOCR, else return the path.
 
-    if 'image' not in request.files:
-        return jsonify({'message': '请上传图片字段 image'}), 400
-    image = request.files['image']
-    if not image or not image.filename:
-        return jsonify({'message': '图片不能为空'}), 400
+    Stored images have no file extension, so decoding here also spares PaddleOCR
+    from guessing the type from the name.
+    """
 
-    safe_name = secure_filename(image.filename)
-    raw_bytes = image.read()
-    if not raw_bytes:
-        return jsonify({'message': '图片为空或读取失败'}), 400
+    try:
+        import cv2  # type: ignore
+        import numpy as np  # type: ignore
+    except Exception:
+        return str(path)
+    img = cv2.imdecode(np.fromfile(str(path), dtype=np.uint8), cv2.IMREAD_COLOR)
+    return img if img is not None else str(path)
 
-    file_sha = sha256(raw_bytes).hexdigest()
 
-    raw_form_subject = request.form.get('subject')
-    entry = ErrorBookEntry(
-        user_id=user.id,
-        title=request.form.get('title') or None,
-        subject=normalize_subject(raw_form_subject) if raw_form_subject else None,
-        status='uploaded',
-        image_original_name=safe_name or None,
-        image_mimetype=image.mimetype,
-        image_size=len(raw_bytes),
-        image_sha256=file_sha,
-        image_blob=raw_bytes,
-    )
-    save_and_commit(entry)
+def _process_error_book_entry(entry: 'ErrorBookEntry') -> None:
+    """OCR -> Gemini analysis -> quiz -> knowledge for a freshly uploaded entry.
+
+    Every stage only mutates the session and the job commits once at the end, so
+    an upload costs two commits (insert + result) instead of one per stage. Nothing
+    is flushed before the final commit, so no write lock is held across the OCR or
+    Gemini calls; pollers see 'uploaded' until the finished row lands.
+    """
+
+    # Read the deferred column now: loading it later would autoflush the pending
+    # changes and hold SQLite's write lock through the quiz request.
+    has_quiz = bool((entry.quiz_json or '').strip())
 
     # OCR
     try:
-        # PaddleOCR 需要文件路径：写入临时文件
-        ext = Path(safe_name).suffix.lower() or '.png'
-        fd, tmp_path = tempfile.mkstemp(suffix=ext)
-        try:
-            with os.fdopen(fd, 'wb') as tmp_file:
-                tmp_file.write(raw_bytes)
-            ocr_text, ocr_json = run_ocr(tmp_path)
-        finally:
-            try:
-                os.unlink(tmp_path)
-            except Exception:
-                pass
-        import json
-
+        if not entry.image_path:
+            raise RuntimeError('图片未保存')
+        ocr_text, ocr_json = run_ocr(_load_ocr_input(_error_book_upload_dir() / entry.image_path))
         entry.ocr_text = ocr_text
-        entry.ocr_json = json.dumps(ocr_json, ensure_ascii=False)
+        entry.ocr_json_zst = _compress_text(_json_dumps(ocr_json))
         entry.status = 'ocr_done'
-        save_and_commit(entry)
     except Exception as exc:
         entry.status = 'ocr_failed'
         entry.verdict = f'OCR 失败：{exc}'
         save_and_commit(entry)
-        return jsonify(entry.to_detail()), 200
+        return
 
     # AI analysis (optional)
     try:
-        analysis_text = run_gemini_analysis(entry.ocr_text or '')
+        analysis_text = analyze_error_text(entry.ocr_text or '')
         entry.ai_analysis = analysis_text
         entry.status = 'done'
 
         # Try to extract title/subject/verdict from returned JSON
-        import json
+        parsed = _parse_first_json_object(analysis_text)
+        if isinstance(parsed, dict):
+            entry.ai_digest_json = _json_dumps(build_analysis_digest(parsed))
+            entry.title = entry.title or parsed.get('title')
+            if not entry.subject or normalize_subject(entry.subject) == '未分类':
+                entry.subject = normalize_subject(parsed.get('subject'))
+            else:
+                entry.subject = normalize_subject(entry.subject)
+            entry.verdict = entry.verdict or parsed.get('verdict')
+        elif not entry.verdict:
+            # non-JSON response is acceptable; keep as-is
+            entry.verdict = 'AI 已生成解析（非结构化输出）'
+    except Exception as exc:
+        entry.status = 'ai_failed'
+        entry.verdict = entry.verdict or f'AI 分析失败：{exc}'
 
+    # Quiz (best-effort)
+    if not has_quiz:
         try:
-            extracted = _extract_first_json_object(analysis_text) or analysis_text
-            parsed = json.loads(extracted)
-            if isinstance(parsed, dict):
-                entry.title = entry.title or parsed.get('title')
-                if not entry.subject or normalize_subject(entry.subject) == '未分类':
-                    entry.subject = normalize_subject(parsed.get('subject'))
-                else:
-                    entry.subject = normalize_subject(entry.subject)
-                entry.verdict = entry.verdict or parsed.get('verdict')
+            _generate_and_persist_quiz(entry, commit=False)
         except Exception:
-            # non-JSON response is acceptable; keep as-is
-            if not entry.verdict:
-                entry.verdict = 'AI 已生成解析（非结构化输出）'
+            pass
 
-        save_and_commit(entry)
-        upsert_knowledge_from_error(entry)
+    if entry.status == 'done':
+        upsert_knowledge_from_error(entry, commit=False)
+    save_and_commit(entry)
+
+
+def _run_error_book_job(entry_id: int) -> None:
+    analysis_producer_started()
+    try:
+        with app.app_context():
+            entry = db.session.get(ErrorBookEntry, entry_id)
+            if entry:
+                _process_error_book_entry(entry)
     except Exception as exc:
-        entry.status = 'ai_failed'
-        entry.verdict = entry.verdict or f'AI 分析失败：{exc}'
-        save_and_commit(entry)
+        try:
+            with app.app_context():
+                entry = db.session.get(ErrorBookEntry, entry_id)
+                if entry and entry.status in ERROR_BOOK_PENDING_STATUSES:
+                    entry.status = 'ocr_failed' if entry.status == 'uploaded' else 'ai_failed'
+                    entry.verdict = entry.verdict or f'处理失败：{exc}'
+                    save_and_commit(entry)
+        except Exception:
+            pass
+        app.logger.warning('Error book background job failed: %s', exc)
+    finally:
+        analysis_producer_finished()
+        try:
+            db.session.remove()
+        except Exception:
+            pass
+
+
+def _find_analyzed_duplicate(user_id: int, image_sha256: str) -> 'ErrorBookEntry | None':
+    """Latest finished entry of this user for the same image bytes, with its results loaded."""
+
+    return (
+        ErrorBookEntry.query.options(db.undefer_group('detail'))
+        .filter_by(user_id=user_id, image_sha256=image_sha256, status='done')
+        .order_by(ErrorBookEntry.created_at.desc())
+        .first()
+    )
+
+
+def _copy_error_book_results(source: 'ErrorBookEntry', target: 'ErrorBookEntry') -> None:
+    """Give a re-uploaded image the OCR/analysis/quiz of its earlier entry."""
+
+    target.ocr_text = source.ocr_text
+    target.ocr_json_zst = source.ocr_json_zst
+    target.ocr_json = source.ocr_json
+    target.ai_analysis = source.ai_analysis
+    target.ai_digest_json = source.ai_digest_json
+    target.quiz_json = source.quiz_json
+    target.quiz_created_at = source.quiz_created_at
+    target.title = target.title or source.title
+    target.subject = target.subject or source.subject
+    target.verdict = source.verdict
+    target.status = source.status
+
+
+def start_error_book_job(entry_id: int) -> bool:
+    try:
+        _ERROR_BOOK_EXECUTOR.submit(_run_error_book_job, entry_id)
+        return True
+    except Exception:
+        return False
+
+
+def resume_pending_error_book_jobs() -> int:
+    """Re-queue entries left pending by a restart or crash.
+
+    Jobs only live in the in-process executor, so rows still in a pending status
+    at startup would otherwise never be processed. Returns the number queued.
+    """
+
+    try:
+        entry_ids = [
+            row[0]
+            for row in db.session.query(ErrorBookEntry.id)
+            .filter(ErrorBookEntry.status.in_(ERROR_BOOK_PENDING_STATUSES))
+            .order_by(ErrorBookEntry.id)
+        ]
+    except Exception as exc:
+        app.logger.warning('Error-book job resume skipped/failed: %s', exc)
+        return 0
+    return sum(1 for entry_id in entry_ids if start_error_book_job(entry_id))
+
+
+@app.route('/api/error-book/entries', methods=['GET', 'POST'])
+def error_book_entries():
+    user, error_response, status = require_auth()
+    if error_response:
+        return error_response, status
+
+    access_user_ids = get_error_book_access_user_ids(user)
 
-    # Quiz (best-effort, persisted)
-    if not (entry.quiz_json or '').strip():
+    if request.method == 'GET':
+        entries = (
+            ErrorBookEntry.query.options(db.load_only(*ERROR_BOOK_SUMMARY_COLUMNS))
+            .filter(ErrorBookEntry.user_id.in_(access_user_ids))
+            .order_by(ErrorBookEntry.created_at.desc())
+            .limit(50)
+            .all()
+        )
+        return jsonify([entry.to_summary() for entry in entries])
+
+    if 'image' not in request.files:
+        return jsonify({'message': '请上传图片字段 image'}), 400
+    image = request.files['image']
+    if not image or not image.filename:
+        return jsonify({'message': '图片不能为空'}), 400
+
+    safe_name = secure_filename(image.filename)
+    # 流式写入临时文件（同时计算 sha256），随后移动到内容寻址存储
+    ext = Path(safe_name).suffix.lower() or '.png'
+    tmp_path, image_size, file_sha = _stream_upload_to_tempfile(image, suffix=ext)
+    if not image_size:
         try:
-            _generate_and_persist_quiz(entry)
+            os.unlink(tmp_path)
         except Exception:
             pass
+        return jsonify({'message': '图片为空或读取失败'}), 400
 
-    return jsonify(entry.to_detail()), 201
+    try:
+        with _ERROR_BOOK_IMAGE_LOCK:
+            raw_form_subject = request.form.get('subject')
+            entry = ErrorBookEntry(
+                user_id=user.id,
+                title=request.form.get('title') or None,
+                subject=normalize_subject(raw_form_subject) if raw_form_subject else None,
+                status='uploaded',
+                image_original_name=safe_name or None,
+                image_mimetype=image.mimetype,
+                image_size=image_size,
+                image_sha256=file_sha,
+                image_path=_store_error_book_image(tmp_path, file_sha),
+            )
+            # Same image uploaded before: reuse its results instead of re-running OCR + Gemini.
+            duplicate_of = _find_analyzed_duplicate(user.id, file_sha)
+            if duplicate_of is not None:
+                _copy_error_book_results(duplicate_of, entry)
+                db.session.add(entry)
+                db.session.flush()
+                upsert_knowledge_from_error(entry, commit=False)
+            save_and_commit(entry)
+    finally:
+        # Gone already unless this digest was stored before.
+        try:
+            os.unlink(tmp_path)
+        except Exception:
+            pass
+
+    if duplicate_of is not None:
+        return jsonify(entry.to_detail()), 201
+
+    if not start_error_book_job(entry.id):
+        entry.status = 'ocr_failed'
+        entry.verdict = '后台任务提交失败，请重新上传'
+        save_and_commit(entry)
+        return jsonify(entry.to_detail()), 200
+
+    # OCR + analysis + quiz run on the worker pool; clients poll the detail route.
+    return jsonify(entry.to_detail()), 202
 
 
 @app.route('/api/error-book/entries/<int:entry_id>', methods=['GET', 'DELETE'])
@@ -2062,16 +3540,20 @@ def error_book_entry_detail(entry_id: int):
         return jsonify({'message': '未找到错题记录'}), 404
 
     if request.method == 'DELETE':
+        image_sha256, image_path = entry.image_sha256, entry.image_path
         db.session.delete(entry)
+        _delete_knowledge_hits('error_book', entry_id)
         db.session.commit()
+        _remove_unreferenced_error_book_image(image_sha256, image_path)
         return jsonify({'message': '已删除', 'id': entry_id})
 
     # Ensure quiz is available without requiring client to call /quiz.
+    # (Skipped while the upload job is still running; it generates the quiz itself.)
     quiz_error = None
     quiz_payload = None
     if (entry.quiz_json or '').strip():
         quiz_payload = entry.to_detail().get('quiz')
-    else:
+    elif entry.status not in ERROR_BOOK_PENDING_STATUSES:
         quiz_payload, quiz_error = _generate_and_persist_quiz(entry)
 
     detail = entry.to_detail()
@@ -2093,12 +3575,55 @@ def error_book_entry_image(entry_id: int):
     entry = ErrorBookEntry.query.filter(ErrorBookEntry.id == entry_id).filter(
         ErrorBookEntry.user_id.in_(access_user_ids)
     ).first()
-    if not entry or not entry.image_blob:
+    if not entry:
         return jsonify({'message': '未找到图片'}), 404
 
+    # Images are content-addressed, so the stored sha256 is a strong ETag and a
+    # revalidating client gets a bodiless 304 before the file or legacy blob is
+    # even looked at.
+    etag = entry.image_sha256
+    if etag and etag in request.if_none_match:
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+        resp.headers['Cache-Control'] = ERROR_BOOK_IMAGE_CACHE_CONTROL
+        return resp
+
+    # Lazy backfill for rows created before images moved to disk.
+    if not entry.image_path and entry.image_blob:
+        try:
+            digest = entry.image_sha256 or sha256(entry.image_blob).hexdigest()
+            entry.image_sha256 = etag = digest
+            entry.image_path = _store_error_book_image(entry.image_blob, digest)
+            entry.image_blob = None
+            save_and_commit(entry)
+        except Exception as exc:
+            db.session.rollback()
+            app.logger.warning('Failed to move error-book image to disk: %s', exc)
+
     mimetype = entry.image_mimetype or 'image/png'
     download_name = entry.image_original_name or f"error-book-{entry.id}.png"
-    return send_file(io.BytesIO(entry.image_blob), mimetype=mimetype, download_name=download_name)
+
+    full_path = (Path(app.config['ERROR_BOOK_UPLOAD_DIR']) / entry.image_path) if entry.image_path else None
+    if full_path is None or not full_path.is_file():
+        if not entry.image_blob:
+            return jsonify({'message': '未找到图片'}), 404
+        resp = send_file(
+            io.BytesIO(entry.image_blob),
+            mimetype=mimetype,
+            download_name=download_name,
+            conditional=True,
+            etag=etag or False,
+        )
+    else:
+        resp = send_file(
+            full_path,
+            mimetype=mimetype,
+            download_name=download_name,
+            conditional=True,
+            etag=etag or True,
+        )
+    resp.headers['Cache-Control'] = ERROR_BOOK_IMAGE_CACHE_CONTROL
+    return resp
 
 
 @app.route('/api/error-book/entries/<int:entry_id>/quiz', methods=['GET'])
@@ -2139,32 +3664,122 @@ def dashboard_summary():
     return jsonify(payload)
 
 
+# Per-viewer dashboard payloads, keyed by the owner ids the viewer can see. Any
+# committed change to an entry/note/knowledge row of one of those owners drops
+# the entry, so the TTL only bounds staleness from writes outside the ORM.
+_DASHBOARD_CACHE: dict[tuple[int, ...], tuple[dict, float]] = {}
+_DASHBOARD_CACHE_LOCK = threading.Lock()
+_DASHBOARD_CACHE_TTL = float(os.getenv('DASHBOARD_CACHE_TTL', 60))
+_DASHBOARD_CACHE_MAX = 2048
+# Bumped on every invalidation; a payload computed across one isn't stored.
+_DASHBOARD_CACHE_VERSION = 0
+
+
+def invalidate_dashboard_cache(owner_user_ids: Iterable[int]) -> None:
+    global _DASHBOARD_CACHE_VERSION
+    ids = {i for i in owner_user_ids if i}
+    if not ids:
+        return
+    with _DASHBOARD_CACHE_LOCK:
+        _DASHBOARD_CACHE_VERSION += 1
+        for key in [k for k in _DASHBOARD_CACHE if ids.intersection(k)]:
+            del _DASHBOARD_CACHE[key]
+
+
+def _collect_dashboard_owners(session: Any, flush_context: Any) -> None:
+    owners = session.info.setdefault('dashboard_owners', set())
+    mind_map_owners = session.info.setdefault('mind_map_owners', set())
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, (ErrorBookEntry, NoteAssistantEntry, KnowledgeNode, KnowledgeHit)):
+            owners.add(obj.user_id)
+        if isinstance(obj, (ErrorBookEntry, NoteAssistantEntry)):
+            mind_map_owners.add(obj.user_id)
+    # Only node ids matter to the mind-map graph, not last_seen_at bumps.
+    for obj in (*session.new, *session.deleted):
+        if isinstance(obj, KnowledgeNode):
+            mind_map_owners.add(obj.user_id)
+
+
+def _invalidate_dashboard_owners(session: Any) -> None:
+    # Releasing a SAVEPOINT fires after_commit too; wait for the outer commit.
+    if session.in_nested_transaction():
+        return
+    owners = session.info.pop('dashboard_owners', None)
+    if owners:
+        invalidate_dashboard_cache(owners)
+    mind_map_owners = session.info.pop('mind_map_owners', None)
+    if mind_map_owners:
+        invalidate_mind_map_history_cache(mind_map_owners)
+
+
+def _discard_dashboard_owners(session: Any) -> None:
+    # A rolled-back SAVEPOINT keeps the outer transaction's owners (over-invalidating is harmless).
+    if session.in_nested_transaction():
+        return
+    session.info.pop('dashboard_owners', None)
+    session.info.pop('mind_map_owners', None)
+
+
+event.listen(OrmSession, 'after_flush', _collect_dashboard_owners)
+event.listen(OrmSession, 'after_commit', _invalidate_dashboard_owners)
+event.listen(OrmSession, 'after_rollback', _discard_dashboard_owners)
+
+
 def _compute_dashboard_summary_payload(user: 'User') -> dict:
     access_user_ids = get_error_book_access_user_ids(user)
+    if _DASHBOARD_CACHE_TTL <= 0:
+        return _build_dashboard_summary_payload(user, access_user_ids)
+
+    key = tuple(sorted(set(access_user_ids)))
+    with _DASHBOARD_CACHE_LOCK:
+        hit = _DASHBOARD_CACHE.get(key)
+        version = _DASHBOARD_CACHE_VERSION
+    if hit and hit[1] > time.monotonic():
+        return hit[0]
+
+    payload = _build_dashboard_summary_payload(user, access_user_ids)
+
+    now = time.monotonic()
+    with _DASHBOARD_CACHE_LOCK:
+        if version == _DASHBOARD_CACHE_VERSION:
+            if len(_DASHBOARD_CACHE) >= _DASHBOARD_CACHE_MAX:
+                for k in [k for k, (_, exp) in _DASHBOARD_CACHE.items() if exp <= now]:
+                    _DASHBOARD_CACHE.pop(k, None)
+                while len(_DASHBOARD_CACHE) >= _DASHBOARD_CACHE_MAX:
+                    _DASHBOARD_CACHE.pop(next(iter(_DASHBOARD_CACHE)), None)
+            _DASHBOARD_CACHE[key] = (payload, now + _DASHBOARD_CACHE_TTL)
+    return payload
+
 
+def _build_dashboard_summary_payload(user: 'User', access_user_ids: list[int]) -> dict:
     # Recent error-book entries (for lists + analysis mining)
     recent = (
-        ErrorBookEntry.query.filter(ErrorBookEntry.user_id.in_(access_user_ids))
+        ErrorBookEntry.query.options(
+            db.load_only(*ERROR_BOOK_SUMMARY_COLUMNS, ErrorBookEntry.ai_digest_json)
+        )
+        .filter(ErrorBookEntry.user_id.in_(access_user_ids))
         .order_by(ErrorBookEntry.created_at.desc())
         .limit(80)
         .all()
     )
 
-    total_entries = ErrorBookEntry.query.filter(ErrorBookEntry.user_id.in_(access_user_ids)).count()
-    done_count = ErrorBookEntry.query.filter(ErrorBookEntry.user_id.in_(access_user_ids)).filter(
-        ErrorBookEntry.status == 'done'
-    ).count()
-    ocr_failed = ErrorBookEntry.query.filter(ErrorBookEntry.user_id.in_(access_user_ids)).filter(
-        ErrorBookEntry.status == 'ocr_failed'
-    ).count()
-    ai_failed = ErrorBookEntry.query.filter(ErrorBookEntry.user_id.in_(access_user_ids)).filter(
-        ErrorBookEntry.status == 'ai_failed'
-    ).count()
-    with_quiz = (
-        ErrorBookEntry.query.filter(ErrorBookEntry.user_id.in_(access_user_ids))
-        .filter(ErrorBookEntry.quiz_json.isnot(None))
-        .count()
+    # Totals in one grouped pass instead of a COUNT(*) per status.
+    status_rows = (
+        db.session.query(
+            ErrorBookEntry.status,
+            func.count(),
+            func.sum(case((ErrorBookEntry.quiz_json.isnot(None), 1), else_=0)),
+        )
+        .filter(ErrorBookEntry.user_id.in_(access_user_ids))
+        .group_by(ErrorBookEntry.status)
+        .all()
     )
+    status_counts = {row_status: count for row_status, count, _ in status_rows}
+    total_entries = sum(status_counts.values())
+    done_count = status_counts.get('done', 0)
+    ocr_failed = status_counts.get('ocr_failed', 0)
+    ai_failed = status_counts.get('ai_failed', 0)
+    with_quiz = sum(int(quiz_count or 0) for _, _, quiz_count in status_rows)
 
     # Subject distribution (from recent window for speed)
     subject_counts: dict[str, int] = {}
@@ -2173,62 +3788,39 @@ def _compute_dashboard_summary_payload(user: 'User') -> dict:
         subject_counts[subject] = subject_counts.get(subject, 0) + 1
     subjects_sorted = sorted(subject_counts.items(), key=lambda kv: (-kv[1], kv[0]))
 
-    # Daily counts (last 7 days) based on created_at
+    # Daily counts (last 7 days) based on created_at, bucketed by the database
     today = datetime.utcnow().date()
     last_days = [today - timedelta(days=i) for i in range(6, -1, -1)]
     daily_map = {d.isoformat(): 0 for d in last_days}
-    for entry in recent:
-        try:
-            d = (entry.created_at or datetime.utcnow()).date().isoformat()
-        except Exception:
-            continue
-        if d in daily_map:
-            daily_map[d] += 1
+    day_col = func.date(ErrorBookEntry.created_at)
+    day_rows = (
+        db.session.query(day_col, func.count())
+        .filter(ErrorBookEntry.user_id.in_(access_user_ids))
+        .filter(ErrorBookEntry.created_at >= datetime.combine(last_days[0], datetime.min.time()))
+        .group_by(day_col)
+        .all()
+    )
+    for day, count in day_rows:
+        key = day.isoformat() if hasattr(day, 'isoformat') else str(day or '')
+        if key in daily_map:
+            daily_map[key] = count
     daily_counts = [{'date': d, 'count': daily_map[d]} for d in daily_map]
 
     # Mine structured AI analysis JSON (best-effort)
-    import json
-
     key_point_counts: dict[str, int] = {}
     review_plan_counts: dict[str, int] = {}
     concept_counts: dict[str, int] = {}
 
     for entry in recent:
-        raw = (entry.ai_analysis or '').strip()
-        if not raw:
-            continue
-        extracted = _extract_first_json_object(raw) or ''
-        if not extracted:
-            continue
-        try:
-            parsed = json.loads(extracted)
-        except Exception:
-            continue
-        if not isinstance(parsed, dict):
+        digest = _analysis_digest(entry)
+        if not digest:
             continue
-
-        key_points = parsed.get('key_points')
-        if isinstance(key_points, list):
-            for item in key_points:
-                s = str(item or '').strip()
-                if s:
-                    key_point_counts[s] = key_point_counts.get(s, 0) + 1
-
-        review_plan = parsed.get('review_plan')
-        if isinstance(review_plan, list):
-            for item in review_plan:
-                s = str(item or '').strip()
-                if s:
-                    review_plan_counts[s] = review_plan_counts.get(s, 0) + 1
-
-        mistakes = parsed.get('mistakes')
-        if isinstance(mistakes, list):
-            for m in mistakes:
-                if not isinstance(m, dict):
-                    continue
-                concept = str(m.get('concept') or '').strip()
-                if concept:
-                    concept_counts[concept] = concept_counts.get(concept, 0) + 1
+        for s in digest.get('key_points', ()):
+            key_point_counts[s] = key_point_counts.get(s, 0) + 1
+        for s in digest.get('review_plan', ()):
+            review_plan_counts[s] = review_plan_counts.get(s, 0) + 1
+        for s in digest.get('mistake_concepts', ()):
+            concept_counts[s] = concept_counts.get(s, 0) + 1
 
     top_key_points = [k for k, _ in sorted(key_point_counts.items(), key=lambda kv: (-kv[1], kv[0]))[:6]]
     top_review_plan = [k for k, _ in sorted(review_plan_counts.items(), key=lambda kv: (-kv[1], kv[0]))[:6]]
@@ -2264,39 +3856,49 @@ def _compute_dashboard_summary_payload(user: 'User') -> dict:
         .all()
     )
 
-    # Count mistake hits for recent error-book entries only (speed)
-    recent_for_mastery = (
-        ErrorBookEntry.query.filter(ErrorBookEntry.user_id.in_(access_user_ids))
+    # Mistake hits from the 120 most recent error-book entries and note hits
+    # (progress proxy) from the 160 most recent notes, counted per node in SQL.
+    recent_error_ids = (
+        db.session.query(ErrorBookEntry.id)
+        .filter(ErrorBookEntry.user_id.in_(access_user_ids))
         .order_by(ErrorBookEntry.created_at.desc())
         .limit(120)
-        .all()
     )
-    mistake_counts_by_name: dict[tuple[int, str, str], int] = {}
-    for e in recent_for_mastery:
-        subj, concepts = _extract_error_concepts(e)
-        for c in concepts:
-            key = (e.user_id, normalize_subject(subj), _normalize_concept_name(c))
-            mistake_counts_by_name[key] = mistake_counts_by_name.get(key, 0) + 1
-
-    # Count note hits (progress proxy) from recent note entries
-    recent_notes_for_mastery = (
-        NoteAssistantEntry.query.filter(NoteAssistantEntry.user_id.in_(note_access_user_ids))
+    recent_note_ids = (
+        db.session.query(NoteAssistantEntry.id)
+        .filter(NoteAssistantEntry.user_id.in_(note_access_user_ids))
         .order_by(NoteAssistantEntry.created_at.desc())
         .limit(160)
-        .all()
     )
-    note_counts_by_name: dict[tuple[int, str, str], int] = {}
-    for n in recent_notes_for_mastery:
-        subj, concepts = _extract_note_concepts(n)
-        for c in concepts:
-            key = (n.user_id, normalize_subject(subj), _normalize_concept_name(c))
-            note_counts_by_name[key] = note_counts_by_name.get(key, 0) + 1
+    mistake_counts_by_node: dict[int, int] = {}
+    note_counts_by_node: dict[int, int] = {}
+    if knowledge_nodes:
+        hit_rows = (
+            db.session.query(KnowledgeHit.node_id, KnowledgeHit.source_type, func.count())
+            .filter(KnowledgeHit.node_id.in_([node.id for node in knowledge_nodes]))
+            .filter(
+                or_(
+                    and_(
+                        KnowledgeHit.source_type == 'error_book',
+                        KnowledgeHit.source_id.in_(recent_error_ids.subquery().select()),
+                    ),
+                    and_(
+                        KnowledgeHit.source_type == 'note',
+                        KnowledgeHit.source_id.in_(recent_note_ids.subquery().select()),
+                    ),
+                )
+            )
+            .group_by(KnowledgeHit.node_id, KnowledgeHit.source_type)
+            .all()
+        )
+        for node_id, source_type, count in hit_rows:
+            target = mistake_counts_by_node if source_type == 'error_book' else note_counts_by_node
+            target[node_id] = count
 
     knowledge_mastery = []
     for node in knowledge_nodes:
-        key = (node.user_id, normalize_subject(node.subject), _normalize_concept_name(node.name))
-        mistake_count = mistake_counts_by_name.get(key, 0)
-        note_count = note_counts_by_name.get(key, 0)
+        mistake_count = mistake_counts_by_node.get(node.id, 0)
+        note_count = note_counts_by_node.get(node.id, 0)
         knowledge_mastery.append(
             {
                 'node_id': node.id,
@@ -2354,8 +3956,7 @@ def parent_report():
     report = None
     try:
         raw = run_gemini_parent_report(dashboard_payload)
-        extracted = _extract_first_json_object(raw) or ''
-        parsed = _loads_lenient_object(extracted) if extracted else None
+        parsed = _parse_first_json_object(raw)
         if isinstance(parsed, dict):
             report = {
                 'week': str(parsed.get('week') or '').strip() or _build_parent_report_fallback(dashboard_payload)['week'],
@@ -2406,55 +4007,136 @@ def parent_report():
     )
 
 
+# Per-owner co-occurrence graph + history index for mind maps. Both scan a few hundred
+# recent notes/errors, so they are cached until a commit touches one of the owner's
+# notes/errors or adds/removes a knowledge node (see the dashboard session hooks);
+# the TTL only bounds staleness from writes outside the ORM.
+_MIND_MAP_HISTORY_CACHE: dict[int, tuple[Any, float]] = {}
+_MIND_MAP_HISTORY_CACHE_LOCK = threading.Lock()
+_MIND_MAP_HISTORY_CACHE_TTL = float(os.getenv('MIND_MAP_HISTORY_CACHE_TTL', 600))
+_MIND_MAP_HISTORY_CACHE_MAX = 512
+_MIND_MAP_HISTORY_CACHE_VERSION = 0
+
+
+def invalidate_mind_map_history_cache(owner_user_ids: Iterable[int]) -> None:
+    global _MIND_MAP_HISTORY_CACHE_VERSION
+    with _MIND_MAP_HISTORY_CACHE_LOCK:
+        _MIND_MAP_HISTORY_CACHE_VERSION += 1
+        for owner_id in owner_user_ids:
+            _MIND_MAP_HISTORY_CACHE.pop(owner_id, None)
+
+
+def _get_mind_map_history(owner_user_id: int):
+    """(co-occurrence graph, (concept_to_notes, concept_to_errors)); treat the result as read-only."""
+
+    if _MIND_MAP_HISTORY_CACHE_TTL <= 0:
+        return _build_cooccurrence_related(owner_user_id), _build_history_index(owner_user_id)
+
+    with _MIND_MAP_HISTORY_CACHE_LOCK:
+        hit = _MIND_MAP_HISTORY_CACHE.get(owner_user_id)
+        version = _MIND_MAP_HISTORY_CACHE_VERSION
+    if hit and hit[1] > time.monotonic():
+        return hit[0]
+
+    result = (_build_cooccurrence_related(owner_user_id), _build_history_index(owner_user_id))
+
+    now = time.monotonic()
+    with _MIND_MAP_HISTORY_CACHE_LOCK:
+        if version == _MIND_MAP_HISTORY_CACHE_VERSION:
+            _MIND_MAP_HISTORY_CACHE.pop(owner_user_id, None)
+            while len(_MIND_MAP_HISTORY_CACHE) >= _MIND_MAP_HISTORY_CACHE_MAX:
+                _MIND_MAP_HISTORY_CACHE.pop(next(iter(_MIND_MAP_HISTORY_CACHE)), None)
+            _MIND_MAP_HISTORY_CACHE[owner_user_id] = (result, now + _MIND_MAP_HISTORY_CACHE_TTL)
+    return result
+
+
 def _build_cooccurrence_related(owner_user_id: int) -> dict[int, dict[int, int]]:
     """Build node co-occurrence graph from recent history for the owner user."""
 
-    related: dict[int, dict[int, int]] = {}
-
     notes = (
-        NoteAssistantEntry.query.filter_by(user_id=owner_user_id)
+        NoteAssistantEntry.query.options(
+            db.load_only(NoteAssistantEntry.id, NoteAssistantEntry.subject, NoteAssistantEntry.summary_json)
+        )
+        .filter_by(user_id=owner_user_id)
         .order_by(NoteAssistantEntry.created_at.desc())
         .limit(120)
         .all()
     )
     errors = (
-        ErrorBookEntry.query.filter_by(user_id=owner_user_id)
+        ErrorBookEntry.query.options(db.load_only(*ERROR_BOOK_CONCEPT_COLUMNS))
+        .filter_by(user_id=owner_user_id)
         .order_by(ErrorBookEntry.created_at.desc())
         .limit(120)
         .all()
     )
 
-    def add_pairs(node_ids: list[int]):
-        uniq = list(dict.fromkeys([int(x) for x in node_ids if x]))
-        if len(uniq) < 2:
-            return
-        for i in range(len(uniq)):
-            for j in range(i + 1, len(uniq)):
-                a, b = uniq[i], uniq[j]
-                related.setdefault(a, {})[b] = related.setdefault(a, {}).get(b, 0) + 1
-                related.setdefault(b, {})[a] = related.setdefault(b, {}).get(a, 0) + 1
-
+    sources: list[tuple[str, list[str]]] = []
     for n in notes:
         subj, concepts = _extract_note_concepts(n)
-        ids: list[int] = []
-        for c in concepts:
-            node = get_or_create_knowledge_node(owner_user_id, subj, c, kind='concept')
-            if node:
-                ids.append(node.id)
-        add_pairs(ids)
-
+        sources.append((normalize_subject(subj), [_normalize_concept_name(c) for c in concepts]))
     for e in errors:
         subj, concepts = _extract_error_concepts(e)
-        ids = []
-        for c in concepts:
-            node = get_or_create_knowledge_node(owner_user_id, subj, c, kind='concept')
-            if node:
-                ids.append(node.id)
-        add_pairs(ids)
+        sources.append((normalize_subject(subj), [_normalize_concept_name(c) for c in concepts]))
+
+    # Read-only lookup: concepts of analysed entries already have nodes (created when
+    # the entry was processed), and the graph is only consulted for existing nodes.
+    all_names = {c for _, concepts in sources for c in concepts if c}
+    node_ids: dict[tuple[str, str], int] = {}
+    if all_names:
+        rows = (
+            db.session.query(KnowledgeNode.id, KnowledgeNode.subject, KnowledgeNode.name)
+            .filter(KnowledgeNode.user_id == owner_user_id, KnowledgeNode.name.in_(all_names))
+            .all()
+        )
+        node_ids = {(subject, name): int(node_id) for node_id, subject, name in rows}
 
+    # Each unordered pair is counted once under (low, high) and mirrored at the end.
+    pair_counts: Counter[tuple[int, int]] = Counter()
+    for subj, concepts in sources:
+        uniq = list(dict.fromkeys(i for i in (node_ids.get((subj, c)) for c in concepts) if i))
+        if len(uniq) < 2:
+            continue
+        pair_counts.update((a, b) if a < b else (b, a) for a, b in combinations(uniq, 2))
+
+    related: dict[int, dict[int, int]] = {}
+    for (a, b), count in pair_counts.items():
+        related.setdefault(a, {})[b] = count
+        related.setdefault(b, {})[a] = count
     return related
 
 
+_MIND_TREE_KINDS = ['chapter', 'concept', 'method', 'mistake']
+
+
+def _mind_tree_node_schema(depth: int) -> dict:
+    # response_schema can't recurse, so the tree is unrolled to the prompt's max depth.
+    properties: dict[str, Any] = {'name': _SCHEMA_STR, 'kind': {'type': 'STRING', 'enum': _MIND_TREE_KINDS}}
+    if depth > 1:
+        properties['children'] = {'type': 'ARRAY', 'items': _mind_tree_node_schema(depth - 1)}
+    return {'type': 'OBJECT', 'properties': properties, 'required': ['name', 'kind']}
+
+
+_MIND_TREE_SCHEMA = {
+    'type': 'OBJECT',
+    'properties': {
+        'tree': _mind_tree_node_schema(4),
+        'subject': _SCHEMA_STR,
+        'seed_concepts': _SCHEMA_STR_LIST,
+    },
+    'required': ['tree'],
+}
+_MIND_MAP_COMPARE_SCHEMA = _schema_object(
+    {
+        'comparisons': {
+            'type': 'ARRAY',
+            'items': _schema_object(
+                {'name': _SCHEMA_STR, 'summary': _SCHEMA_STR, 'gaps': _SCHEMA_STR_LIST, 'actions': _SCHEMA_STR_LIST}
+            ),
+        }
+    }
+)
+
+
 def _validate_mind_tree_dict(obj: Any) -> tuple[dict | None, str | None]:
     if not isinstance(obj, dict):
         return None, 'mind tree 结果不是对象'
@@ -2466,18 +4148,113 @@ def _validate_mind_tree_dict(obj: Any) -> tuple[dict | None, str | None]:
     return obj, None
 
 
-def run_gemini_mindmap_tree(subject: str, title: str, source_text: str, seed_concepts: list[str]):
-    import json
-    import time
+# Persistent cache for the mind-map calls and Whisper transcripts, one JSON file per
+# request under AI_CACHE_DIR/<hh>/<hash>.json. A mind-map prompt embeds every input, so
+# identical (subject, title, source, concepts) requests are served from disk across
+# restarts; transcripts are keyed by the audio's sha256. Bump the matching version
+# when a prompt or the decoding changes; AI_CACHE_ENABLED=0 turns it off.
+_MINDMAP_PROMPT_VERSION = '1'
+_WHISPER_CACHE_VERSION = '1'
+_AI_CACHE_ENABLED = os.getenv('AI_CACHE_ENABLED', '1').strip() != '0'
+
+
+def _ai_cache_dir() -> Path:
+    return Path(os.getenv('AI_CACHE_DIR') or os.path.join(app.instance_path, 'ai_cache'))
+
+
+def _ai_cache_key(
+    kind: str, model: str, prompt: str, version: str = _MINDMAP_PROMPT_VERSION, provider: str = 'gemini'
+) -> str:
+    # Length-prefixed fields, so no two different field tuples hash the same bytes.
+    h = sha256()
+    for field in (provider, model, version, kind, prompt):
+        raw = field.encode('utf-8')
+        h.update(len(raw).to_bytes(8, 'little'))
+        h.update(raw)
+    return h.hexdigest()
 
-    api_key = app.config.get('GEMINI_API_KEY', '')
-    if not api_key:
-        raise RuntimeError('未配置 GEMINI_API_KEY，无法生成知识树')
 
+def _ai_cache_get(key: str) -> str | None:
+    if not _AI_CACHE_ENABLED:
+        return None
     try:
-        from google import genai  # type: ignore
+        with open(_ai_cache_dir() / key[:2] / f'{key}.json', 'rb') as f:
+            record = _json_loads(f.read())
+        response = record.get('response') if isinstance(record, dict) else None
+        return response if isinstance(response, str) and response.strip() else None
+    except FileNotFoundError:
+        return None
     except Exception as exc:
-        raise RuntimeError('google-genai 未安装，请先安装 google-genai') from exc
+        app.logger.warning('AI cache read failed: %s', exc)
+        return None
+
+
+def _ai_cache_set(key: str, model: str, response: str, version: str = _MINDMAP_PROMPT_VERSION) -> None:
+    if not _AI_CACHE_ENABLED:
+        return
+    record = {
+        'response': response,
+        'model': model,
+        'prompt_version': version,
+        'created_at': isoformat_utc_z(datetime.now(timezone.utc)),
+    }
+    try:
+        target = _ai_cache_dir() / key[:2] / f'{key}.json'
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_suffix(f'.{uuid.uuid4().hex}.tmp')
+        tmp.write_text(_json_dumps(record), encoding='utf-8')
+        os.replace(tmp, target)
+    except Exception as exc:
+        app.logger.warning('AI cache write failed: %s', exc)
+
+
+def _gemini_generate_with_retries(
+    client: Any, model: str, prompt: str, attempts: int = 3, schema: dict | None = None
+) -> str:
+    """Plain generate_content, retried (with a short backoff) on transient network errors.
+
+    The backoff sleeps on the calling thread, so callers on the request thread pass
+    fewer attempts; calls already on a pool keep the default. `schema` constrains the
+    output like in _gemini_generate_text.
+    """
+
+    config = {'response_mime_type': 'application/json', 'response_schema': schema} if schema else None
+    raw = ''
+    last_exc: Exception | None = None
+    for attempt in range(attempts):
+        try:
+            response = client.models.generate_content(model=model, contents=prompt, config=config)
+            raw = (getattr(response, 'text', None) or '').strip()
+            if raw:
+                break
+        except Exception as exc:
+            last_exc = exc
+            msg = str(exc).lower()
+            transient = any(
+                s in msg
+                for s in (
+                    'server disconnected',
+                    'timed out',
+                    'timeout',
+                    'connection reset',
+                    'temporarily unavailable',
+                    'ssl',
+                    'tls',
+                )
+            )
+            if attempt < attempts - 1 and transient:
+                time.sleep(0.6 + attempt * 0.9)
+                continue
+            raise
+    if not raw and last_exc:
+        raise last_exc
+    return raw
+
+
+def run_gemini_mindmap_tree(subject: str, title: str, source_text: str, seed_concepts: list[str]):
+    api_key = app.config.get('GEMINI_API_KEY', '')
+    if not api_key:
+        raise RuntimeError('未配置 GEMINI_API_KEY，无法生成知识树')
 
     subject_norm = normalize_subject(subject)
     seed = [c for c in [str(x or '').strip() for x in (seed_concepts or [])] if c]
@@ -2511,7 +4288,7 @@ def run_gemini_mindmap_tree(subject: str, title: str, source_text: str, seed_con
     ]
   }},
   "subject": "{subject_norm}",
-  "seed_concepts": {json.dumps(seed, ensure_ascii=False)}
+  "seed_concepts": {_json_dumps(seed)}
 }}
 
 输入：
@@ -2521,41 +4298,17 @@ def run_gemini_mindmap_tree(subject: str, title: str, source_text: str, seed_con
 内容（截断）：
 """ + text
 
-    raw = ''
-    last_exc: Exception | None = None
-    for attempt in range(3):
-        try:
-            client = genai.Client(api_key=api_key)
-            response = client.models.generate_content(model=model, contents=prompt)
-            raw = (getattr(response, 'text', None) or '').strip()
-            if raw:
-                break
-        except Exception as exc:
-            last_exc = exc
-            msg = str(exc).lower()
-            transient = any(
-                s in msg
-                for s in (
-                    'server disconnected',
-                    'timed out',
-                    'timeout',
-                    'connection reset',
-                    'temporarily unavailable',
-                    'ssl',
-                    'tls',
-                )
-            )
-            if attempt < 2 and transient:
-                time.sleep(0.6 + attempt * 0.9)
-                continue
-            raise
-    if not raw and last_exc:
-        raise last_exc
-    extracted = _extract_first_json_object(raw) or raw
-    parsed = _loads_lenient_object(extracted)
+    cache_key = _ai_cache_key('mindmap_tree', model, prompt)
+    raw = _ai_cache_get(cache_key)
+    from_api = raw is None
+    if from_api:
+        raw = _gemini_generate_with_retries(_genai_client(api_key), model, prompt, schema=_MIND_TREE_SCHEMA)
+    parsed = _parse_first_json_object(raw)
     ok, err = _validate_mind_tree_dict(parsed)
     if err:
         raise RuntimeError(err)
+    if from_api:
+        _ai_cache_set(cache_key, model, raw)
     return ok
 
 
@@ -2582,56 +4335,103 @@ def _flatten_mind_tree(tree: dict) -> list[tuple[str, str, str]]:
     return edges
 
 
-def _build_history_index(owner_user_id: int) -> tuple[dict[str, list[NoteAssistantEntry]], dict[str, list[ErrorBookEntry]]]:
+def _build_history_index(owner_user_id: int) -> tuple[dict[str, list[dict[str, Any]]], dict[str, list[dict[str, Any]]]]:
+    """Map normalized concept -> evidence rows of the owner's recent notes / errors (newest first)."""
+
     notes = (
-        NoteAssistantEntry.query.filter_by(user_id=owner_user_id)
+        NoteAssistantEntry.query.options(
+            db.load_only(
+                NoteAssistantEntry.id,
+                NoteAssistantEntry.title,
+                NoteAssistantEntry.subject,
+                NoteAssistantEntry.created_at,
+                NoteAssistantEntry.summary_json,
+            )
+        )
+        .filter_by(user_id=owner_user_id)
         .order_by(NoteAssistantEntry.created_at.desc())
         .limit(220)
         .all()
     )
     errors = (
-        ErrorBookEntry.query.filter_by(user_id=owner_user_id)
+        ErrorBookEntry.query.options(
+            db.load_only(
+                *ERROR_BOOK_CONCEPT_COLUMNS, ErrorBookEntry.title, ErrorBookEntry.created_at, ErrorBookEntry.verdict
+            )
+        )
+        .filter_by(user_id=owner_user_id)
         .order_by(ErrorBookEntry.created_at.desc())
         .limit(220)
         .all()
     )
 
-    concept_to_notes: dict[str, list[NoteAssistantEntry]] = {}
+    concept_to_notes: dict[str, list[dict[str, Any]]] = {}
     for n in notes:
         _, concepts = _extract_note_concepts(n)
+        row = {
+            'id': n.id,
+            'title': (n.title or '').strip() or '课堂笔记',
+            'created_at': isoformat_utc_z(n.created_at),
+        }
         for c in concepts:
             key = _normalize_concept_name(c)
             if not key:
                 continue
-            concept_to_notes.setdefault(key, []).append(n)
+            concept_to_notes.setdefault(key, []).append(row)
 
-    concept_to_errors: dict[str, list[ErrorBookEntry]] = {}
+    concept_to_errors: dict[str, list[dict[str, Any]]] = {}
     for e in errors:
         _, concepts = _extract_error_concepts(e)
+        row = {
+            'id': e.id,
+            'title': (e.title or '').strip() or '错题',
+            'created_at': isoformat_utc_z(e.created_at),
+            'verdict': (e.verdict or '').strip(),
+        }
         for c in concepts:
             key = _normalize_concept_name(c)
             if not key:
                 continue
-            concept_to_errors.setdefault(key, []).append(e)
+            concept_to_errors.setdefault(key, []).append(row)
 
     return concept_to_notes, concept_to_errors
 
 
-def run_gemini_mindmap_compare(subject: str, title: str, items: list[dict[str, Any]]):
-    import json
-    import time
+# Comparison prompt budget: per-field clips and an overall cap on the items JSON.
+_MIND_MAP_COMPARE_ITEMS_MAX_CHARS = 3500
+
+
+def _clip(value: Any, limit: int) -> str:
+    return str(value or '').strip()[:limit]
+
+
+def _budget_compare_items(items: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Clip titles/verdicts, keep 3 of each per item, then drop the lowest-ranked items
+    (callers pass them highest highlight first) until the JSON fits the budget."""
+
+    clipped = [
+        {
+            'name': _clip(it.get('name'), 40),
+            'highlight': it.get('highlight') or 0,
+            'notes_titles': [_clip(x, 40) for x in (it.get('notes_titles') or [])[:3]],
+            'errors_titles': [_clip(x, 40) for x in (it.get('errors_titles') or [])[:3]],
+            'errors_verdicts': [_clip(x, 80) for x in (it.get('errors_verdicts') or [])[:3]],
+        }
+        for it in items
+    ]
+    while len(clipped) > 1 and len(_json_dumps(clipped)) > _MIND_MAP_COMPARE_ITEMS_MAX_CHARS:
+        clipped.pop()
+    return clipped
 
+
+def run_gemini_mindmap_compare(subject: str, title: str, items: list[dict[str, Any]]):
     api_key = app.config.get('GEMINI_API_KEY', '')
     if not api_key:
         raise RuntimeError('未配置 GEMINI_API_KEY，无法生成对比分析')
 
-    try:
-        from google import genai  # type: ignore
-    except Exception as exc:
-        raise RuntimeError('google-genai 未安装，请先安装 google-genai') from exc
-
     model = app.config.get('GEMINI_MODEL', 'gemini-2.5-flash')
     subject_norm = normalize_subject(subject)
+    items = _budget_compare_items(items)
 
     prompt = f"""
 你是学习分析助手。给你一些知识点以及它们关联的“笔记要点/错题错因”，请输出对比分析。
@@ -2655,46 +4455,104 @@ def run_gemini_mindmap_compare(subject: str, title: str, items: list[dict[str, A
 科目：{subject_norm}
 标题：{title}
 输入 items JSON：
-{json.dumps(items, ensure_ascii=False)}
+{_json_dumps(items)}
 """
 
-    raw = ''
-    last_exc: Exception | None = None
-    for attempt in range(3):
-        try:
-            client = genai.Client(api_key=api_key)
-            response = client.models.generate_content(model=model, contents=prompt)
-            raw = (getattr(response, 'text', None) or '').strip()
-            if raw:
-                break
-        except Exception as exc:
-            last_exc = exc
-            msg = str(exc).lower()
-            transient = any(
-                s in msg
-                for s in (
-                    'server disconnected',
-                    'timed out',
-                    'timeout',
-                    'connection reset',
-                    'temporarily unavailable',
-                    'ssl',
-                    'tls',
-                )
-            )
-            if attempt < 2 and transient:
-                time.sleep(0.6 + attempt * 0.9)
-                continue
-            raise
-    if not raw and last_exc:
-        raise last_exc
-    extracted = _extract_first_json_object(raw) or raw
-    parsed = _loads_lenient_object(extracted)
+    cache_key = _ai_cache_key('mindmap_compare', model, prompt)
+    raw = _ai_cache_get(cache_key)
+    from_api = raw is None
+    if from_api:
+        # Best-effort and on the request thread: one retry at most (<= 0.6s of backoff).
+        raw = _gemini_generate_with_retries(
+            _genai_client(api_key), model, prompt, attempts=2, schema=_MIND_MAP_COMPARE_SCHEMA
+        )
+    parsed = _parse_first_json_object(raw)
     if not isinstance(parsed, dict) or not isinstance(parsed.get('comparisons'), list):
         raise RuntimeError('对比分析返回格式不正确')
+    if from_api:
+        _ai_cache_set(cache_key, model, raw)
     return parsed
 
 
+# Gemini tree requests for /api/mind-map/generate, overlapped with the handler's DB work,
+# and the snapshot writes that follow its response.
+_MIND_MAP_EXECUTOR = ThreadPoolExecutor(
+    max_workers=max(1, int(os.getenv('MIND_MAP_WORKERS', '4'))),
+    thread_name_prefix='mind-map',
+)
+_MIND_MAP_AI_TIMEOUT = float(os.getenv('MIND_MAP_AI_TIMEOUT', '60'))
+
+# Generates in flight, keyed by (owner, source, mode): concurrent identical requests
+# (double clicks, refreshes, other viewers of the same owner) wait for the first one's
+# payload instead of each writing nodes and calling Gemini. Per process only.
+_MIND_MAP_INFLIGHT: dict[str, Future] = {}
+_MIND_MAP_INFLIGHT_LOCK = threading.Lock()
+
+
+def _mind_map_singleflight(key: str, build: Any) -> Any:
+    """Return build(), or the result of an identical build already running in another request."""
+
+    with _MIND_MAP_INFLIGHT_LOCK:
+        running = _MIND_MAP_INFLIGHT.get(key)
+        if running is None:
+            mine: Future = Future()
+            _MIND_MAP_INFLIGHT[key] = mine
+    if running is not None:
+        try:
+            return running.result(timeout=_MIND_MAP_AI_TIMEOUT + 30)
+        except Exception:
+            return build()  # the first request failed or stalled; do the work here
+
+    try:
+        result = build()
+    except BaseException as exc:
+        mine.set_exception(exc)
+        raise
+    else:
+        mine.set_result(result)
+        return result
+    finally:
+        with _MIND_MAP_INFLIGHT_LOCK:
+            _MIND_MAP_INFLIGHT.pop(key, None)
+
+
+def _write_mind_map_snapshot(
+    owner_user_id: int,
+    source_type: str,
+    source_id: int,
+    root_node_id: int,
+    map_data: dict[str, Any],
+    highlight_counts: dict[int, int],
+    related_payload: dict[str, list[dict[str, Any]]],
+) -> None:
+    """Best-effort MindMapSnapshot insert, run on the pool off the response path.
+
+    Nothing reads the row back, so it's a Core INSERT: no ORM instance or unit-of-work flush.
+    """
+
+    try:
+        with app.app_context():
+            db.session.execute(
+                insert(MindMapSnapshot).values(
+                    user_id=owner_user_id,
+                    source_type=source_type,
+                    source_id=source_id,
+                    root_node_id=root_node_id,
+                    map_json=_json_dumps(map_data),
+                    highlights_json=_json_dumps(highlight_counts),
+                    related_json=_json_dumps(related_payload),
+                )
+            )
+            db.session.commit()
+    except Exception as exc:
+        app.logger.warning('Mind map snapshot not saved: %s', exc)
+    finally:
+        try:
+            db.session.remove()
+        except Exception:
+            pass
+
+
 @app.route('/api/mind-map/generate', methods=['POST'])
 def mind_map_generate():
     user, error_response, status = require_auth()
@@ -2756,118 +4614,178 @@ def mind_map_generate():
         except Exception:
             source_text = ''
 
+    mode = str(data.get('mode') or 'ai').strip()  # ai|simple
+
+    payload = _mind_map_singleflight(
+        f'{owner_user_id}:{source_type}:{source_id_int}:{mode}',
+        lambda: _build_mind_map_payload(
+            owner_user_id, source_type, source_id_int, subject, title, concept_names, source_text, mode
+        ),
+    )
+    if payload is None:
+        return jsonify({'message': '无法生成根节点'}), 500
+    return jsonify(payload)
+
+
+def _build_mind_map_payload(
+    owner_user_id: int,
+    source_type: str,
+    source_id_int: int,
+    subject: str,
+    title: str,
+    concept_names: list[str],
+    source_text: str,
+    mode: str,
+) -> dict[str, Any] | None:
+    """Build (and persist) the mind map for one source; None when no root node can be made."""
+
     root_node = get_or_create_knowledge_node(owner_user_id, subject, title, kind='chapter')
     if not root_node:
-        return jsonify({'message': '无法生成根节点'}), 500
+        return None
 
     nodes: dict[int, KnowledgeNode] = {root_node.id: root_node}
     edges: list[dict[str, int]] = []
 
-    mode = str(data.get('mode') or 'ai').strip()  # ai|simple
+    # The AI tree call only needs the inputs above, so it runs on the pool while this
+    # thread (and its DB session) builds the history-based parts of the map.
+    ai_future: Future | None = None
+    if mode == 'ai':
+        try:
+            ai_future = _MIND_MAP_EXECUTOR.submit(run_gemini_mindmap_tree, subject, title, source_text, concept_names)
+        except Exception as exc:
+            app.logger.warning('Mind map AI tree not started: %s', exc)
+
+    # Mistake tags across owner's history (for highlights): knowledge hits of the
+    # 160 most recent error-book entries, counted per concept name in SQL.
+    recent_error_ids = (
+        db.session.query(ErrorBookEntry.id)
+        .filter(ErrorBookEntry.user_id == owner_user_id)
+        .order_by(ErrorBookEntry.created_at.desc())
+        .limit(160)
+    )
+    concept_counter: dict[str, int] = dict(
+        db.session.query(KnowledgeNode.name, func.count())
+        .join(KnowledgeHit, KnowledgeHit.node_id == KnowledgeNode.id)
+        .filter(
+            KnowledgeHit.user_id == owner_user_id,
+            KnowledgeHit.source_type == 'error_book',
+            KnowledgeHit.source_id.in_(recent_error_ids.subquery().select()),
+        )
+        .group_by(KnowledgeNode.name)
+        .all()
+    )
+
+    # Related links by co-occurrence, and evidence from history
+    co, (concept_to_notes, concept_to_errors) = _get_mind_map_history(owner_user_id)
 
     # Prefer AI hierarchical expansion; fallback to deterministic.
     ai_tree = None
-    if mode == 'ai':
+    if ai_future is not None:
         try:
-            ai_tree = run_gemini_mindmap_tree(subject, title, source_text, concept_names)
+            ai_tree = ai_future.result(timeout=_MIND_MAP_AI_TIMEOUT)
         except Exception as exc:
             app.logger.warning('Mind map AI tree failed, fallback to simple: %s', exc)
             ai_tree = None
 
     if ai_tree and isinstance(ai_tree, dict) and isinstance(ai_tree.get('tree'), dict):
         root_name = _normalize_concept_name(ai_tree['tree'].get('name')) or title
-        # Ensure root uses existing root_node but keep name stable
+        # Ensure root uses existing root_node but keep name stable. The rename rides on
+        # the node upsert's commit below; a SAVEPOINT undoes just it if the name is taken.
         if root_name and root_name != (root_node.name or ''):
             try:
-                root_node.name = _normalize_concept_name(root_name) or root_node.name
-                save_and_commit(root_node)
+                with db.session.begin_nested():
+                    root_node.name = _normalize_concept_name(root_name) or root_node.name
             except Exception:
                 pass
 
         pairs = _flatten_mind_tree(ai_tree['tree'])
-        # Create nodes and edges. Parent/child resolved by name, with root as anchor.
-        name_to_id: dict[str, int] = {_normalize_concept_name(root_node.name): root_node.id}
+        # Plan nodes and edges by name first (parent/child resolved by name, with root
+        # as anchor), then create every node in one bulk upsert.
+        root_key = _normalize_concept_name(root_node.name)
+        planned: dict[str, str] = {root_key: 'chapter'}
+        edge_keys: list[tuple[str, str]] = []
 
-        def get_id_for_name(nm: str, kind: str) -> int | None:
+        def plan_name(nm: str, kind: str) -> str:
             key = _normalize_concept_name(nm)
-            if not key:
-                return None
-            if key in name_to_id:
-                return name_to_id[key]
-            node = get_or_create_knowledge_node(owner_user_id, subject, key, kind=kind if kind in ('chapter', 'concept', 'method', 'mistake') else 'concept')
-            if not node:
-                return None
-            nodes[node.id] = node
-            name_to_id[key] = node.id
-            return node.id
+            if key and key not in planned:
+                planned[key] = kind if kind in ('chapter', 'concept', 'method', 'mistake') else 'concept'
+            return key
 
         # Bound size
         for parent_name, child_name, child_kind in pairs[:80]:
-            if len(nodes) >= 34:
+            if len(planned) >= 34:
                 break
-            p_id = get_id_for_name(parent_name, kind='chapter')
-            c_id = get_id_for_name(child_name, kind=child_kind)
-            if not p_id or not c_id or p_id == c_id:
+            p_key = plan_name(parent_name, 'chapter')
+            c_key = plan_name(child_name, child_kind)
+            if not p_key or not c_key or p_key == c_key:
                 continue
-            edges.append({'from': p_id, 'to': c_id})
+            edge_keys.append((p_key, c_key))
 
         # Ensure seeds appear under root if missing
+        seed_keys: list[str] = []
         for name in concept_names:
-            if len(nodes) >= 34:
+            if len(planned) >= 34:
                 break
-            node = get_or_create_knowledge_node(owner_user_id, subject, name, kind='concept')
-            if not node:
-                continue
-            nodes[node.id] = node
-            if not any(e.get('to') == node.id for e in edges):
+            key = plan_name(name, 'concept')
+            if key:
+                seed_keys.append(key)
+
+        new_names = [k for k in planned if k != root_key]
+        by_name = bulk_upsert_knowledge_nodes(owner_user_id, subject, new_names, kinds=planned)
+        by_name[root_key] = root_node
+        for key in planned:
+            node = by_name.get(key)
+            if node:
+                nodes[node.id] = node
+        for p_key, c_key in edge_keys:
+            if p_key in by_name and c_key in by_name:
+                edges.append({'from': by_name[p_key].id, 'to': by_name[c_key].id})
+        for key in seed_keys:
+            node = by_name.get(key)
+            if node and node is not root_node and not any(e.get('to') == node.id for e in edges):
                 edges.append({'from': root_node.id, 'to': node.id})
     else:
         # Flat tree (root -> concepts). Deterministic fallback.
-        for name in concept_names:
-            node = get_or_create_knowledge_node(owner_user_id, subject, name, kind='concept')
+        by_name = bulk_upsert_knowledge_nodes(owner_user_id, subject, concept_names, kind='concept')
+        for key in dict.fromkeys(_normalize_concept_name(n) for n in concept_names):
+            node = by_name.get(key)
             if not node:
                 continue
             nodes[node.id] = node
             edges.append({'from': root_node.id, 'to': node.id})
 
+    # Normalized once for the highlight, evidence and comparison lookups below.
+    norm_names = {node_id: _normalize_concept_name(node.name) for node_id, node in nodes.items()}
+
     # Highlight from error-book mistake tags across owner's history
     highlight_counts: dict[int, int] = {}
-    owner_errors = (
-        ErrorBookEntry.query.filter_by(user_id=owner_user_id)
-        .order_by(ErrorBookEntry.created_at.desc())
-        .limit(160)
-        .all()
-    )
-    concept_counter: dict[str, int] = {}
-    for e in owner_errors:
-        _, cs = _extract_error_concepts(e)
-        for c in cs:
-            c2 = _normalize_concept_name(c)
-            if c2:
-                concept_counter[c2] = concept_counter.get(c2, 0) + 1
-    for node_id, node in nodes.items():
-        c = concept_counter.get(_normalize_concept_name(node.name), 0)
+    for node_id, nm in norm_names.items():
+        c = concept_counter.get(nm, 0)
         if c > 0:
             highlight_counts[node_id] = c
 
     # Related links by co-occurrence
-    co = _build_cooccurrence_related(owner_user_id)
+    related_top = {
+        node_id: sorted(co.get(int(node_id), {}).items(), key=lambda kv: (-kv[1], kv[0]))[:6]
+        for node_id in nodes.keys()
+    }
+    # Names of every related node in one IN query (ids come from the owner's own graph).
+    all_rids = {rid for top in related_top.values() for rid, _ in top}
+    related_names: dict[int, str] = (
+        dict(db.session.query(KnowledgeNode.id, KnowledgeNode.name).filter(KnowledgeNode.id.in_(all_rids)).all())
+        if all_rids
+        else {}
+    )
     related_payload: dict[str, list[dict[str, Any]]] = {}
-    for node_id in nodes.keys():
-        rel = co.get(int(node_id), {})
-        top = sorted(rel.items(), key=lambda kv: (-kv[1], kv[0]))[:6]
-        items = []
-        for rid, cnt in top:
-            other = KnowledgeNode.query.filter_by(id=rid).first()
-            if other:
-                items.append({'node_id': other.id, 'name': other.name, 'count': cnt})
-        related_payload[str(node_id)] = items
+    for node_id, top in related_top.items():
+        related_payload[str(node_id)] = [
+            {'node_id': rid, 'name': related_names[rid], 'count': cnt} for rid, cnt in top if rid in related_names
+        ]
 
     # Evidence from history: related notes + errors for each concept node
-    concept_to_notes, concept_to_errors = _build_history_index(owner_user_id)
     evidence: dict[str, dict[str, Any]] = {}
     for node_id, node in nodes.items():
-        nm = _normalize_concept_name(node.name)
+        nm = norm_names[node_id]
         if not nm or node.kind == 'chapter':
             continue
         notes_hit = concept_to_notes.get(nm, [])[:5]
@@ -2875,23 +4793,8 @@ def mind_map_generate():
         if not notes_hit and not errors_hit:
             continue
         evidence[str(node_id)] = {
-            'notes': [
-                {
-                    'id': n.id,
-                    'title': (n.title or '').strip() or '课堂笔记',
-                    'created_at': isoformat_utc_z(n.created_at),
-                }
-                for n in notes_hit
-            ],
-            'errors': [
-                {
-                    'id': e.id,
-                    'title': (e.title or '').strip() or '错题',
-                    'created_at': isoformat_utc_z(e.created_at),
-                    'verdict': (e.verdict or '').strip(),
-                }
-                for e in errors_hit
-            ],
+            'notes': [dict(row) for row in notes_hit],
+            'errors': [dict(row) for row in errors_hit],
         }
 
     # Comparative analysis (LLM best-effort) for top highlighted nodes
@@ -2925,6 +4828,10 @@ def mind_map_generate():
             )
         if items:
             comp = run_gemini_mindmap_compare(subject, title, items)
+            # First node per normalized name, matching the previous linear scan.
+            node_by_name: dict[str, int] = {}
+            for node_id, nm in norm_names.items():
+                node_by_name.setdefault(nm, node_id)
             for c in comp.get('comparisons', []) if isinstance(comp, dict) else []:
                 if not isinstance(c, dict):
                     continue
@@ -2932,62 +4839,57 @@ def mind_map_generate():
                 if not nm:
                     continue
                 # Map to node ids by name
-                for node_id, node in nodes.items():
-                    if _normalize_concept_name(node.name) == nm:
-                        analysis[str(node_id)] = {
-                            'summary': str(c.get('summary') or '').strip(),
-                            'gaps': c.get('gaps') if isinstance(c.get('gaps'), list) else [],
-                            'actions': c.get('actions') if isinstance(c.get('actions'), list) else [],
-                        }
-                        break
+                node_id = node_by_name.get(nm)
+                if node_id is not None:
+                    analysis[str(node_id)] = {
+                        'summary': str(c.get('summary') or '').strip(),
+                        'gaps': c.get('gaps') if isinstance(c.get('gaps'), list) else [],
+                        'actions': c.get('actions') if isinstance(c.get('actions'), list) else [],
+                    }
     except Exception as exc:
         app.logger.warning('Mind map comparison analysis skipped: %s', exc)
 
-    # Persist snapshot (best-effort)
-    try:
-        import json
+    node_dicts = [n.to_dict() for n in nodes.values()]
 
-        snap = MindMapSnapshot(
-            user_id=owner_user_id,
-            source_type=source_type,
-            source_id=source_id_int,
-            root_node_id=root_node.id,
-            map_json=json.dumps(
-                {
-                    'root_id': root_node.id,
-                    'nodes': [n.to_dict() for n in nodes.values()],
-                    'edges': edges,
-                    'evidence': evidence,
-                    'analysis': analysis,
-                },
-                ensure_ascii=False,
-            ),
-            highlights_json=json.dumps(highlight_counts, ensure_ascii=False),
-            related_json=json.dumps(related_payload, ensure_ascii=False),
+    # Persist snapshot (best-effort). The response doesn't reference it, so the encode
+    # and commit run on the pool; the structures passed along aren't touched again here.
+    try:
+        _MIND_MAP_EXECUTOR.submit(
+            _write_mind_map_snapshot,
+            owner_user_id,
+            source_type,
+            source_id_int,
+            root_node.id,
+            {
+                'root_id': root_node.id,
+                'nodes': node_dicts,
+                'edges': edges,
+                'evidence': evidence,
+                'analysis': analysis,
+            },
+            highlight_counts,
+            related_payload,
         )
-        save_and_commit(snap)
-    except Exception:
-        pass
+    except Exception as exc:
+        app.logger.warning('Mind map snapshot not queued: %s', exc)
 
-    return jsonify(
-        {
-            'generated_at': isoformat_utc_z(datetime.now(timezone.utc)),
-            'source': {
-                'type': source_type,
-                'id': source_id_int,
-                'user_id': owner_user_id,
-                'title': title,
-                'subject': subject,
-            },
-            'root_id': root_node.id,
-            'nodes': [n.to_dict() for n in nodes.values()],
-            'edges': edges,
-            'highlights': [{'node_id': nid, 'count': cnt} for nid, cnt in sorted(highlight_counts.items(), key=lambda kv: -kv[1])],
-            'related': related_payload,
-            'evidence': evidence,
-            'analysis': analysis,
-        }
-    )
+    return {
+        'generated_at': isoformat_utc_z(datetime.now(timezone.utc)),
+        'source': {
+            'type': source_type,
+            'id': source_id_int,
+            'user_id': owner_user_id,
+            'title': title,
+            'subject': subject,
+        },
+        'root_id': root_node.id,
+        'nodes': node_dicts,
+        'edges': edges,
+        'highlights': [{'node_id': nid, 'count': cnt} for nid, cnt in sorted(highlight_counts.items(), key=lambda kv: -kv[1])],
+        'related': related_payload,
+        'evidence': evidence,
+        'analysis': analysis,
+    }
 
 
 # --- Routes: Note Assistant --------------------------------------------
@@ -3013,6 +4915,10 @@ def note_entries():
     if not audio_file:
         return jsonify({'message': '缺少音频文件字段 audio'}), 400
 
+    not_ready = whisper_not_ready_response()
+    if not_ready is not None:
+        return not_ready
+
     focus_tag = (request.form.get('focus_tag') or '').strip()
     title = (request.form.get('title') or '').strip()
     subject = normalize_subject(request.form.get('subject')) if request.form.get('subject') else ''
@@ -3026,36 +4932,38 @@ def note_entries():
         if 'webm' not in mimetype.lower() and 'mp4' not in mimetype.lower():
             return jsonify({'message': f'不支持的文件类型：{mimetype}（请上传音频）'}), 400
 
-    data = audio_file.read()
-    if not data:
-        return jsonify({'message': '音频内容为空'}), 400
-    if len(data) > 80 * 1024 * 1024:
-        return jsonify({'message': '音频过大（>80MB），请切分后上传'}), 400
-
-    digest = sha256(data).hexdigest()
-
-    # Write to a temp file (Windows requires closing the handle before ffmpeg/decoder reads it)
+    # Stream to a temp file, hashing on the way (Windows requires closing the handle
+    # before ffmpeg/decoder reads it); the upload is never held in memory as a whole.
     suffix = _guess_audio_suffix(original_name, mimetype)
-    fd, tmp_path = tempfile.mkstemp(prefix='note_audio_', suffix=suffix)
     try:
-        with os.fdopen(fd, 'wb') as f:
-            f.write(data)
+        tmp_path, audio_size, digest = _stream_upload_to_tempfile(
+            audio_file, suffix=suffix, prefix='note_audio_', max_size=NOTE_AUDIO_MAX_BYTES
+        )
+    except UploadTooLargeError:
+        return jsonify({'message': '音频过大（>80MB），请切分后上传'}), 400
+    try:
+        if not audio_size:
+            return jsonify({'message': '音频内容为空'}), 400
 
+        # A cached transcript means no Whisper run, so the row is written once, already
+        # transcribed; otherwise it's committed first so 'transcribing' is visible meanwhile.
+        cached = _cached_transcript(digest)
         entry = NoteAssistantEntry(
             user_id=user.id,
             title=title or None,
             subject=subject or None,
             focus_tag=focus_tag or None,
-            status='transcribing',
+            status='transcribing' if cached is None else 'transcribed',
+            transcript_text=cached,
             audio_original_name=original_name,
             audio_mimetype=mimetype,
-            audio_size=len(data),
+            audio_size=audio_size,
             audio_sha256=digest,
         )
         save_and_commit(entry)
 
         try:
-            transcript = transcribe_audio_file(tmp_path)
+            transcript = cached if cached is not None else _transcribe_cached(digest, lambda: transcribe_audio_file(tmp_path))
         except Exception as exc:
             entry.status = 'transcribe_failed'
             entry.transcript_text = ''
@@ -3073,9 +4981,10 @@ def note_entries():
                 201,
             )
 
-        entry.transcript_text = transcript
-        entry.status = 'transcribed'
-        save_and_commit(entry)
+        if cached is None:
+            entry.transcript_text = transcript
+            entry.status = 'transcribed'
+            save_and_commit(entry)
         return (
             jsonify(
                 {
@@ -3124,13 +5033,266 @@ def note_entry_detail(entry_id: int):
         return jsonify({'message': '未找到笔记记录'}), 404
 
     if request.method == 'DELETE':
+        session_id = entry.session_id
         db.session.delete(entry)
+        _delete_knowledge_hits('note', entry_id)
         db.session.commit()
+        discard_live_transcript(session_id)
         return jsonify({'message': '已删除', 'id': entry_id})
 
     return jsonify(entry.to_detail())
 
 
+# Live transcription of recording sessions: while chunks keep arriving, finished
+# stretches of audio are transcribed in the background, so finalize only runs Whisper
+# on the tail. MediaRecorder slices are 2.5s and split words, so segments are long and
+# cut at the quietest 200ms before each boundary. Each chunk is decoded once: a
+# MediaRecorder WebM stream is fed into a per-session PyAV decoder as it grows, and
+# only audio not yet transcribed is kept. State is per process and dropped after
+# LIVE_ASR_IDLE_SECONDS without chunks; finalize falls back to one full pass whenever
+# it has none (restart, other worker, failed segment).
+_LIVE_ASR_SEGMENT_SECONDS = float(os.getenv('LIVE_ASR_SEGMENT_SECONDS', '60'))
+_LIVE_ASR_EVERY_CHUNKS = max(1, int(os.getenv('LIVE_ASR_EVERY_CHUNKS', '12')))
+_LIVE_ASR_IDLE_SECONDS = float(os.getenv('LIVE_ASR_IDLE_SECONDS', '3600'))
+_LIVE_ASR_CUT_WINDOW_SECONDS = 5.0
+# Whisper already saturates the device; one live job at a time.
+_LIVE_ASR_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='live-asr')
+_LIVE_ASR_SESSIONS: dict[str, '_LiveTranscript'] = {}
+_LIVE_ASR_LOCK = threading.Lock()
+
+
+class _ByteFeed:
+    """Blocking byte pipe: PyAV demuxes from it while chunk bytes are written in."""
+
+    def __init__(self) -> None:
+        self._buf = bytearray()
+        self._cond = threading.Condition()
+        self._eof = False
+
+    def feed(self, data: bytes) -> None:
+        with self._cond:
+            self._buf += data
+            self._cond.notify_all()
+
+    def finish(self) -> None:
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+
+    def read(self, size: int = -1) -> bytes:
+        with self._cond:
+            while not self._buf and not self._eof:
+                self._cond.wait()
+            n = len(self._buf) if size is None or size < 0 else min(size, len(self._buf))
+            data = bytes(self._buf[:n])
+            del self._buf[:n]
+            return data
+
+
+class _LiveTranscript:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()  # held while a segment is transcribed
+        self.offset = 0  # samples of the decoded session already transcribed
+        self.parts: list[str] = []
+        self.chunks_seen = 0
+        self.chunks_passed = 0  # chunks_seen when the last pass started
+        self.last_chunk = ''  # name of the last chunk file handed to the decoder
+        self.feed: _ByteFeed | None = None  # set for a single WebM stream
+        self.pcm_lock = threading.Lock()
+        self.pcm: list[Any] = []  # decoded samples from `offset` on
+        self.last_active = time.monotonic()
+        self.failed = False
+        self.closed = False
+
+    def append_pcm(self, samples: Any) -> None:
+        with self.pcm_lock:
+            if not self.closed:
+                self.pcm.append(samples)
+
+    def pending_pcm(self) -> Any:
+        """Decoded samples not transcribed yet (starting at `offset`), as one array."""
+
+        import numpy as np  # type: ignore
+
+        with self.pcm_lock:
+            if len(self.pcm) > 1:
+                self.pcm = [np.concatenate(self.pcm)]
+            return self.pcm[0] if self.pcm else np.zeros(0, dtype=np.float32)
+
+    def consume_pcm(self, n: int) -> None:
+        with self.pcm_lock:
+            if self.pcm:
+                self.pcm[0] = self.pcm[0][n:]
+
+    def close(self) -> None:
+        self.closed = True
+        if self.feed is not None:
+            self.feed.finish()
+        with self.pcm_lock:
+            self.pcm = []
+
+
+def _list_session_chunks(session_id: str) -> list[Path]:
+    try:
+        session_dir = _note_session_dir(session_id)
+        return sorted((p for p in session_dir.glob('chunk_*') if p.is_file()), key=lambda p: p.name)
+    except Exception:
+        return []
+
+
+def _quiet_cut(samples: Any, target: int, lo: int = 0) -> int:
+    """Sample index of the quietest 200ms frame in the window ending at `target` (never before `lo`)."""
+
+    import numpy as np  # type: ignore
+
+    frame = int(0.2 * _WHISPER_SAMPLE_RATE)
+    start = max(lo, target - int(_LIVE_ASR_CUT_WINDOW_SECONDS * _WHISPER_SAMPLE_RATE))
+    n_frames = (target - start) // frame
+    if n_frames < 2:
+        return target
+    window = np.asarray(samples[start : start + n_frames * frame], dtype=np.float32).reshape(n_frames, frame)
+    quietest = int(np.argmin(np.einsum('ij,ij->i', window, window)))
+    return start + quietest * frame + frame // 2
+
+
+def _run_live_decoder(state: _LiveTranscript) -> None:
+    """Decode the session's WebM stream from `state.feed` until it is finished."""
+
+    try:
+        import av  # type: ignore
+        import numpy as np  # type: ignore
+
+        resampler = av.AudioResampler(format='s16', layout='mono', rate=_WHISPER_SAMPLE_RATE)
+
+        def emit(frames: list[Any]) -> None:
+            for f in frames:
+                state.append_pcm(f.to_ndarray().reshape(-1).astype(np.float32) / 32768.0)
+
+        with av.open(state.feed, format='matroska') as container:
+            for frame in container.decode(container.streams.audio[0]):
+                emit(resampler.resample(frame))
+            emit(resampler.resample(None))
+    except Exception as exc:
+        if not state.closed:
+            state.failed = True
+            app.logger.warning('Live decoder failed: %s', exc)
+
+
+def _feed_live_decoder(state: _LiveTranscript, session_id: str) -> None:
+    """Decode the chunks saved since the last pass into `state.pcm`."""
+
+    chunks = _list_session_chunks(session_id)
+    new_chunks = [p for p in chunks if p.name > state.last_chunk]
+    if not new_chunks:
+        return
+    if not state.last_chunk and _is_single_webm_stream(chunks):
+        # Only the first slice has the WebM header, so the stream can't be decoded
+        # chunk by chunk; one decoder thread keeps reading it as it grows.
+        state.feed = _ByteFeed()
+        threading.Thread(target=_run_live_decoder, args=(state,), name='live-asr-decode', daemon=True).start()
+    for path in new_chunks:
+        state.last_chunk = path.name
+        data = path.read_bytes()
+        if not data:
+            continue
+        if state.feed is not None:
+            state.feed.feed(data)
+        else:
+            samples = _decode_audio_av(io.BytesIO(data))
+            if samples is None:
+                raise RuntimeError(f'分片解码失败：{path.name}')
+            state.append_pcm(samples)
+
+
+def _advance_live_transcript(session_id: str) -> None:
+    with _LIVE_ASR_LOCK:
+        state = _LIVE_ASR_SESSIONS.get(session_id)
+        if state is None or state.chunks_seen == state.chunks_passed:
+            return
+        state.chunks_passed = state.chunks_seen
+    with state.lock:
+        if state.closed or state.failed:
+            return
+        try:
+            _feed_live_decoder(state, session_id)
+            samples = state.pending_pcm()
+            segment = int(_LIVE_ASR_SEGMENT_SECONDS * _WHISPER_SAMPLE_RATE)
+            # Leave a margin so the last cut never lands on the still-growing edge.
+            margin = int(_LIVE_ASR_CUT_WINDOW_SECONDS * _WHISPER_SAMPLE_RATE)
+            pos = 0
+            while len(samples) - pos >= segment + margin and not state.closed:
+                cut = _quiet_cut(samples, pos + segment, lo=pos + 1)
+                text = (transcribe_audio_samples(samples[pos:cut]) or '').strip()
+                if text:
+                    state.parts.append(text)
+                state.offset += cut - pos
+                pos = cut
+            state.consume_pcm(pos)
+        except Exception as exc:
+            state.failed = True
+            app.logger.warning('Live transcription failed for session %s: %s', session_id, exc)
+
+
+def note_live_transcript_chunk_added(session_id: str) -> None:
+    """Count a saved chunk; every LIVE_ASR_EVERY_CHUNKS chunks, queue a live pass."""
+
+    if _LIVE_ASR_SEGMENT_SECONDS <= 0:
+        return
+    now = time.monotonic()
+    with _LIVE_ASR_LOCK:
+        # Sessions that were never finalized would otherwise keep their decoder forever.
+        stale = [sid for sid, st in _LIVE_ASR_SESSIONS.items() if now - st.last_active > _LIVE_ASR_IDLE_SECONDS]
+        evicted = [_LIVE_ASR_SESSIONS.pop(sid) for sid in stale]
+        state = _LIVE_ASR_SESSIONS.setdefault(session_id, _LiveTranscript())
+        state.last_active = now
+        state.chunks_seen += 1
+        due = state.chunks_seen % _LIVE_ASR_EVERY_CHUNKS == 0
+    for st in evicted:
+        st.close()
+    if due and _WHISPER_READY.is_set():
+        try:
+            _LIVE_ASR_EXECUTOR.submit(_advance_live_transcript, session_id)
+        except Exception:
+            pass
+
+
+def _take_live_transcript(session_id: str) -> '_LiveTranscript | None':
+    """Close and return the session's live state (waits for a running segment)."""
+
+    with _LIVE_ASR_LOCK:
+        state = _LIVE_ASR_SESSIONS.pop(session_id, None)
+    if state is None:
+        return None
+    with state.lock:
+        state.close()
+    return None if state.failed else state
+
+
+def discard_live_transcript(session_id: str | None) -> None:
+    """Drop a session's live state without waiting for a running segment."""
+
+    if not session_id:
+        return
+    with _LIVE_ASR_LOCK:
+        state = _LIVE_ASR_SESSIONS.pop(session_id, None)
+    if state is not None:
+        state.close()
+
+
+def _finish_session_transcript(samples: Any, live: '_LiveTranscript | None') -> str:
+    """Live segments plus the untranscribed tail, or one full pass without usable live state."""
+
+    if live is None or not live.offset or live.offset > len(samples):
+        return transcribe_audio_samples(samples)
+    parts = list(live.parts)
+    tail = samples[live.offset :]
+    if len(tail) >= _WHISPER_SAMPLE_RATE // 2:
+        text = (transcribe_audio_samples(tail) or '').strip()
+        if text:
+            parts.append(text)
+    return '\n'.join(parts)
+
+
 @app.route('/api/note/session', methods=['POST'])
 def note_create_session():
     user, error_response, status = require_auth()
@@ -3173,22 +5335,25 @@ def note_append_chunk(session_id: str):
     if not audio_file:
         return jsonify({'message': '缺少音频分片字段 audio'}), 400
 
-    data = audio_file.read()
-    if not data:
-        return jsonify({'message': '音频分片为空'}), 400
-    if len(data) > 10 * 1024 * 1024:
-        return jsonify({'message': '单个分片过大（>10MB）'}), 400
-
     original_name = audio_file.filename or 'chunk.webm'
     mimetype = audio_file.mimetype or ''
 
-    # Always persist chunk for finalize fallback
+    # Always persist chunk for finalize fallback (streamed straight to disk)
     try:
-        _save_note_session_chunk(session_id, original_name, mimetype, data)
+        chunk_path = _save_note_session_chunk(
+            session_id, original_name, mimetype, audio_file.stream, max_size=NOTE_CHUNK_MAX_BYTES
+        )
+    except UploadTooLargeError:
+        return jsonify({'message': '单个分片过大（>10MB）'}), 400
     except Exception as exc:
         app.logger.warning('Failed to save note chunk: %s', exc)
+    else:
+        if not chunk_path.stat().st_size:
+            chunk_path.unlink(missing_ok=True)
+            return jsonify({'message': '音频分片为空'}), 400
+        # 已完成的长片段在后台先行转写，结束录音时只需转写剩余尾部。
+        note_live_transcript_chunk_added(session_id)
 
-    # 当前策略：不做实时转写，仅保存分片；停止录音后统一合并+转写。
     return jsonify({'ok': True, 'entry_id': entry.id})
 
 
@@ -3206,39 +5371,34 @@ def note_finalize_session(session_id: str):
         return jsonify({'message': '未找到会话'}), 404
 
     # Prefer merged transcription when chunks exist (chunk-level text is often inaccurate).
-    try:
-        session_dir = _note_session_dir(session_id)
-        chunks = sorted(
-            [p for p in session_dir.glob('chunk_*') if p.is_file()],
-            key=lambda p: p.name,
-        )
-    except Exception:
-        chunks = []
+    chunks = _list_session_chunks(session_id)
+    live = _take_live_transcript(session_id)
 
     if chunks:
-        with tempfile.TemporaryDirectory() as tmp:
-            wav_out = Path(tmp) / 'session.wav'
-            ok, err = _ffmpeg_concat_to_wav(chunks, wav_out)
-            if not ok:
-                return (
-                    jsonify(
-                        {
-                            'message': '暂无可用转写文本（分片合并失败）',
-                            'detail': err,
-                        }
-                    ),
-                    400,
-                )
-            try:
-                mp3_out = Path(tmp) / 'session.mp3'
-                mp3_ok, mp3_err = _ffmpeg_to_mp3(wav_out, mp3_out)
-                audio_for_asr = mp3_out if mp3_ok else wav_out
-                transcript = transcribe_audio_file(str(audio_for_asr))
-            except Exception as exc:
-                return jsonify({'message': f'合并后转写失败：{exc}'}), 400
+        not_ready = whisper_not_ready_response()
+        if not_ready is not None:
+            return not_ready
 
-            if not mp3_ok:
-                app.logger.warning('Finalize mp3 encode failed, fell back to wav ASR: %s', mp3_err)
+        samples, err = _decode_chunks_to_pcm(chunks)
+        if samples is None:
+            return (
+                jsonify(
+                    {
+                        'message': '暂无可用转写文本（分片合并失败）',
+                        'detail': err,
+                    }
+                ),
+                400,
+            )
+        # One joined array rather than one pipeline input per chunk: MediaRecorder
+        # slices split words arbitrarily, and the pipeline already batches its
+        # overlapping 30s windows on the device. Segments finished while recording
+        # are reused, so only the tail is transcribed here.
+        try:
+            pcm_digest = sha256(samples).hexdigest()  # decoded PCM is a contiguous float32 buffer
+            transcript = _transcribe_cached(pcm_digest, lambda: _finish_session_transcript(samples, live))
+        except Exception as exc:
+            return jsonify({'message': f'合并后转写失败：{exc}'}), 400
 
         entry.transcript_text = (transcript or '').strip()
         if not (entry.transcript_text or '').strip():
@@ -3459,14 +5619,16 @@ def bind_request_respond(request_id: int):
     if action == 'approve':
         # Bind: student -> parent
         user.linked_user_id = req.parent_id
-        save_and_commit(user)
         req.status = 'approved'
     else:
         req.status = 'rejected'
 
     req.responded_at = datetime.utcnow()
-    save_and_commit(req)
-    return jsonify({'message': '已处理', 'request': req.to_student_dict()})
+    # Serialize before committing: commit expires every loaded instance, so
+    # reading req/parent afterwards would cost a refresh SELECT per object.
+    payload = req.to_student_dict()
+    db.session.commit()
+    return jsonify({'message': '已处理', 'request': payload})
 
 
 @app.route('/api/profile/password', methods=['PUT'])
@@ -3484,17 +5646,35 @@ def update_password():
     if not check_password_hash(user.password_hash, current_password):
         return jsonify({'message': '当前密码不正确'}), 400
 
-    user.password_hash = generate_password_hash(new_password)
+    user.password_hash = hash_password(new_password)
     save_and_commit(user)
+    invalidate_token(user.auth_token)
 
     return jsonify({'message': '密码已更新'})
 
 
 if __name__ == '__main__':
     with app.app_context():
-        ensure_error_book_entry_schema()
-        ensure_note_assistant_schema()
-        ensure_knowledge_schema()
-        ensure_bind_schema()
+        ensure_schema()
         db.create_all()
-    app.run(host='0.0.0.0', port=3000, debug=True)
\ No newline at end of file
+        migrate_error_book_images_to_disk()
+        backfill_error_book_digests()
+        backfill_knowledge_hits()
+    if os.getenv('FLASK_DEBUG', '').strip() == '1':
+        # Development: debugger + reloader. Only the reloader's child process
+        # serves requests, so prewarm and resume jobs there.
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            start_model_prewarm()
+            with app.app_context():
+                resume_pending_error_book_jobs()
+        app.run(host='0.0.0.0', port=3000, debug=True)
+    else:
+        start_model_prewarm()
+        with app.app_context():
+            resume_pending_error_book_jobs()
+        try:
+            from waitress import serve
+        except ImportError:
+            app.run(host='0.0.0.0', port=3000, threaded=True)
+        else:
+            serve(app, host='0.0.0.0', port=3000, threads=int(os.getenv('SERVER_THREADS', '8')))
\ No newline at end of file
@@ -57,21 +57,27 @@ def main() -> int:
     sqlite_path = _resolve_sqlite_path(db_uri) if args.delete_sqlite_file else None
 
     with app.app_context():
-        print("Dropping all tables...")
-        db.drop_all()
-        db.session.commit()
-
+        # DDL goes straight through one engine transaction (no ORM session), so the drop
+        # and the recreate cost a single commit. app.py's connect hook already puts SQLite
+        # in WAL with synchronous=NORMAL.
         if sqlite_path is not None:
+            # A fresh file has no tables to drop; release pooled handles before deleting it.
+            db.engine.dispose()
             try:
                 if sqlite_path.exists():
                     print(f"Deleting SQLite file: {sqlite_path}")
                     sqlite_path.unlink()
+                # WAL side files belong to the deleted database.
+                for suffix in ("-wal", "-shm"):
+                    sqlite_path.with_name(sqlite_path.name + suffix).unlink(missing_ok=True)
             except Exception as exc:
                 print(f"Warning: failed to delete sqlite file: {exc}")
 
-        print("Creating all tables...")
-        db.create_all()
-        db.session.commit()
+        with db.engine.begin() as conn:
+            print("Dropping all tables...")
+            db.metadata.drop_all(bind=conn)
+            print("Creating all tables...")
+            db.metadata.create_all(bind=conn)
 
     print("Done.")
     return 0
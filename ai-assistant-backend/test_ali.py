@@ -1,3 +1,5 @@
+import asyncio
+import sys
 import time
 import nls
 import os
@@ -12,6 +14,9 @@ if not APPKEY or not TOKEN:
         "未配置阿里云 NLS 凭证：请设置环境变量 ALI_NLS_APPKEY 与 ALI_NLS_TOKEN 后再运行该脚本"
     )
 
+CHUNK_BYTES = 640
+CHUNK_SECONDS = CHUNK_BYTES / (16000 * 2)  # 16kHz 16bit 单声道：640 字节 = 20ms
+
 # ================= 回调函数 =================
 class TestSt:
     def __init__(self, tid, test_file):
@@ -30,22 +35,26 @@ class TestSt:
         )
         self.__file = test_file
 
-    def start(self):
-        # 启动识别，开启中间结果（实时出字）
-        self.__th.start(aformat="pcm",
-                        enable_intermediate_result=True,
-                        enable_punctuation_prediction=True,
-                        enable_inverse_text_normalization=True)
-        
+    async def start(self):
+        # 启动识别，开启中间结果（实时出字）；握手是阻塞调用，放到线程里不占事件循环
+        await asyncio.to_thread(self.__th.start,
+                                aformat="pcm",
+                                enable_intermediate_result=True,
+                                enable_punctuation_prediction=True,
+                                enable_inverse_text_normalization=True)
+
         # 模拟读取音频流发送
         with open(self.__file, "rb") as f:
-            self.__slices = zip(*(iter(f.read()),) * 640) # 每次发很小一段
-            for i in self.__slices:
-                self.__th.send_audio(bytes(i))
-                time.sleep(0.01) # 模拟真实语速
+            data = memoryview(f.read())  # 切片不复制，只在发送时拷贝一次
+        # 按真实语速发送：每段的发送时刻由起始时间推算，sleep 的误差不会累积
+        next_t = time.monotonic()
+        for off in range(0, len(data), CHUNK_BYTES): # 每次发很小一段
+            self.__th.send_audio(bytes(data[off:off + CHUNK_BYTES]))
+            next_t += CHUNK_SECONDS
+            await asyncio.sleep(max(0.0, next_t - time.monotonic()))
 
         # 发送结束指令
-        self.__th.stop()
+        await asyncio.to_thread(self.__th.stop)
 
     def test_on_sentence_begin(self, message, *args):
         print("句子开始:", message)
@@ -68,7 +77,12 @@ class TestSt:
     def test_on_completed(self, message, *args):
         print("识别完成")
 
+
+async def main(files):
+    # 多个文件即多路识别，在同一个事件循环里并发推流
+    await asyncio.gather(*(TestSt(f"session{i}", path).start() for i, path in enumerate(files, 1)))
+
+
 if __name__ == "__main__":
-    # 请确保目录下有 test.pcm 或 test.wav (16000Hz, 16bit, Mono)
-    t = TestSt("thread1", "test.pcm")
-    t.start()
\ No newline at end of file
+    # 请确保目录下有 test.pcm 或 test.wav (16000Hz, 16bit, Mono)；也可传入多个文件
+    asyncio.run(main(sys.argv[1:] or ["test.pcm"]))
\ No newline at end of file
@@ -3,37 +3,170 @@ from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor, pipeline
 from datasets import load_dataset
 
 import os
+import sys
 
 
 device = "cuda:0" if torch.cuda.is_available() else "cpu"
-torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+# 支持 bf16 的卡（Ampere 及以后）直接以 bfloat16 加载：指数位与 fp32 相同，不会像 fp16 那样溢出；
+# 同时允许 fp32 矩阵乘走 TF32。老卡仍用 fp16，CPU 用 fp32。
+if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+    torch_dtype = torch.bfloat16
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+elif torch.cuda.is_available():
+    torch_dtype = torch.float16
+else:
+    torch_dtype = torch.float32
 
 model_id = os.getenv('WHISPER_MODEL') or "openai/whisper-base"
 
-model = AutoModelForSpeechSeq2Seq.from_pretrained(
-    model_id, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=True
-)
-model.to(device)
+# 命令行可传入多个音频文件：python test_whisper.py a.mp3 b.mp3 ...
+audio_paths = sys.argv[1:] or ["C:\\Users\\qqrtq\\Documents\\GitHub\\computer-software\\test.mp3"]
 
+# WHISPER_BACKEND=ctranslate2：用 faster-whisper（CTranslate2）跑 int8 量化模型，
+# GPU 上 int8_float16、CPU 上 int8，权重读写带宽约减半。需 pip install faster-whisper。
+if os.getenv('WHISPER_BACKEND', '').strip().lower() == 'ctranslate2':
+    from faster_whisper import BatchedInferencePipeline, WhisperModel
+
+    ct2_model = WhisperModel(
+        model_id.rsplit('/', 1)[-1].removeprefix('whisper-'),  # openai/whisper-base -> base
+        device="cuda" if torch.cuda.is_available() else "cpu",
+        compute_type="int8_float16" if torch.cuda.is_available() else "int8",
+    )
+    batched = BatchedInferencePipeline(model=ct2_model)
+    for path in audio_paths:
+        segments, _ = batched.transcribe(
+            path, beam_size=1, vad_filter=True, batch_size=int(os.getenv('WHISPER_BATCH_SIZE') or 16)
+        )
+        print(path)
+        print("".join(seg.text for seg in segments))
+    sys.exit(0)
+
+
+def load_model(dev):
+    m = AutoModelForSpeechSeq2Seq.from_pretrained(
+        model_id, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=True, attn_implementation="sdpa"
+    )
+    m.to(dev)
+    # 与后端一致：WHISPER_TORCH_COMPILE=1 时编译 forward（首次调用较慢，Windows 可能不支持）。
+    if os.getenv('WHISPER_TORCH_COMPILE', '').strip() == '1':
+        m.generation_config.cache_implementation = "static"
+        m.forward = torch.compile(m.forward, mode="reduce-overhead", fullgraph=False)
+    m.generation_config.forced_decoder_ids = None
+    return m
+
+
+def make_pipe(m, dev):
+    return pipeline(
+        "automatic-speech-recognition",
+        model=m,
+        tokenizer=processor.tokenizer,
+        feature_extractor=processor.feature_extractor,
+        torch_dtype=torch_dtype,
+        device=dev,
+    )
+
+
+model = load_model(device)
 processor = AutoProcessor.from_pretrained(model_id)
+pipe = make_pipe(model, device)
 
-pipe = pipeline(
-    "automatic-speech-recognition",
-    model=model,
-    tokenizer=processor.tokenizer,
-    feature_extractor=processor.feature_extractor,
-    torch_dtype=torch_dtype,
-    device=device,
-)
+# 多卡：每张 GPU 各放一份模型，文件轮流分给各卡并行转写（不跨卡搬数据）。
+gpu_count = torch.cuda.device_count()
+if gpu_count > 1 and len(audio_paths) > 1:
+    from concurrent.futures import ThreadPoolExecutor
+
+    pipes = [pipe] + [make_pipe(load_model(f"cuda:{i}"), f"cuda:{i}") for i in range(1, gpu_count)]
+
+    def transcribe_on_gpu(i):
+        return pipes[i](
+            audio_paths[i::gpu_count],
+            batch_size=int(os.getenv('WHISPER_BATCH_SIZE') or 8),
+            chunk_length_s=30,
+            return_timestamps=True,
+            generate_kwargs={"num_beams": 1, "condition_on_prev_tokens": False},
+        )
+
+    with ThreadPoolExecutor(max_workers=gpu_count) as ex:
+        per_gpu = list(ex.map(transcribe_on_gpu, range(gpu_count)))
+    for i, results in enumerate(per_gpu):
+        for path, result in zip(audio_paths[i::gpu_count], results):
+            print(path)
+            print(result["text"])
+    sys.exit(0)
 
 dataset = load_dataset("distil-whisper/librispeech_long", "clean", split="validation")
 sample = dataset[0]["audio"]
 
-result = pipe(
-    "C:\\Users\\qqrtq\\Documents\\GitHub\\computer-software\\test.mp3", 
-    return_timestamps=True
-)
-print(result["text"])
+# 多个文件（以及长音频切出的 30s 片段）按 batch 一起送进模型，GPU 利用率更高。
+# 不以前文 token 为条件，各片段互不依赖，才能并行解码。
+
+if device.startswith("cuda"):
+    # GPU 上自己提特征：pipeline 内部用 NumPy 在 CPU 上逐条做 STFT/梅尔滤波，
+    # 这里传 device 让特征提取器用 torch 在 GPU 上批量计算，再直接 generate。
+    from transformers.pipelines.audio_utils import ffmpeg_read
+
+    sampling_rate = processor.feature_extractor.sampling_rate
+    arrays = []
+    for path in audio_paths:
+        with open(path, "rb") as f:
+            arrays.append(ffmpeg_read(f.read(), sampling_rate))
+    if os.getenv('WHISPER_VAD', '').strip() == '1':
+        # Silero VAD 去掉静音，把语音段拼成 <=30s 的窗口（切点都落在静音处，不需要重叠），
+        # 所有文件的窗口一起按 batch 编码：静音不再占编码器算力，短片段也不用各自补齐到 30s。
+        vad_model, vad_utils = torch.hub.load("snakers4/silero-vad", "silero_vad")
+        get_speech_timestamps = vad_utils[0]
+        max_len = 30 * sampling_rate
+
+        windows = []  # (文件序号, 音频片段)
+        for idx, audio in enumerate(arrays):
+            start = end = None
+            for ts in get_speech_timestamps(torch.from_numpy(audio), vad_model, sampling_rate=sampling_rate):
+                s0, s1 = ts["start"], ts["end"]
+                if start is not None and s1 - start > max_len:
+                    windows.append((idx, audio[start:end]))
+                    start = None
+                if start is None:
+                    start = s0
+                # 单段语音超过 30s 时硬切
+                while s1 - start > max_len:
+                    windows.append((idx, audio[start:start + max_len]))
+                    start += max_len
+                end = s1
+            if start is not None:
+                windows.append((idx, audio[start:end]))
+
+        texts = [""] * len(arrays)
+        batch_size = int(os.getenv('WHISPER_BATCH_SIZE') or 8)
+        for i in range(0, len(windows), batch_size):
+            batch = windows[i:i + batch_size]
+            inputs = processor([w for _, w in batch], sampling_rate=sampling_rate, return_tensors="pt", device=device)
+            inputs = inputs.to(device, torch_dtype)
+            generated = model.generate(**inputs, num_beams=1, condition_on_prev_tokens=False)
+            for (idx, _), text in zip(batch, processor.batch_decode(generated, skip_special_tokens=True)):
+                texts[idx] += text
+    else:
+        # 超过 30s 的音频走长音频（顺序）解码：不截断，按最长补齐。
+        long_form = max(len(a) for a in arrays) > 30 * sampling_rate
+        extra = {"truncation": False, "padding": "longest", "return_attention_mask": True} if long_form else {}
+        inputs = processor(arrays, sampling_rate=sampling_rate, return_tensors="pt", device=device, **extra)
+        inputs = inputs.to(device, torch_dtype)
+        generated = model.generate(**inputs, num_beams=1, condition_on_prev_tokens=False, return_timestamps=True)
+        texts = processor.batch_decode(generated, skip_special_tokens=True)
+    for path, text in zip(audio_paths, texts):
+        print(path)
+        print(text)
+else:
+    results = pipe(
+        audio_paths,
+        batch_size=int(os.getenv('WHISPER_BATCH_SIZE') or 8),
+        chunk_length_s=30,
+        return_timestamps=True,
+        generate_kwargs={"num_beams": 1, "condition_on_prev_tokens": False},
+    )
+    for path, result in zip(audio_paths, results):
+        print(path)
+        print(result["text"])
 
 ##要转录本地音频文件，只需在调用管道时传递音频文件的路径：
 
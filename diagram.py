@@ -1,5 +1,9 @@
 import os
 import platform
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from graphviz import Digraph
 from plantuml import PlantUML
 from diagrams import Diagram, Cluster
@@ -11,6 +15,7 @@ from diagrams.generic.device import Mobile
 from diagrams.custom import Custom
 
 # --- 1. 核心配置：自动选择中文字体 ---
+@lru_cache(maxsize=1)  # 操作系统不会变，只探测一次
 def get_chinese_font():
     """根据操作系统自动选择一个可用的中文字体"""
     system = platform.system()
@@ -29,16 +34,22 @@ print(f"检测到操作系统: {platform.system()}, 将使用字体: {CHINESE_FO
 
 
 # --- 2. 函数：生成用户核心学习闭环流程图 ---
+# 流程图的全局样式是常量，在模块级定义一次；构造 Digraph 时一次性传入，
+# 不再逐条 dot.attr(...) 追加（后一条 node 属性还会覆盖前一条）。
+_FLOWCHART_GRAPH_ATTRS = dict(rankdir='TB', splines='ortho', nodesep='0.8', ranksep='1.2')
+_FLOWCHART_NODE_ATTRS = dict(shape='box', style='rounded,filled', fontsize='12')
+
+
 def create_flowchart(font_name):
     """使用 Graphviz 生成流程图"""
     print("--- 正在生成用户核心学习闭环流程图... ---")
-    dot = Digraph(comment='AI Study Assistant - Core Loop')
-    dot.attr(rankdir='TB', splines='ortho', nodesep='0.8', ranksep='1.2')
-    
-    dot.attr('node', fontname=font_name)
-    dot.attr('edge', fontname=font_name)
-    
-    dot.attr('node', shape='box', style='rounded,filled', fontsize='12')
+    dot = Digraph(
+        comment='AI Study Assistant - Core Loop',
+        graph_attr=_FLOWCHART_GRAPH_ATTRS,
+        node_attr={**_FLOWCHART_NODE_ATTRS, 'fontname': font_name},
+        edge_attr={'fontname': font_name},
+    )
+
     user_action_color = '#E3F2FD'
     ai_process_color = '#E8F5E9'
     output_color = '#FFF3E0'
@@ -63,9 +74,12 @@ def create_flowchart(font_name):
     dot.edge('D', 'E2', label='数据反馈')
     dot.edge('E1', 'A', style='dashed', label='驱动新一轮学习')
 
-    output_filename = '1_user_core_loop_flowchart'
-    dot.render(output_filename, format='png', view=False, cleanup=True)
-    print(f"流程图已生成: {output_filename}.png")
+    output_filename = '1_user_core_loop_flowchart.png'
+    # pipe() 把 DOT 源码经 stdin 交给 dot，直接拿回 PNG 字节，省掉中间 .gv 文件的写入和清理
+    png = dot.pipe(format='png')
+    with open(output_filename, 'wb') as f:
+        f.write(png)
+    print(f"流程图已生成: {output_filename}")
 
 
 # --- 3. 函数：生成 UML 用例图 (已修正) ---
@@ -113,11 +127,23 @@ def create_uml_diagram(font_name):
     @enduml
     """
     
-    p = PlantUML(url="http://www.plantuml.com/plantuml")
     output_filename = '2_uml_use_case_diagram.png'
+    # 优先用本地 plantuml.jar（PLANTUML_JAR 或当前目录）经管道渲染，省掉网络往返；
+    # 没有 jar 或 Java 时退回在线服务。
+    jar = os.getenv('PLANTUML_JAR') or 'plantuml.jar'
     try:
+        if os.path.isfile(jar) and shutil.which('java'):
+            proc = subprocess.run(
+                ['java', '-jar', jar, '-pipe', '-tpng', '-charset', 'UTF-8'],
+                input=plantuml_code.encode('utf-8'),
+                capture_output=True,
+                check=True,
+            )
+            png = proc.stdout
+        else:
+            png = PlantUML(url="http://www.plantuml.com/plantuml").processes(plantuml_code)
         with open(output_filename, 'wb') as f:
-            f.write(p.processes(plantuml_code))
+            f.write(png)
         print(f"UML用例图已生成: {output_filename}")
     except Exception as e:
         print(f"生成UML图失败，请检查网络连接或Java环境: {e}")
@@ -135,9 +161,15 @@ def create_architecture_diagram(font_name):
     icon_path = "./icons"
     os.makedirs(icon_path, exist_ok=True)
     
-    whisper_icon = os.path.join(icon_path, "whisper.png") if os.path.exists(os.path.join(icon_path, "whisper.png")) else None
-    ocr_icon = os.path.join(icon_path, "paddleocr.png") if os.path.exists(os.path.join(icon_path, "paddleocr.png")) else None
-    vector_icon = os.path.join(icon_path, "vector.png") if os.path.exists(os.path.join(icon_path, "vector.png")) else None
+    # 一次列目录，代替对每个图标分别 stat
+    present = {e.name for e in os.scandir(icon_path) if e.is_file()}
+
+    def icon(name):
+        return os.path.join(icon_path, name) if name in present else None
+
+    whisper_icon = icon("whisper.png")
+    ocr_icon = icon("paddleocr.png")
+    vector_icon = icon("vector.png")
 
     with Diagram(
         "AI 学习助手 - 系统架构", 
@@ -177,8 +209,14 @@ def create_architecture_diagram(font_name):
 
 # --- 5. 主执行函数 ---
 if __name__ == "__main__":
-    create_flowchart(CHINESE_FONT)
-    create_uml_diagram(CHINESE_FONT)
-    create_architecture_diagram(CHINESE_FONT)
+    # 三张图互不依赖（两次本地 graphviz 渲染 + 一次 PlantUML 网络请求），分进程并行生成。
+    # 用进程而不是线程：diagrams 的 Diagram 上下文是全局状态，不是线程安全的。
+    with ProcessPoolExecutor(max_workers=3) as ex:
+        futures = [
+            ex.submit(fn, CHINESE_FONT)
+            for fn in (create_flowchart, create_uml_diagram, create_architecture_diagram)
+        ]
+        for fut in futures:
+            fut.result()  # 任一图失败时在这里抛出
     
     print("\n所有图表生成完毕！")
\ No newline at end of file